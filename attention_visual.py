@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from model import Transformer
+from model import Transformer, AttentionCapture
 from config import get_config, get_weights_file_path
 from train import get_model, get_ds, greedy_decode
 import altair as alt
@@ -16,29 +16,43 @@ print("Using device:", device)
 
 # Load config, dataset, model
 config = get_config()
+config['val_batch_size'] = 1  # one sentence per batch for the attention maps
 train_dataloader, val_dataloader, vocab_src, vocab_tgt = get_ds(config)
-model = get_model(config, vocab_src.get_vocab_size(), vocab_tgt.get_vocab_size()).to(device)
+model = get_model(config, vocab_src.get_vocab_size(), vocab_tgt.get_vocab_size(),
+                  vocab_src.token_to_id('[PAD]'), vocab_tgt.token_to_id('[PAD]')).to(device)
 
 # Load checkpoint best
 model_filename = "model wts pth"
 state = torch.load(model_filename)
 model.load_state_dict(state['model_state_dict'])
 
+layers = [0, 1, 2]
+heads = [0, 1, 2, 3, 4, 5, 6, 7]
+attention_maps = {}  # filled by load_next_batch
+
 
 def load_next_batch():
     batch = next(iter(val_dataloader))
     encoder_input = batch["encoder_input"].to(device)
-    encoder_mask = batch["encoder_mask"].to(device)
     decoder_input = batch["decoder_input"].to(device)
-    decoder_mask = batch["decoder_mask"].to(device)
+    encoder_mask = model.make_src_mask(encoder_input)
+    decoder_mask = model.make_tgt_mask(decoder_input)
 
     encoder_input_tokens = [vocab_src.id_to_token(idx) for idx in encoder_input[0].cpu().numpy()]
     decoder_input_tokens = [vocab_tgt.id_to_token(idx) for idx in decoder_input[0].cpu().numpy()]
 
     assert encoder_input.size(0) == 1, "Batch size must be 1 for visualization"
 
-    model_out = greedy_decode(
-        model, encoder_input, encoder_mask, vocab_src, vocab_tgt, config['seq_len'], device)
+    model.eval()
+    with torch.no_grad():
+        model_out = greedy_decode(
+            model, encoder_input, encoder_mask, vocab_src, vocab_tgt, config['seq_len'], device)
+        # one full (teacher forced) pass over the target with capture on --> (L, L) maps for every recorded block
+        # (the cached greedy decode above only runs one query row per step)
+        with AttentionCapture(model, layers=layers, to_cpu=True) as capture:
+            encoder_output = model.encode(encoder_input, encoder_mask)
+            model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask)
+    attention_maps.update(capture.maps)
 
     return batch, encoder_input_tokens, decoder_input_tokens
 
@@ -62,12 +76,8 @@ def mtx2df(m, max_row, max_col, row_tokens, col_tokens):
 
 
 def get_attn_map(attn_type: str, layer: int, head: int):
-    if attn_type == "encoder":
-        attn = model.encoder.layers[layer].self_attention_block.attention_score
-    elif attn_type == "decoder":
-        attn = model.decoder.layers[layer].self_attention_block.attention_score
-    elif attn_type == "encoder-decoder":
-        attn = model.decoder.layers[layer].self_cross_attention_block.attention_score
+    # attn_type--> "encoder", "decoder" or "encoder-decoder", as recorded by AttentionCapture
+    attn = attention_maps[(attn_type, layer)]
     return attn[0, head].data
 
 
@@ -111,9 +121,6 @@ print(f'Target: {batch["tgt_text"][0]}')
 
 sentence_len = encoder_input_tokens.index("[PAD]") if "[PAD]" in encoder_input_tokens else len(encoder_input_tokens)
 
-layers = [0, 1, 2]
-heads = [0, 1, 2, 3, 4, 5, 6, 7]
-
 # 🔧 Generate and Save Attention Charts as HTML
 enc_chart = get_all_attention_maps("encoder", layers, heads, encoder_input_tokens, encoder_input_tokens,
                                    min(20, sentence_len))
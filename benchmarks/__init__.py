@@ -0,0 +1 @@
+# CPU benchmarks, run from the repo root e.g. --> python -m benchmarks.decode_cache
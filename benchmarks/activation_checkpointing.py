@@ -0,0 +1,102 @@
+# training memory / throughput with activation checkpointing of every k-th encoder/decoder block
+#   parity--> loss + gradients with dropout on are identical to the plain model (RNG restored for the recompute)
+#   every (mode, batch) runs in a fresh process, peak = growth of the max resident set size during one training step
+#   max batch--> largest batch whose step fits --budget_mb, extrapolated linearly from the two largest measured batches
+# usage --> python -m benchmarks.activation_checkpointing [--batches 2 4 8] [--every 0 2 1] [--budget_mb 8000]
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+
+def train_step(model, src, tgt, vocab, loss_fn):
+    src_mask, tgt_mask = model.make_src_mask(src), model.make_tgt_mask(tgt)
+    out = model.project(model.decode(model.encode(src, src_mask), src_mask, tgt, tgt_mask))
+    loss = loss_fn(out.view(-1, vocab), tgt.view(-1))
+    loss.backward()
+    return loss
+
+
+def check_parity(args):
+    import torch
+    from model import set_activation_checkpointing
+    from benchmarks.common import random_model, random_source
+
+    model = random_model(args.vocab, seq_len=64, d_model=64, N=2, h=4, d_ff=128).train()  # dropout 0.1
+    src, _ = random_source(4, 32, args.vocab)
+    tgt, _ = random_source(4, 32, args.vocab, seed=1)
+    results = []
+    for every in (0, 1):
+        set_activation_checkpointing(model, every)
+        model.zero_grad()
+        torch.manual_seed(123)
+        loss = train_step(model, src, tgt, args.vocab, torch.nn.CrossEntropyLoss())
+        results.append((loss.item(), [p.grad.clone() for p in model.parameters()]))
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(results[0][1], results[1][1]))
+    return abs(results[0][0] - results[1][0]), grad_diff
+
+
+def run(every, batch, args, results):
+    import torch
+    from model import set_activation_checkpointing
+    from benchmarks.common import random_model, random_source
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = random_model(args.vocab, seq_len=args.seq_len, d_model=args.d_model, N=args.N).train()
+    set_activation_checkpointing(model, every)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    src, _ = random_source(batch, args.seq_len, args.vocab)
+    tgt, _ = random_source(batch, args.seq_len, args.vocab, seed=1)
+    # weights, gradients and Adam moments allocated before the baseline --> growth is activations only
+    train_step(model, src[:1, :8], tgt[:1, :8], args.vocab, loss_fn)
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=False)
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    train_step(model, src, tgt, args.vocab, loss_fn)
+    optimizer.step()
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(((peak - base) / 1024, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seq_len", type=int, default=350)
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--N", type=int, default=6)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--batches", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--every", type=int, nargs="+", default=[0, 2, 1], help="0--> off, k--> every k-th block")
+    parser.add_argument("--budget_mb", type=float, default=8000, help="activation memory available for one step")
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+
+    loss_diff, grad_diff = check_parity(args)
+    print(f"parity with dropout: loss diff {loss_diff:.2e}, max grad diff {grad_diff:.2e}")
+    assert loss_diff < 1e-5 and grad_diff < 1e-5, "checkpointed blocks do not reproduce the plain gradients"
+
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    print(f"{'every':>6} {'batch':>6} {'peak (MB)':>10} {'step (s)':>9} {'tok/s':>8}")
+    for every in args.every:
+        peaks = []
+        for batch in args.batches:
+            p = ctx.Process(target=run, args=(every, batch, args, results))
+            p.start()
+            peak, elapsed = results.get()
+            p.join()
+            peaks.append(peak)
+            print(f"{every:>6} {batch:>6} {peak:>10.0f} {elapsed:>9.2f} {batch * args.seq_len / elapsed:>8.0f}")
+        if len(args.batches) > 1:
+            (b0, b1), (p0, p1) = args.batches[-2:], peaks[-2:]
+            per_sentence = max((p1 - p0) / (b1 - b0), 1e-6)
+            max_batch = int(b1 + (args.budget_mb - p1) / per_sentence)
+            print(f"{every:>6} --> ~{per_sentence:.0f} MB per sentence, max batch within {args.budget_mb:.0f} MB: {max_batch}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# MultiHeadAttentionBlock backends on CPU: parity + time and memory across sequence lengths
+#   fused "sdpa" (torch scaled_dot_product_attention) vs explicit "math" softmax(q k^T / sqrt(d_k)) v
+# memory--> bytes autograd saves for backward during a training forward
+# usage --> python -m benchmarks.attention_backend [--batch 8] [--seq_lens 64 128 256 350 512]
+import argparse
+import torch
+from dataset import causal_mask
+from model import MultiHeadAttentionBlock
+from benchmarks.common import timeit
+
+
+def make_inputs(batch, seq_len, d_model, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    x = torch.randn(batch, seq_len, d_model, generator=g)
+    # padded keys at the end of every other row + causal --> same mask layout as the decoder self attention
+    lengths = torch.where(torch.arange(batch) % 2 == 0, seq_len, seq_len // 2)
+    pad = (torch.arange(seq_len).unsqueeze(0) < lengths.unsqueeze(1)).int()  # (batch, seq_len)
+    mask = pad.unsqueeze(1).unsqueeze(1) & causal_mask(seq_len).int()  # (batch,1,seq_len,seq_len)
+    return x, mask
+
+
+def block(backend, d_model, h, seed=0):
+    torch.manual_seed(seed)
+    return MultiHeadAttentionBlock(d_model, h, dropout=0.0, backend=backend)
+
+
+def check_parity(d_model, h):
+    # outputs and input gradients of both backends must match (dropout off)
+    x, mask = make_inputs(4, 64, d_model)
+    results = []
+    for backend in ("sdpa", "math"):
+        m = block(backend, d_model, h)
+        xi = x.clone().requires_grad_(True)
+        out = m(xi, xi, xi, mask)
+        out.sum().backward()
+        results.append((out.detach(), xi.grad))
+    return (results[0][0] - results[1][0]).abs().max().item(), (results[0][1] - results[1][1]).abs().max().item()
+
+
+def saved_bytes(m, x, mask):
+    # size of every tensor autograd keeps for backward
+    total = 0
+
+    def pack(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        m(x, x, x, mask)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--h", type=int, default=8)
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[64, 128, 256, 350, 512])
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    out_diff, grad_diff = check_parity(args.d_model, args.h)
+    print(f"parity sdpa vs math: max abs diff output {out_diff:.2e}, input grad {grad_diff:.2e}")
+    assert out_diff < 1e-4 and grad_diff < 1e-4, "attention backends disagree"
+
+    print(f"{'seq_len':>8} {'backend':>8} {'infer (ms)':>11} {'train (ms)':>11} {'saved (MB)':>11}")
+    for seq_len in args.seq_lens:
+        x, mask = make_inputs(args.batch, seq_len, args.d_model)
+        for backend in ("sdpa", "math"):
+            m = block(backend, args.d_model, args.h)
+
+            def infer():
+                with torch.no_grad():
+                    m(x, x, x, mask)
+
+            xg = x.clone().requires_grad_(True)
+
+            def train():
+                m(xg, xg, xg, mask).sum().backward()
+
+            t_infer = timeit(infer) * 1000
+            t_train = timeit(train) * 1000
+            mb = saved_bytes(m, xg, mask) / 2 ** 20
+            print(f"{seq_len:>8} {backend:>8} {t_infer:>11.2f} {t_train:>11.2f} {mb:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# peak memory of a training loop with / without attention probabilities kept alive
+#   retain-all --> explicit attention + every block keeps its last probabilities (what the blocks did before AttentionCapture)
+#   math       --> explicit attention, nothing kept
+#   sdpa       --> fused attention, nothing kept (default)
+# every mode runs in a fresh process, peak = max resident set size of that process
+# held = probabilities still referenced after the optimizer step, i.e. memory pinned between steps / during validation
+# usage --> python -m benchmarks.attention_capture [--batch 8] [--seq_len 350] [--steps 3]
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+
+def run_mode(mode, args, results):
+    import torch
+    from model import AttentionCapture, set_attention_backend
+    from benchmarks.common import random_model, random_source
+
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    model = random_model(args.vocab, seq_len=args.seq_len, d_model=args.d_model, N=args.N)
+    set_attention_backend(model, "sdpa" if mode == "sdpa" else "math")
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    src, src_mask = random_source(args.batch, args.seq_len, args.vocab)
+    tgt, _ = random_source(args.batch, args.seq_len, args.vocab, seed=1)
+    tgt_mask = model.make_tgt_mask(tgt)
+    capture = AttentionCapture(model) if mode == "retain-all" else None
+    if capture is not None:
+        capture.__enter__()
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        out = model.project(model.decode(model.encode(src, src_mask), src_mask, tgt, tgt_mask))
+        loss = loss_fn(out.view(-1, args.vocab), tgt.view(-1))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    elapsed = (time.perf_counter() - start) / args.steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on linux
+    held = sum(t.numel() * t.element_size() for t in capture.maps.values()) if capture is not None else 0
+    results.put((mode, peak / 1024, (peak - base) / 1024, held / 2 ** 20, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=350)
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--N", type=int, default=6)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    print(f"{'mode':>11} {'peak RSS (MB)':>14} {'growth in loop (MB)':>20} {'held (MB)':>10} {'step (s)':>9}")
+    for mode in ("retain-all", "math", "sdpa"):
+        p = ctx.Process(target=run_mode, args=(mode, args, results))
+        p.start()
+        name, peak, growth, held, step = results.get()
+        p.join()
+        print(f"{name:>11} {peak:>14.0f} {growth:>20.0f} {held:>10.0f} {step:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
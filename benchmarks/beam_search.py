@@ -0,0 +1,62 @@
+# decoding throughput on CPU: greedy vs batched beam search at beam sizes 1/4/8
+# usage --> python -m benchmarks.beam_search [--batch 16] [--max_len 60]
+import argparse
+import time
+import torch
+from decoding import greedy_decode, beam_search
+from benchmarks.common import SpecialTokens, random_model, random_source
+
+
+def log_prob(model, src, src_mask, out, pad_id):
+    # teacher forced log prob of every decoded row ([SOS] excluded, [PAD] ignored)
+    decoder_input = out[:, :-1]
+    decoded = model.decode(model.encode(src, src_mask), src_mask, decoder_input, model.make_tgt_mask(decoder_input))
+    log_probs = torch.log_softmax(model.project(decoded).float(), dim=-1)
+    picked = log_probs.gather(-1, out[:, 1:].unsqueeze(-1)).squeeze(-1)
+    return (picked * (out[:, 1:] != pad_id)).sum(dim=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--src_len", type=int, default=30)
+    parser.add_argument("--max_len", type=int, default=60)
+    parser.add_argument("--beam_sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--length_penalty", type=float, default=0.6)
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = random_model(args.vocab, d_model=args.d_model)
+    src, src_mask = random_source(args.batch, args.src_len, args.vocab)
+    tok = SpecialTokens()
+
+    with torch.no_grad():
+        greedy = greedy_decode(model, src, src_mask, tok, tok, args.max_len, "cpu")
+        # without length penalty the live beam of beam 1 follows the greedy path and greedy's hypothesis is one of
+        # the finished candidates --> beam 1 never scores below greedy
+        beam1 = beam_search(model, src, src_mask, tok, args.max_len, "cpu", beam_size=1, length_penalty=0.0)
+        pad_id = tok.token_to_id("[PAD]")
+        not_worse = (log_prob(model, src, src_mask, beam1, pad_id) >= log_prob(model, src, src_mask, greedy, pad_id) - 1e-4)
+        print(f"beam 1 log prob >= greedy: {bool(not_worse.all())}")
+
+        runs = [("greedy", lambda: greedy_decode(model, src, src_mask, tok, tok, args.max_len, "cpu"))]
+        for k in args.beam_sizes:
+            runs.append((f"beam {k}", lambda k=k: beam_search(model, src, src_mask, tok, args.max_len, "cpu",
+                                                               beam_size=k, length_penalty=args.length_penalty)))
+        print(f"{'decoder':>10} {'seconds':>9} {'sent/s':>8} {'tok/s':>9} {'empty':>6}")
+        for name, fn in runs:
+            start = time.perf_counter()
+            out = fn()
+            elapsed = time.perf_counter() - start
+            # generated tokens exclude [SOS] and [PAD]
+            generated = int((out != tok.token_to_id("[PAD]")).sum()) - out.size(0)
+            empty = int((out[:, 1] == tok.token_to_id("[EOS]")).sum())  # [SOS][EOS] outputs
+            print(f"{name:>10} {elapsed:>9.2f} {args.batch / elapsed:>8.1f} {generated / elapsed:>9.1f} {empty:>6}")
+
+
+if __name__ == "__main__":
+    main()
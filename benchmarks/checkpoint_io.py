@@ -0,0 +1,77 @@
+# end of epoch checkpointing: how long the training loop is blocked, and inference load time
+#   sync--> torch.save of model + Adam state (+ a second one for "best"), what train_model did before
+#   async--> CheckpointWriter.save (cpu snapshot only), the write itself runs on the background thread
+#   load--> full torch.load vs load_checkpoint (memory mapped on torch >= 2.1) + load_state_dict
+# usage --> python -m benchmarks.checkpoint_io [--d_model 512] [--N 6] [--vocab 8000]
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from checkpoints import CheckpointWriter, load_checkpoint
+from config import get_config, get_weights_file_path
+from benchmarks.common import random_model, random_source, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--N", type=int, default=6)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--epochs", type=int, default=4)
+    args = parser.parse_args()
+
+    model = random_model(args.vocab, seq_len=64, d_model=args.d_model, N=args.N).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    src, _ = random_source(2, 16, args.vocab)
+    out = model(src, model.make_src_mask(src), src, model.make_tgt_mask(src))
+    out.float().mean().backward()
+    optimizer.step()  # Adam moments allocated
+    state = lambda epoch: {'epoch': epoch, 'model_state_dict': model.state_dict(),
+                           'optimizer_state_dict': optimizer.state_dict(), 'global_step': epoch}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = get_config()
+        config['data_source'] = os.path.join(tmp, "bench")
+        writer = CheckpointWriter(config, keep_last=2)
+
+        start = time.perf_counter()
+        for epoch in range(args.epochs):
+            torch.save(state(epoch), os.path.join(tmp, "sync.pt"))
+            torch.save(state(epoch), os.path.join(tmp, "sync_best.pt"))  # every epoch improving --> worst case
+        sync = (time.perf_counter() - start) / args.epochs
+
+        blocked = []
+        start = time.perf_counter()
+        for epoch in range(args.epochs):
+            t = time.perf_counter()
+            writer.save(state(epoch), epoch, val_loss=1.0 / (epoch + 1), best=True)
+            blocked.append(time.perf_counter() - t)
+        writer.close()
+        total = (time.perf_counter() - start) / args.epochs
+
+        path = get_weights_file_path(config, f"{args.epochs - 1:02d}")
+        size = os.path.getsize(path) / 2 ** 20
+        kept = sorted(f for f in os.listdir(os.path.dirname(path)))
+        print(f"checkpoint {size:.0f} MB, files after {args.epochs} epochs (keep_last=2): {kept}")
+        print(f"sync save (epoch + best): {sync * 1000:8.0f} ms blocked per epoch")
+        # back to back saves also wait for the previous write (one pending snapshot), real epochs are longer than a write
+        print(f"async save:               {blocked[0] * 1000:8.0f} ms blocked (cpu snapshot), "
+              f"{sum(blocked) / len(blocked) * 1000:.0f} ms back to back, {total * 1000:.0f} ms per write")
+
+        def full():
+            model.load_state_dict(torch.load(path, map_location="cpu")['model_state_dict'])
+
+        def mapped():
+            model.load_state_dict(load_checkpoint(path)['model_state_dict'])
+
+        mmap = "mmap" in torch.load.__code__.co_varnames
+        print(f"load full torch.load:     {timeit(full, repeat=3) * 1000:8.0f} ms")
+        print(f"load_checkpoint{' (mmap)' if mmap else ' (no mmap in this torch, full load)'}: "
+              f"{timeit(mapped, repeat=3) * 1000:8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
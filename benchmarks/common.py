@@ -0,0 +1,59 @@
+import time
+import torch
+from model import build_transformer
+
+
+class SpecialTokens:
+    # the ids get_or_build_tokenizer gives the special tokens, enough for the decoders without a trained tokenizer
+    ids = {"[UNK]": 0, "[PAD]": 1, "[SOS]": 2, "[EOS]": 3}
+
+    def token_to_id(self, token):
+        return self.ids[token]
+
+
+def random_model(vocab_size: int = 1000, seq_len: int = 350, d_model: int = 512, N: int = 6, h: int = 8,
+                 d_ff: int = 2048, seed: int = 0):
+    # randomly initialized model from build_transformer --> no dataset / checkpoint needed
+    torch.manual_seed(seed)
+    pad_id = SpecialTokens.ids["[PAD]"]
+    model = build_transformer(vocab_size, vocab_size, seq_len, seq_len, d_model=d_model, N=N, h=h, d_ff=d_ff,
+                              src_pad_id=pad_id, tgt_pad_id=pad_id)
+    model.eval()
+    return model
+
+
+def random_source(batch: int, length: int, vocab_size: int = 1000, seed: int = 0):
+    # token ids in [4, vocab) so they never hit the special tokens [UNK] [PAD] [SOS] [EOS]
+    g = torch.Generator().manual_seed(seed)
+    src = torch.randint(4, vocab_size, (batch, length), generator=g)
+    src_mask = torch.ones(batch, 1, 1, length, dtype=torch.int)
+    return src, src_mask
+
+
+def timeit(fn, repeat: int = 5, warmup: int = 1):
+    # best of `repeat` wall clock timings in seconds
+    for _ in range(warmup):
+        fn()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def sample_pairs(translator, n: int, seed: int = 0, sources: str = None, references: str = None):
+    # (sources, [[reference]]) for the BLEU comparisons --> the same sentences for every run
+    # sources / references--> parallel text files (one sentence per line), e.g. a held out test set
+    # otherwise a seeded sample of n rows of the token cache
+    if sources:
+        with open(sources, encoding="utf-8") as f:
+            src = [line.strip() for line in f][:n]
+        with open(references, encoding="utf-8") as f:
+            ref = [[line.strip()] for line in f][:n]
+        return src, ref
+    import random
+    translator.source_pair(0)  # opens the token cache
+    size = len(translator.dataset)
+    pairs = [translator.source_pair(i) for i in random.Random(seed).sample(range(size), min(n, size))]
+    return [p[0] for p in pairs], [[p[1]] for p in pairs]
@@ -0,0 +1,79 @@
+# data parallel training throughput (gloo, cpu) at 1/2/4/8 processes on this machine
+#   every rank trains its own synthetic batches through DistributedDataParallel, like train_es_lr.train_worker
+#   tokens/s--> non pad target tokens of all ranks / wall clock of the slowest rank, efficiency = speedup / processes
+#   threads are split evenly between the ranks (torch.set_num_threads(cores // processes))
+# usage --> python -m benchmarks.ddp_scaling [--processes 1 2 4 8] [--steps 10] [--batch 8]
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def worker(rank, world_size, args, results):
+    from model import data_parallel
+    from benchmarks.common import random_model, random_source
+
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port + world_size)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    model = random_model(args.vocab, seq_len=args.seq_len, d_model=args.d_model, N=args.N).train()
+    ddp_model = data_parallel(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=1)
+    # different data on every rank, same shapes --> same work per step
+    src, _ = random_source(args.batch, args.seq_len, args.vocab, seed=2 * rank)
+    tgt, _ = random_source(args.batch, args.seq_len, args.vocab, seed=2 * rank + 1)
+    src_mask, tgt_mask = model.make_src_mask(src), model.make_tgt_mask(tgt)
+
+    def step():
+        out = ddp_model(src, src_mask, tgt, tgt_mask)
+        loss_fn(out.view(-1, args.vocab), tgt.view(-1)).backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    step()  # warmup (DDP bucket setup, allocator)
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        tokens = world_size * args.steps * int((tgt != 1).sum())
+        results.put(tokens / elapsed)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=8, help="sentences per rank and step")
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--d_model", type=int, default=256)
+    parser.add_argument("--N", type=int, default=3)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--port", type=int, default=29600)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cpu cores")
+    print(f"{'procs':>6} {'tok/s':>10} {'speedup':>8} {'efficiency':>11}")
+    ctx = mp.get_context("spawn")
+    base = None
+    for world_size in args.processes:
+        results = ctx.SimpleQueue()
+        mp.start_processes(worker, args=(world_size, args, results), nprocs=world_size, join=True,
+                           start_method="spawn")
+        throughput = results.get()
+        base = base or throughput
+        speedup = throughput / base
+        print(f"{world_size:>6} {throughput:>10.0f} {speedup:>7.2f}x {speedup / world_size:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# per token decode latency vs prefix length on CPU: full prefix recompute vs kv cache
+# vs kv cache + cross attention keys/values precomputed by model.prepare_memory
+# usage --> python -m benchmarks.decode_cache [--d_model 512] [--threads 1]
+import argparse
+import torch
+from benchmarks.common import random_model, random_source, timeit
+
+
+def check_parity(model, src, src_mask, tgt, memory: bool):
+    # decoder outputs of the cached step by step path must match the full recompute for every position
+    with torch.no_grad():
+        enc = model.encode(src, src_mask)
+        full = model.decode(enc, src_mask, tgt, model.make_tgt_mask(tgt))
+        cache = model.prepare_memory(enc) if memory else model.new_cache()
+        steps = [model.decode(enc, src_mask, tgt[:, i:i + 1], None, cache) for i in range(tgt.size(1))]
+    return (full - torch.cat(steps, dim=1)).abs().max().item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--vocab", type=int, default=1000)
+    parser.add_argument("--src_len", type=int, default=50)
+    parser.add_argument("--prefix_lens", type=int, nargs="+", default=[1, 25, 50, 100, 200, 300])
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = random_model(args.vocab, d_model=args.d_model)
+    src, src_mask = random_source(1, args.src_len, args.vocab)
+    tgt, _ = random_source(1, max(args.prefix_lens), args.vocab, seed=1)
+
+    for memory in (False, True):
+        diff = check_parity(model, src, src_mask, tgt[:, :64], memory)
+        print(f"parity {'kv cache + memory' if memory else 'kv cache'} (max abs diff of decoder outputs, 64 steps): {diff:.2e}")
+        assert diff < 1e-4, "cached decode does not match full recompute"
+
+    with torch.no_grad():
+        enc = model.encode(src, src_mask)
+        print(f"{'prefix':>8} {'full (ms)':>12} {'cached (ms)':>12} {'+memory (ms)':>13} {'speedup':>8}")
+        for L in args.prefix_lens:
+            prefix = tgt[:, :L]
+
+            def full_step():
+                out = model.decode(enc, src_mask, prefix, model.make_tgt_mask(prefix))
+                model.project(out[:, -1])
+
+            def make_step(memory: bool):
+                # fill the cache with the first L-1 tokens, every timed call decodes token L from that state
+                cache = model.prepare_memory(enc) if memory else model.new_cache()
+                if L > 1:
+                    model.decode(enc, src_mask, prefix[:, :-1], model.make_tgt_mask(prefix[:, :-1]), cache)
+                snapshot = [(c.key, c.value) for c in cache.self_attn]
+                length = cache.length
+
+                def cached_step():
+                    for c, (k, v) in zip(cache.self_attn, snapshot):
+                        c.key, c.value = k, v
+                    if not memory:
+                        for c in cache.cross_attn:
+                            c.key = c.value = None  # project the encoder output again, like the plain kv cache
+                    cache.length = length
+                    out = model.decode(enc, src_mask, prefix[:, -1:], None, cache)
+                    model.project(out[:, -1])
+                return cached_step
+
+            t_full = timeit(full_step) * 1000
+            t_cached = timeit(make_step(False)) * 1000
+            t_memory = timeit(make_step(True)) * 1000
+            print(f"{L:>8} {t_full:>12.2f} {t_cached:>12.2f} {t_memory:>13.2f} {t_full / t_memory:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# per layer CPU time of the attention projections: separate w_q / w_k / w_v GEMMs (old layout) vs fused w_qkv / w_kv
+#   self attention   --> full sequence forward (encoder / training) and one cached decode step
+#   cross attention  --> encoder keys/values projection (prepare_memory) + full forward
+# parity--> old layout weights loaded through the state_dict conversion give the same outputs
+# usage --> python -m benchmarks.fused_qkv [--batch 8] [--seq_lens 32 128 350] [--threads 1]
+import argparse
+import torch
+import torch.nn as nn
+from model import MultiHeadAttentionBlock, AttentionCache
+from benchmarks.common import timeit
+
+
+class SeparateQKV(MultiHeadAttentionBlock):
+    # the layout before the fusion --> three (d_model, d_model) GEMMs
+    def __init__(self, d_model, h, cross: bool = False):
+        super().__init__(d_model, h, dropout=0.0, cross=cross)
+        for name in ("w_qkv", "w_kv"):
+            if hasattr(self, name):
+                delattr(self, name)
+        self.w_q = nn.Linear(d_model, d_model, bias=False)
+        self.w_k = nn.Linear(d_model, d_model, bias=False)
+        self.w_v = nn.Linear(d_model, d_model, bias=False)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        nn.Module._load_from_state_dict(self, *args, **kwargs)
+
+    def project_kv(self, x):
+        return self.split_heads(self.w_k(x)), self.split_heads(self.w_v(x))
+
+    def forward(self, q, k, v, mask, cache: AttentionCache = None):
+        query = self.split_heads(self.w_q(q))
+        if cache is not None and cache.static and cache.key is not None:
+            key, value = cache.key, cache.value
+        else:
+            key, value = self.project_kv(k)
+            if cache is not None:
+                key, value = cache.update(key, value)
+        x = nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=mask)
+        return self.w_o(x.transpose(1, 2).reshape(x.shape[0], -1, self.d_model))
+
+
+def pair(d_model, h, cross):
+    torch.manual_seed(0)
+    old = SeparateQKV(d_model, h, cross).eval()
+    new = MultiHeadAttentionBlock(d_model, h, dropout=0.0, cross=cross).eval()
+    new.load_state_dict(old.state_dict())  # old checkpoint keys --> converted on load
+    return old, new
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--h", type=int, default=8)
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[32, 128, 350])
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    self_old, self_new = pair(args.d_model, args.h, cross=False)
+    cross_old, cross_new = pair(args.d_model, args.h, cross=True)
+    with torch.no_grad():
+        x = torch.randn(2, 20, args.d_model)
+        memory = torch.randn(2, 30, args.d_model)
+        diff_self = (self_old(x, x, x, None) - self_new(x, x, x, None)).abs().max().item()
+        diff_cross = (cross_old(x, memory, memory, None) - cross_new(x, memory, memory, None)).abs().max().item()
+    print(f"parity old layout -> fused (max abs diff): self {diff_self:.2e}, cross {diff_cross:.2e}")
+    assert diff_self < 1e-5 and diff_cross < 1e-5, "converted weights do not reproduce the old outputs"
+
+    print(f"{'seq_len':>8} {'layer':>22} {'separate (ms)':>14} {'fused (ms)':>11} {'speedup':>8}")
+    for seq_len in args.seq_lens:
+        x = torch.randn(args.batch, seq_len, args.d_model)
+        step = torch.randn(args.batch, 1, args.d_model)
+        history = [(torch.randn(args.batch, args.h, seq_len, args.d_model // args.h),) * 2 for _ in range(2)]
+
+        def cached_step(block, kv):
+            def run():
+                cache = AttentionCache()
+                cache.key, cache.value = kv
+                block(step, step, step, None, cache)
+            return run
+
+        cases = {
+            "self forward": [lambda b=b: b(x, x, x, None) for b in (self_old, self_new)],
+            "self cached step": [cached_step(self_old, history[0]), cached_step(self_new, history[1])],
+            "cross kv projection": [lambda b=b: b.project_kv(x) for b in (cross_old, cross_new)],
+            "cross forward": [lambda b=b: b(step, x, x, None) for b in (cross_old, cross_new)],
+        }
+        with torch.no_grad():
+            for name, (old_fn, new_fn) in cases.items():
+                t_old, t_new = timeit(old_fn) * 1000, timeit(new_fn) * 1000
+                print(f"{seq_len:>8} {name:>22} {t_old:>14.3f} {t_new:>11.3f} {t_old / t_new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# cost of the training loop instrumentation per step
+#   per step flush--> loss.item() + writer.add_scalar + writer.flush() every batch (train_model before)
+#   buffered--> MetricBuffer + TokenCounter, one sync / write every --log_every steps, phase timers off (default)
+#   timers--> buffered + StepTimer on, also prints where the step time goes
+# usage --> python -m benchmarks.instrumentation [--steps 60] [--log_every 50] [--batch 8] [--seq_len 64] [--repeat 2]
+import argparse
+import tempfile
+import time
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from instrumentation import MetricBuffer, StepTimer, TokenCounter, peak_memory_mb
+from benchmarks.common import SpecialTokens, random_model, random_source
+
+
+def run(mode, args, log_dir):
+    model = random_model(args.vocab, seq_len=args.seq_len, d_model=args.d_model, N=args.N).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    pad_id = SpecialTokens.ids["[PAD]"]
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=pad_id)
+    writer = SummaryWriter(log_dir)
+    metrics = MetricBuffer(writer, args.log_every)
+    timer = StepTimer(mode == "timers")
+    timer.attach(model)
+    tokens = TokenCounter(pad_id)
+    batches = [(random_source(args.batch, args.seq_len, args.vocab, seed=2 * i)[0],
+                random_source(args.batch, args.seq_len, args.vocab, seed=2 * i + 1)[0]) for i in range(4)]
+
+    start = time.perf_counter()
+    for step in range(1, args.steps + 1):
+        for src, tgt in timer.iterate([batches[step % len(batches)]]):
+            with timer.phase("data"):
+                src_mask, tgt_mask = model.make_src_mask(src), model.make_tgt_mask(tgt)
+            out = model(src, src_mask, tgt, tgt_mask)
+            with timer.phase("loss"):
+                loss = loss_fn(out.view(-1, args.vocab), tgt.view(-1))
+            if mode == "per step flush":
+                writer.add_scalar('train loss', loss.item(), step)
+                writer.flush()
+            else:
+                metrics.add('train loss', loss, step)
+                tokens.add(tgt)
+            with timer.phase("backward"):
+                loss.backward()
+            with timer.phase("optimizer"):
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+            timer.step()
+            if mode != "per step flush" and metrics.due(step):
+                metrics.add('train/tokens_per_sec', tokens.rate(), step)
+                metrics.add('train/peak_memory_mb', peak_memory_mb("cpu"), step)
+                means = timer.means()
+                for name, ms in means.items():
+                    metrics.add(f'train/time_ms/{name}', ms, step)
+                timer.reset()
+                metrics.flush()
+                if means:
+                    print("   " + ", ".join(f"{name} {ms:.1f}" for name, ms in means.items()) + " (ms per step)")
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed / args.steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=60)
+    parser.add_argument("--log_every", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--d_model", type=int, default=128)
+    parser.add_argument("--N", type=int, default=2)
+    parser.add_argument("--vocab", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # alternating rounds, best of --repeat --> no advantage for the mode that runs last
+        for r in range(args.repeat):
+            for mode in ("per step flush", "buffered", "timers"):
+                seconds = run(mode, args, f"{tmp}/{mode.replace(' ', '_')}_{r}")
+                results[mode] = min(results.get(mode, seconds), seconds)
+    base = results["per step flush"]
+    for mode, seconds in results.items():
+        print(f"{mode:>15}: {seconds * 1000:7.2f} ms/step ({(seconds / base - 1) * 100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# load generator for serve.py --> p50/p99 latency and throughput against a local instance
+# usage --> python serve.py &   then   python -m benchmarks.load_test --requests 500 --concurrency 32
+import argparse
+import asyncio
+import json
+import random
+import time
+
+SENTENCES = [
+    "I am not a very good student.",
+    "The house was quiet.",
+    "She looked at him for a long time without saying anything.",
+    "Where are you going?",
+    "It was the best of times, it was the worst of times.",
+    "He opened the door and went out into the garden, where the rain had stopped.",
+    "Thank you.",
+    "They had never seen anything like it before in their lives.",
+]
+
+
+async def post(host, port, text):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps({"text": text}).encode("utf-8")
+    writer.write(f"POST /translate HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    return status, json.loads(payload)
+
+
+async def get_metrics(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET /metrics HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), json.loads(payload)
+
+
+async def run(args, sentences):
+    latencies, statuses, tokens = [], {}, 0
+    todo = iter(range(args.requests))
+
+    async def client():
+        nonlocal tokens
+        for _ in todo:
+            start = time.perf_counter()
+            status, payload = await post(args.host, args.port, random.choice(sentences))
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+                tokens += payload["tokens"]
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def pct(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+
+    print(f"requests: {args.requests}, concurrency: {args.concurrency}, status codes: {statuses}")
+    print(f"latency p50 {pct(0.5):.1f}ms  p90 {pct(0.9):.1f}ms  p99 {pct(0.99):.1f}ms")
+    print(f"throughput {len(latencies) / elapsed:.2f} req/s, {tokens / elapsed:.1f} tokens/s ({elapsed:.1f}s total)")
+    _, metrics = await get_metrics(args.host, args.port)
+    print("server metrics:", json.dumps(metrics, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16, help="clients with one request in flight each")
+    parser.add_argument("--sentences", default=None, help="text file with one sentence per line (default: built in)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sentences = SENTENCES
+    if args.sentences:
+        with open(args.sentences, encoding="utf-8") as f:
+            sentences = [line.strip() for line in f if line.strip()]
+    asyncio.run(run(args, sentences))
+
+
+if __name__ == "__main__":
+    main()
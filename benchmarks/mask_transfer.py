@@ -0,0 +1,124 @@
+# DataLoader output + host to device traffic: per sample materialized masks (old) vs ids only with model side masks (new)
+#   old --> int32 encoder_mask (1,1,L) + decoder_mask (1,L,L) per sample, collated and moved with every batch
+#   new --> ids only, model.make_src_mask / make_tgt_mask build bool masks on the device from a cached causal buffer
+# also checks that the model side masks equal the old ones
+# usage --> python -m benchmarks.mask_transfer [--batch 8] [--seq_len 350] [--samples 512] [--device cuda]
+import argparse
+import random
+import time
+import torch
+from torch.utils.data import DataLoader
+from dataset import BilingualDataset, PadCollate, causal_mask
+from benchmarks.common import SpecialTokens, random_model
+
+
+def make_rows(n, seq_len, vocab, seed=0):
+    # token cache style rows (ids already there) with sentence lengths spread over the whole range
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        src = [rnd.randrange(4, vocab) for _ in range(rnd.randint(3, seq_len - 2))]
+        tgt = [rnd.randrange(4, vocab) for _ in range(rnd.randint(3, seq_len - 1))]
+        rows.append({"translation": {"en": "", "it": ""}, "src_ids": src, "tgt_ids": tgt})
+    return rows
+
+
+class WithMasks(BilingualDataset):
+    # what BilingualDataset(pad=True) returned before --> masks materialized per sample
+    def __getitem__(self, idx):
+        item = super().__getitem__(idx)
+        encoder_input, decoder_input = item["encoder_input"], item["decoder_input"]
+        item["encoder_mask"] = (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int()
+        item["decoder_mask"] = (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0))
+        return item
+
+
+class PadCollateWithMasks(PadCollate):
+    # what PadCollate returned before --> masks built per batch on the host
+    def __call__(self, items):
+        batch = super().__call__(items)
+        batch["encoder_mask"] = (batch["encoder_input"] != self.pad_id).unsqueeze(1).unsqueeze(1).int()
+        batch["decoder_mask"] = (batch["decoder_input"] != self.pad_id).unsqueeze(1).unsqueeze(1).int() & causal_mask(batch["decoder_input"].size(1))
+        return batch
+
+
+def tensor_bytes(batch):
+    return sum(v.numel() * v.element_size() for v in batch.values() if torch.is_tensor(v))
+
+
+def run(loader, model, device, old: bool):
+    # one pass over the loader --> time spent in the DataLoader, in .to(device) and bytes moved per batch
+    t_load = t_move = 0.0
+    moved = 0
+    batches = 0
+    start = time.perf_counter()
+    for batch in loader:
+        t0 = time.perf_counter()
+        t_load += t0 - start
+        encoder_input = batch["encoder_input"].to(device)
+        decoder_input = batch["decoder_input"].to(device)
+        # results not kept, only the time of the transfers / the mask building counts
+        batch["label"].to(device)
+        if old:
+            batch["encoder_mask"].to(device)
+            batch["decoder_mask"].to(device)
+        else:
+            model.make_src_mask(encoder_input)
+            model.make_tgt_mask(decoder_input)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        t_move += start - t0
+        moved += tensor_bytes(batch)
+        batches += 1
+    return t_load, t_move, moved / batches
+
+
+def check_masks(model, loader_old):
+    batch = next(iter(loader_old))
+    src = model.make_src_mask(batch["encoder_input"])
+    tgt = model.make_tgt_mask(batch["decoder_input"])
+    old_tgt = batch["decoder_mask"]
+    if old_tgt.dim() == 3:
+        old_tgt = old_tgt.unsqueeze(1)  # fixed padding collates (batch,1,L,L) from per sample (1,L,L)
+    return bool((src == (batch["encoder_mask"] != 0)).all() and (tgt == (old_tgt != 0)).all())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=350)
+    parser.add_argument("--samples", type=int, default=512)
+    parser.add_argument("--vocab", type=int, default=1000)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    tok = SpecialTokens()
+    rows = make_rows(args.samples, args.seq_len, args.vocab)
+    model = random_model(args.vocab, seq_len=args.seq_len, d_model=64, N=1, h=2, d_ff=64).to(device)
+    pin = device.type == "cuda"
+
+    setups = {
+        "fixed padding": (lambda cls: cls(rows, tok, tok, "en", "it", args.seq_len), None),
+        "dynamic padding": (lambda cls: cls(rows, tok, tok, "en", "it", args.seq_len, pad=False), PadCollate),
+    }
+    print(f"{'setup':>16} {'masks':>6} {'batch (KB)':>11} {'loader (s)':>11} {'to device + masks (s)':>22}")
+    for name, (make_ds, collate) in setups.items():
+        for old in (True, False):
+            ds = make_ds(WithMasks if old else BilingualDataset)
+            collate_fn = None
+            if collate is not None:
+                collate_fn = (PadCollateWithMasks if old else PadCollate)(tok.token_to_id("[PAD]"))
+            loader = DataLoader(ds, batch_size=args.batch, collate_fn=collate_fn, num_workers=args.num_workers,
+                                pin_memory=pin)
+            if old:
+                assert check_masks(model.cpu(), loader), "model side masks differ from the materialized ones"
+                model.to(device)
+            t_load, t_move, per_batch = run(loader, model, device, old)
+            print(f"{name:>16} {'old' if old else 'new':>6} {per_batch / 1024:>11.1f} {t_load:>11.3f} {t_move:>22.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# fp32 vs bf16 (vs fp16 on cuda) autocast: training step + greedy decoding throughput, activation memory
+# and, with a trained checkpoint, BLEU of every mode on the same fixed subset of sentence pairs
+# memory--> bytes autograd saves for backward in one training forward (+ peak allocated on cuda)
+# usage --> python -m benchmarks.precision [--batch 16] [--seq_len 64]
+#           python -m benchmarks.precision --checkpoint weights/tmodel_best.pt [--pairs 200]  (run from the repo root)
+import argparse
+import time
+import torch
+from decoding import greedy_decode
+from precision import autocast
+from benchmarks.common import SpecialTokens, random_model, random_source, sample_pairs, timeit
+
+
+def saved_bytes(fn):
+    total = 0
+
+    def pack(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn()
+    return total
+
+
+def same_rows(a, b, pad_id):
+    # share of sentences decoded to exactly the same ids
+    width = max(a.size(1), b.size(1))
+    a = torch.nn.functional.pad(a, (0, width - a.size(1)), value=pad_id)
+    b = torch.nn.functional.pad(b, (0, width - b.size(1)), value=pad_id)
+    return (a == b).all(dim=1).float().mean().item()
+
+
+def bleu_report(args, modes):
+    # same pairs for every mode
+    import torchmetrics
+    from config import get_config
+    from translate import Translator
+
+    config = get_config()
+    translator = Translator(config, checkpoint=args.checkpoint, device=args.device)
+    sources, targets = sample_pairs(translator, args.pairs, args.seed)
+    reference = None
+    print(f"{'precision':>10} {'BLEU':>7} {'seconds':>9} {'same as fp32':>13}")
+    for mode in modes:
+        translator.precision = mode
+        start = time.perf_counter()
+        predicted = []
+        for i in range(0, len(sources), args.batch):
+            predicted.extend(translator.translate_batch(sources[i:i + args.batch]))
+        elapsed = time.perf_counter() - start
+        reference = reference or predicted
+        bleu = torchmetrics.BLEUScore()(predicted, targets).item()
+        same = sum(a == b for a, b in zip(predicted, reference)) / len(predicted)
+        print(f"{mode:>10} {bleu:>7.4f} {elapsed:>9.2f} {same:>13.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=64, help="source / target length of the training batch")
+    parser.add_argument("--max_len", type=int, default=40, help="greedy decoding length")
+    parser.add_argument("--checkpoint", default=None, help="trained weights --> BLEU per precision")
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    modes = ["fp32", "bf16"] + (["fp16"] if device.type == "cuda" else [])
+
+    if args.checkpoint:
+        bleu_report(args, modes)
+        return
+
+    tok = SpecialTokens()
+    model = random_model(args.vocab, seq_len=max(args.seq_len, args.max_len), d_model=args.d_model).to(device)
+    src, src_mask = random_source(args.batch, args.seq_len, args.vocab)
+    tgt, _ = random_source(args.batch, args.seq_len, args.vocab, seed=1)
+    src, src_mask, tgt = src.to(device), src_mask.to(device), tgt.to(device)
+    tgt_mask = model.make_tgt_mask(tgt)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    tokens = args.batch * args.seq_len
+
+    def forward():
+        out = model.project(model.decode(model.encode(src, src_mask), src_mask, tgt, tgt_mask))
+        return loss_fn(out.float().view(-1, args.vocab), tgt.view(-1))
+
+    with torch.no_grad():
+        reference = greedy_decode(model, src, src_mask, tok, tok, args.max_len, device)
+    print(f"{'precision':>10} {'train tok/s':>12} {'saved (MB)':>11} {'peak (MB)':>10} {'decode tok/s':>13} {'same as fp32':>13}")
+    for mode in modes:
+        def train_step():
+            model.zero_grad(set_to_none=True)
+            with autocast(mode, device):
+                loss = forward()
+            loss.backward()
+
+        def decode():
+            with torch.no_grad(), autocast(mode, device):
+                return greedy_decode(model, src, src_mask, tok, tok, args.max_len, device)
+
+        model.train()
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        t_train = timeit(train_step, repeat=3)
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == "cuda" else float("nan")
+        with autocast(mode, device):
+            saved = saved_bytes(forward) / 2 ** 20
+        model.eval()
+        t_decode = timeit(decode, repeat=3)
+        out = decode()
+        generated = int((out != tok.token_to_id("[PAD]")).sum()) - out.size(0)
+        same = same_rows(out, reference, tok.token_to_id("[PAD]"))
+        print(f"{mode:>10} {tokens / t_train:>12.0f} {saved:>11.1f} {peak:>10.1f} {generated / t_decode:>13.1f} {same:>13.1%}")
+
+
+if __name__ == "__main__":
+    main()
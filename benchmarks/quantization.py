@@ -0,0 +1,76 @@
+# float32 checkpoint vs its dynamic int8 export (quantize.py) on cpu: model size, per sentence latency, BLEU delta
+# usage --> python -m benchmarks.quantization --checkpoint weights/tmodel_best.pt [--quantized weights/int8_tmodel_best.pt]
+#           [--pairs 200] [--sources test.en --references test.it]   (run from the repo root)
+# without --quantized the checkpoint is quantized in memory, same as quantize.py does
+import argparse
+import io
+import time
+import torch
+import torchmetrics
+from config import get_config
+from model import quantize_dynamic_int8
+from translate import Translator
+from benchmarks.common import sample_pairs
+
+
+def state_size(model):
+    # serialized weights only (the training checkpoint also holds the optimizer state)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def evaluate(translator, sources, targets, batch, latency_sentences):
+    # per sentence latency--> one sentence per call, like an interactive request
+    start = time.perf_counter()
+    for sentence in sources[:latency_sentences]:
+        translator.translate(sentence)
+    latency = (time.perf_counter() - start) / min(latency_sentences, len(sources))
+    predicted = []
+    for i in range(0, len(sources), batch):
+        predicted.extend(translator.translate_batch(sources[i:i + batch]))
+    bleu = torchmetrics.BLEUScore()(predicted, targets).item()
+    return latency, bleu, predicted
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", required=True, help="float32 training checkpoint")
+    parser.add_argument("--quantized", default=None, help="int8 export of that checkpoint (quantize.py)")
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--latency_sentences", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--sources", default=None, help="held out source sentences, one per line")
+    parser.add_argument("--references", default=None, help="reference translations of --sources")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    config = get_config()
+    fp32 = Translator(config, checkpoint=args.checkpoint, device="cpu")
+    if args.quantized:
+        int8 = Translator(config, checkpoint=args.quantized, device="cpu")
+    else:
+        int8 = Translator(config, checkpoint=args.checkpoint, device="cpu")
+        int8.model = quantize_dynamic_int8(int8.model)
+    sources, targets = sample_pairs(fp32, args.pairs, args.seed, args.sources, args.references)
+
+    results = {}
+    for name, translator in (("fp32", fp32), ("int8", int8)):
+        with torch.no_grad():
+            latency, bleu, predicted = evaluate(translator, sources, targets, args.batch, args.latency_sentences)
+        results[name] = (state_size(translator.model), latency, bleu, predicted)
+
+    same = sum(a == b for a, b in zip(results["fp32"][3], results["int8"][3])) / len(sources)
+    print(f"{'model':>6} {'size (MB)':>10} {'ms / sentence':>14} {'BLEU':>7}")
+    for name, (size, latency, bleu, _) in results.items():
+        print(f"{name:>6} {size / 2 ** 20:>10.1f} {latency * 1000:>14.1f} {bleu:>7.4f}")
+    (size32, lat32, bleu32, _), (size8, lat8, bleu8, _) = results["fp32"], results["int8"]
+    print(f"size {size32 / size8:.2f}x smaller, latency {lat32 / lat8:.2f}x faster, "
+          f"BLEU delta {bleu8 - bleu32:+.4f}, identical translations {same:.1%} ({len(sources)} sentences)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# separate vocabularies vs one joint vocabulary with tied src embedding / tgt embedding / projection (shared_vocab)
+#   parameters (each shared tensor counted once), checkpoint size (model + Adam state, written by CheckpointWriter
+#   like train_model does), projection weight read per
+#   generated token, train step (forward + backward + Adam) and one decode step time
+# the joint vocabulary is usually bigger than the target one (union of both languages) --> tying saves parameters,
+# optimizer state and checkpoint bytes, but the projection itself gets wider. Pass the real sizes of the trained
+# tokenizers (get_vocab_size() of tokenizer_en.json / tokenizer_it.json / tokenizer_en-it.json), the defaults are
+# word level opus_books en-it sizes (min_frequency=2) and an estimate of their union
+# usage --> python -m benchmarks.shared_vocab [--src_vocab 15700] [--tgt_vocab 22500] [--joint_vocab 30000]
+import argparse
+import os
+import tempfile
+
+import torch
+
+from checkpoints import CheckpointWriter
+from config import get_config, get_weights_file_path
+from model import build_transformer
+from benchmarks.common import SpecialTokens, random_source, timeit
+
+
+def build(args, src_vocab, tgt_vocab, tie):
+    torch.manual_seed(0)
+    pad_id = SpecialTokens.ids["[PAD]"]
+    return build_transformer(src_vocab, tgt_vocab, args.seq_len, args.seq_len, d_model=args.d_model, N=args.N,
+                             d_ff=args.d_ff, src_pad_id=pad_id, tgt_pad_id=pad_id, tie_weights=tie)
+
+
+def measure(args, src_vocab, tgt_vocab, tie):
+    model = build(args, src_vocab, tgt_vocab, tie).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=SpecialTokens.ids["[PAD]"])
+    src, _ = random_source(args.batch, args.length, src_vocab)
+    tgt, _ = random_source(args.batch, args.length, tgt_vocab, seed=1)
+    src_mask, tgt_mask = model.make_src_mask(src), model.make_tgt_mask(tgt)
+
+    def step():
+        torch.manual_seed(0)
+        out = model(src, src_mask, tgt, tgt_mask)
+        loss_fn(out.view(-1, tgt_vocab), tgt.view(-1)).backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    train = timeit(step, repeat=args.repeat)  # warmup step allocates the Adam moments
+    # the real save path (cpu snapshot + atomic_save) --> tied weights must stay one tensor on disk
+    sizes = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        config = get_config()
+        config['data_source'] = os.path.join(tmp, "bench")
+        writer = CheckpointWriter(config, keep_last=0)
+        writer.save({'model_state_dict': model.state_dict()}, 0)
+        writer.save({'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict()}, 1)
+        writer.close()
+        for epoch in (0, 1):
+            sizes[epoch] = os.path.getsize(get_weights_file_path(config, f"{epoch:02d}")) / 2 ** 20
+
+    # one new token per sentence through the projection, what every decode step pays
+    model.eval()
+    hidden = torch.randn(args.batch, 1, args.d_model)
+    with torch.no_grad():
+        project = timeit(lambda: [model.project(hidden) for _ in range(10)], repeat=args.repeat) / 10
+    return {
+        "params": sum(p.numel() for p in model.parameters()),
+        "weights_mb": sizes[0],
+        "checkpoint_mb": sizes[1],
+        "project_mb": model.projection_layer.proj.weight.numel() * 4 / 2 ** 20,
+        "train_ms": train * 1000,
+        "project_ms": project * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src_vocab", type=int, default=15700)
+    parser.add_argument("--tgt_vocab", type=int, default=22500)
+    parser.add_argument("--joint_vocab", type=int, default=30000)
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--N", type=int, default=6)
+    parser.add_argument("--d_ff", type=int, default=2048)
+    parser.add_argument("--seq_len", type=int, default=350)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--length", type=int, default=32, help="tokens per sentence of the train step")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    runs = {
+        f"separate ({args.src_vocab} + {args.tgt_vocab})": measure(args, args.src_vocab, args.tgt_vocab, False),
+        f"tied joint ({args.joint_vocab})": measure(args, args.joint_vocab, args.joint_vocab, True),
+        # same target vocabulary as the separate run --> the saving of tying alone, without the wider projection
+        f"tied ({args.tgt_vocab}, lower bound)": measure(args, args.tgt_vocab, args.tgt_vocab, True),
+    }
+    print(f"{'':<30} {'params':>12} {'weights MB':>11} {'+Adam MB':>9} {'proj MB':>8} {'train ms':>9} {'project ms':>11}")
+    base = None
+    for name, r in runs.items():
+        print(f"{name:<30} {r['params']:>12,} {r['weights_mb']:>11.1f} {r['checkpoint_mb']:>9.1f} {r['project_mb']:>8.1f} "
+              f"{r['train_ms']:>9.0f} {r['project_ms']:>11.3f}")
+        if base is None:
+            base = r
+        else:
+            print(f"{'  vs separate':<30} {r['params'] / base['params'] - 1:>+12.1%} "
+                  f"{r['weights_mb'] / base['weights_mb'] - 1:>+11.1%} {r['checkpoint_mb'] / base['checkpoint_mb'] - 1:>+9.1%} "
+                  f"{r['project_mb'] / base['project_mb'] - 1:>+8.1%} {r['train_ms'] / base['train_ms'] - 1:>+9.1%} "
+                  f"{r['project_ms'] / base['project_ms'] - 1:>+11.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# cold start of inference: fresh python process --> first translated sentence
+#   train path--> what inference.py did before: train_es_lr imports + get_ds (tokenizers, dataset / token cache,
+#                 splits, padding report) + get_model + torch.load of the training checkpoint, then a Translator
+#   bundle--> Translator(checkpoint=<bundle.py export>), tokenizers and hyperparameters come from the file
+#   best of --repeat runs (warm os file cache), heavy modules = training only imports found in sys.modules
+# usage --> python -m benchmarks.startup [--checkpoint tmodel_best.pt] [--bundle bundle.pt] [--repeat 3]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from config import get_config, get_weights_file_path
+
+HEAVY = ("datasets", "torchmetrics", "torch.utils.tensorboard", "tqdm")
+
+TRAIN_PATH = """
+import json, sys, time
+start = time.perf_counter()
+import torch
+from config import get_config
+from train_es_lr import get_ds, get_model
+from translate import Translator
+imported = time.perf_counter()
+config = get_config()
+_, _, tokenizer_src, tokenizer_tgt = get_ds(config)
+model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size(),
+                  tokenizer_src.token_to_id('[PAD]'), tokenizer_tgt.token_to_id('[PAD]'))
+model.load_state_dict(torch.load(sys.argv[1], map_location="cpu")['model_state_dict'])
+translator = Translator(config, checkpoint=sys.argv[1], device="cpu")
+ready = time.perf_counter()
+"""
+
+BUNDLE_PATH = """
+import json, sys, time
+start = time.perf_counter()
+from translate import Translator
+imported = time.perf_counter()
+translator = Translator(checkpoint=sys.argv[1], device="cpu")
+ready = time.perf_counter()
+"""
+
+REPORT = """
+translator.translate("I am not a very good student.")
+done = time.perf_counter()
+heavy = [m for m in HEAVY if m in sys.modules]
+print(json.dumps({"import": imported - start, "ready": ready - start, "first": done - start, "heavy": heavy}))
+"""
+
+
+def run(code, path, repeat):
+    script = f"HEAVY = {HEAVY!r}\n" + code + REPORT
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script, path], capture_output=True, text=True, check=True,
+                             env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return min(runs, key=lambda r: r["first"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", default=None, help="training checkpoint, default: best of get_weights_file_path")
+    parser.add_argument("--bundle", default=None, help="bundle.py export, default: exported from --checkpoint")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    config = get_config()
+    checkpoint = args.checkpoint or get_weights_file_path(config, "best")
+    with tempfile.TemporaryDirectory() as tmp:
+        bundle = args.bundle
+        if bundle is None:
+            from bundle import export_bundle
+            bundle = os.path.join(tmp, "bundle.pt")
+            export_bundle(config, checkpoint, bundle)
+        print(f"checkpoint {os.path.getsize(checkpoint) / 2 ** 20:.0f} MB, bundle {os.path.getsize(bundle) / 2 ** 20:.0f} MB")
+        print(f"{'':>8} {'imports (s)':>12} {'ready (s)':>10} {'first (s)':>10}  training imports")
+        for name, code, path in (("train", TRAIN_PATH, checkpoint), ("bundle", BUNDLE_PATH, bundle)):
+            r = run(code, path, args.repeat)
+            print(f"{name:>8} {r['import']:>12.2f} {r['ready']:>10.2f} {r['first']:>10.2f}  {', '.join(r['heavy']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
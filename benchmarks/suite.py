@@ -0,0 +1,295 @@
+# reproducible CPU benchmark suite, small randomly initialized models --> runs offline, no dataset / checkpoint
+#   micro--> MultiHeadAttentionBlock (sdpa / math), LayerNormalization, FeedForwardBlock
+#   macro--> Transformer.encode, one cached decode step, greedy_decode end to end at several source lengths
+#   data--> BilingualDataset.__getitem__ (tokenizing the text / token cache rows with ids)
+#   train--> forward + backward + Adam step at several batch sizes
+# fixed seeds and inputs, --threads torch threads (default 1), every case timed `repeat` x `number` calls
+# results (ms per call, min / median over the repeats) + environment metadata --> JSON
+# usage:
+#   python -m benchmarks.suite run -o results.json [--filter decode] [--quick]
+#   python -m benchmarks.suite compare results.json [--baseline other.json] [--threshold 0.10]  (exit code 1 on a regression)
+# benchmarks/baseline.json--> stored baseline (default settings, 1 thread), refresh it with `run -o benchmarks/baseline.json`
+# on the machine the comparisons run on, timings of other cpus are not comparable
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from dataset import BilingualDataset
+from decoding import greedy_decode
+from model import MultiHeadAttentionBlock, LayerNormalization, FeedForwardBlock
+from benchmarks.common import SpecialTokens, random_model, random_source
+
+CASES = []
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def case(name):
+    # registers a benchmark: fn(args) --> zero argument callable that is timed
+    def register(fn):
+        CASES.append((name, fn))
+        return fn
+    return register
+
+
+def measure(fn, repeat: int, number: int, warmup: int = 1):
+    for _ in range(warmup):
+        fn()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - start) / number * 1000)
+    return {"min_ms": min(runs), "median_ms": statistics.median(runs), "repeat": repeat, "number": number}
+
+
+def hidden(args, batch: int = 8, length: int = None, seed: int = 0):
+    g = torch.Generator().manual_seed(seed)
+    return torch.randn(batch, length or args.seq_len, args.d_model, generator=g)
+
+
+def model(args):
+    return random_model(args.vocab, seq_len=args.max_len, d_model=args.d_model, N=args.N, h=args.h, d_ff=args.d_ff)
+
+
+def no_grad(fn):
+    def run():
+        with torch.no_grad():
+            return fn()
+    return run
+
+
+for backend in ("sdpa", "math"):
+    @case(f"micro/attention_{backend}")
+    def _(args, backend=backend):
+        torch.manual_seed(0)
+        block = MultiHeadAttentionBlock(args.d_model, args.h, 0.0, backend).eval()
+        x = hidden(args)
+        mask = torch.ones(x.size(0), 1, 1, x.size(1), dtype=torch.bool)
+        return no_grad(lambda: block(x, x, x, mask))
+
+
+@case("micro/layer_norm")
+def _(args):
+    norm = LayerNormalization(args.d_model)
+    x = hidden(args)
+    return no_grad(lambda: norm(x))
+
+
+@case("micro/feed_forward")
+def _(args):
+    torch.manual_seed(0)
+    block = FeedForwardBlock(args.d_model, args.d_ff, 0.0).eval()
+    x = hidden(args)
+    return no_grad(lambda: block(x))
+
+
+@case("macro/encode")
+def _(args):
+    m = model(args)
+    src, _ = random_source(8, args.seq_len, args.vocab)
+    src_mask = m.make_src_mask(src)
+    return no_grad(lambda: m.encode(src, src_mask))
+
+
+@case("macro/decode_step")
+def _(args):
+    # one new token on top of a cached history of seq_len tokens (cache restored before every call)
+    m = model(args)
+    src, _ = random_source(8, args.seq_len, args.vocab)
+    tgt, _ = random_source(8, args.seq_len + 1, args.vocab, seed=1)
+    src_mask = m.make_src_mask(src)
+    with torch.no_grad():
+        enc = m.encode(src, src_mask)
+        cache = m.prepare_memory(enc)
+        m.decode(enc, src_mask, tgt[:, :-1], None, cache)
+    snapshot = [(c.key, c.value) for c in cache.self_attn]
+    length = cache.length
+
+    def step():
+        for c, (k, v) in zip(cache.self_attn, snapshot):
+            c.key, c.value = k, v
+        cache.length = length
+        m.project(m.decode(enc, src_mask, tgt[:, -1:], None, cache)[:, -1])
+    return no_grad(step)
+
+
+for src_len in (8, 32, 128):
+    @case(f"macro/greedy_decode_src{src_len}")
+    def _(args, src_len=src_len):
+        # [EOS] logit pushed down --> every call decodes exactly decode_len tokens
+        m = model(args)
+        with torch.no_grad():
+            m.projection_layer.proj.bias[SpecialTokens.ids["[EOS]"]] = -1e4
+        src, _ = random_source(4, src_len, args.vocab)
+        src_mask = m.make_src_mask(src)
+        tokens = SpecialTokens()
+        return no_grad(lambda: greedy_decode(m, src, src_mask, tokens, tokens, args.decode_len, "cpu"))
+
+
+def toy_tokenizer(vocab: int):
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Whitespace
+    words = {t: i for t, i in SpecialTokens.ids.items()}
+    words.update({f"w{i}": i + len(words) for i in range(vocab)})
+    tokenizer = Tokenizer(WordLevel(words, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    return tokenizer
+
+
+def toy_rows(args, n: int = 256, with_ids: bool = False):
+    rng = np.random.default_rng(0)
+    tokenizer = toy_tokenizer(args.vocab)
+    rows = []
+    for _ in range(n):
+        row = {"translation": {side: " ".join(f"w{i}" for i in rng.integers(0, args.vocab, rng.integers(5, args.seq_len)))
+                               for side in ("en", "it")}}
+        if with_ids:
+            row["src_ids"] = tokenizer.encode(row["translation"]["en"]).ids
+            row["tgt_ids"] = tokenizer.encode(row["translation"]["it"]).ids
+        rows.append(row)
+    return rows, tokenizer
+
+
+for with_ids in (False, True):
+    @case(f"data/bilingual_getitem_{'ids' if with_ids else 'text'}")
+    def _(args, with_ids=with_ids):
+        # 256 items per call, fixed padding to max_len
+        rows, tokenizer = toy_rows(args, with_ids=with_ids)
+        ds = BilingualDataset(rows, tokenizer, tokenizer, "en", "it", args.max_len)
+        return lambda: [ds[i] for i in range(len(ds))]
+
+
+for batch in (4, 16, 32):
+    @case(f"train/step_b{batch}")
+    def _(args, batch=batch):
+        m = model(args).train()
+        optimizer = torch.optim.Adam(m.parameters(), lr=1e-4)
+        loss_fn = torch.nn.CrossEntropyLoss(ignore_index=SpecialTokens.ids["[PAD]"])
+        src, _ = random_source(batch, args.seq_len, args.vocab)
+        tgt, _ = random_source(batch, args.seq_len, args.vocab, seed=1)
+        src_mask, tgt_mask = m.make_src_mask(src), m.make_tgt_mask(tgt)
+
+        def step():
+            torch.manual_seed(0)  # same dropout masks every call
+            out = m(src, src_mask, tgt, tgt_mask)
+            loss_fn(out.view(-1, args.vocab), tgt.view(-1)).backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        return step
+
+
+def environment(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit or None,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "mkldnn": torch.backends.mkldnn.is_available(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("command", "output", "filter")},
+    }
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    if args.quick:
+        args.repeat, args.number = 3, 1
+    results = {}
+    for name, make in CASES:
+        if args.filter and not re.search(args.filter, name):
+            continue
+        fn = make(args)
+        # slow cases (decode end to end, training steps, 256 dataset items) run once per repeat
+        number = 1 if name.split("/")[0] in ("train", "data") or "greedy" in name else args.number
+        results[name] = measure(fn, args.repeat, number)
+        print(f"{name:<34} {results[name]['median_ms']:9.3f} ms (min {results[name]['min_ms']:.3f})", file=sys.stderr)
+    report = {"environment": environment(args), "results": results}
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"results written to {args.output}", file=sys.stderr)
+
+
+def compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    base_env, env = baseline["environment"], current["environment"]
+    for key in ("processor", "cpu_count", "torch_threads", "torch", "config"):
+        if base_env.get(key) != env.get(key):
+            print(f"warning: {key} differs ({base_env.get(key)} vs {env.get(key)}), timings are not comparable")
+
+    regressions = 0
+    print(f"{'case':<34} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:<34} {'-':>10} {result[args.metric]:>10.3f}      new")
+            continue
+        old, new = baseline["results"][name][args.metric], result[args.metric]
+        change = new / old - 1
+        flag = ""
+        if change > args.threshold:
+            flag, regressions = "  REGRESSION", regressions + 1
+        elif change < -args.threshold:
+            flag = "  faster"
+        print(f"{name:<34} {old:>10.3f} {new:>10.3f} {change:>+7.1%}{flag}")
+    print(f"{regressions} regression(s) above {args.threshold:.0%} ({args.metric})")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    r = sub.add_parser("run", help="run the benchmarks, JSON results")
+    r.add_argument("-o", "--output", default="-", help="JSON file, - for stdout")
+    r.add_argument("--filter", default=None, help="regex on the case names, e.g. '^micro/'")
+    r.add_argument("--quick", action="store_true", help="3 repeats x 1 call per case (smoke test, noisy)")
+    r.add_argument("--repeat", type=int, default=7)
+    r.add_argument("--number", type=int, default=10, help="calls per repeat of the fast cases")
+    r.add_argument("--threads", type=int, default=1)
+    r.add_argument("--d_model", type=int, default=128)
+    r.add_argument("--N", type=int, default=2)
+    r.add_argument("--h", type=int, default=4)
+    r.add_argument("--d_ff", type=int, default=512)
+    r.add_argument("--vocab", type=int, default=2000)
+    r.add_argument("--seq_len", type=int, default=64, help="sentence length of the micro / encode / train cases")
+    r.add_argument("--max_len", type=int, default=160, help="model seq_len (positional encodings, dataset padding)")
+    r.add_argument("--decode_len", type=int, default=32, help="tokens generated by the greedy_decode cases")
+    c = sub.add_parser("compare", help="flag regressions of a results file against a baseline")
+    c.add_argument("current", help="results of `run`")
+    c.add_argument("--baseline", default=BASELINE)
+    c.add_argument("--threshold", type=float, default=0.10, help="relative slowdown counted as a regression")
+    c.add_argument("--metric", choices=["median_ms", "min_ms"], default="median_ms")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
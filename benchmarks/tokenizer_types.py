@@ -0,0 +1,129 @@
+# word level vs bpe vs unigram tokenizers (config tokenizer_type / vocab_size) on the same corpus
+#   tokenizers trained on 90% of the sentences (train_tokenizer, streamed like get_or_build_tokenizer), the rest held out:
+#   vocab size, tokens per sentence, [UNK] share and exact detokenize round trips of the held out targets,
+#   projection GFLOPs per target sentence (2 * d_model * vocab per token) and training throughput
+#   (forward + backward + Adam on length bucketed batches of real sentences) --> sentences/s is the comparable number,
+#   subword sentences are longer but every token costs a smaller softmax
+# corpus--> the config dataset (load_dataset, needs the HF cache / network) or --jsonl in the evaluation.py test set format
+# usage --> python -m benchmarks.tokenizer_types [--jsonl pairs.jsonl] [--limit 20000] [--vocab_size 8000 16000]
+# results, --jsonl of 20000 synthetic en-it pairs (zipf distributed stems + inflection suffixes + punctuation,
+# 4-24 words, the HF hub was not reachable), 18000 train / 2000 held out, d_model 512, N 6, batch 16, 1 cpu thread:
+#   tokenizer     vocab src/tgt  src len  tgt len  tgt p95   UNK  exact  proj GFLOP  sent/s  tok/s
+#   wordlevel      9814/10622      15.9     15.9      26   3.8%  53.2%     0.184     11.3    188
+#   bpe8000        8000/8000       15.4     15.7      26   0.0% 100.0%     0.137     11.4    189
+#   bpe16000      13581/14972      14.8     15.0      25   0.0% 100.0%     0.245      9.6    148
+#   unigram8000    7749/8000       17.0     17.5      29   0.0% 100.0%     0.152      9.0    161
+#   unigram16000   9843/11391      17.0     17.2      28   0.0% 100.0%     0.212      8.8    156
+#   bpe8000--> word level lengths without [UNK], -25% projection cost, every held out reference round trips exactly
+#   (word level 53%: [UNK] words + the punctuation cleanup). The projection follows vocab_size, not the tokenizer type:
+#   16000 is wider than word level on this corpus. sent/s over 8 steps is noisy (bpe16000 gave 10.9 in another run),
+#   rerun on the config dataset (no --jsonl) for the real numbers
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+
+from config import get_config
+from dataset import BilingualDataset, PadCollate, LengthBucketSampler
+from evaluation import read_test_set
+from model import build_transformer
+from train_es_lr import train_tokenizer
+from translate import detokenize
+
+
+def load_rows(config, args):
+    if args.jsonl:
+        rows = read_test_set(args.jsonl, config['lang_src'], config['lang_tgt'])
+    else:
+        from datasets import load_dataset
+        ds = load_dataset(config['data_source'], f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+        rows = [ds[i] for i in range(min(len(ds), args.limit))]
+    rows = rows[:args.limit]
+    random.Random(0).shuffle(rows)
+    return rows
+
+
+def train_throughput(args, config, tok_src, tok_tgt, rows):
+    # same sentences and batch size for every tokenizer, sentences truncated to seq_len like in training
+    torch.manual_seed(0)
+    pad_id = tok_tgt.token_to_id('[PAD]')
+    model = build_transformer(tok_src.get_vocab_size(), tok_tgt.get_vocab_size(), args.seq_len, args.seq_len,
+                              d_model=args.d_model, N=args.N, src_pad_id=tok_src.token_to_id('[PAD]'),
+                              tgt_pad_id=pad_id).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=pad_id)
+    ds = BilingualDataset(rows, tok_src, tok_tgt, config['lang_src'], config['lang_tgt'], args.seq_len, pad=False)
+    lengths = [max(len(ds[i]["encoder_input"]), len(ds[i]["decoder_input"])) for i in range(len(ds))]
+    sampler = LengthBucketSampler(lengths, batch_size=args.batch_size, seed=0)
+    loader = torch.utils.data.DataLoader(ds, batch_sampler=sampler, collate_fn=PadCollate(pad_id))
+    sentences = tokens = 0
+    elapsed = 0.0
+    for step, batch in enumerate(loader):
+        if step > args.steps:
+            break
+        start = time.perf_counter()
+        encoder_input, decoder_input, label = batch['encoder_input'], batch['decoder_input'], batch['label']
+        out = model(encoder_input, model.make_src_mask(encoder_input), decoder_input, model.make_tgt_mask(decoder_input))
+        loss_fn(out.view(-1, out.shape[-1]), label.view(-1)).backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if step > 0:  # first step allocates the Adam moments
+            elapsed += time.perf_counter() - start
+            sentences += label.size(0)
+            tokens += int((label != pad_id).sum())
+    return sentences / elapsed, tokens / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jsonl", default=None, help="source / reference pairs instead of the config dataset")
+    parser.add_argument("--limit", type=int, default=20000, help="sentences used (train + held out)")
+    parser.add_argument("--vocab_size", type=int, nargs="+", default=[8000, 16000], help="bpe / unigram vocab sizes")
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--N", type=int, default=6)
+    parser.add_argument("--seq_len", type=int, default=350)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=8, help="timed training steps per tokenizer")
+    args = parser.parse_args()
+
+    config = get_config()
+    lang_src, lang_tgt = config['lang_src'], config['lang_tgt']
+    rows = load_rows(config, args)
+    split = int(0.9 * len(rows))
+    train_rows, held_out = rows[:split], rows[split:]
+    references = [r["translation"][lang_tgt] for r in held_out]
+    print(f"{len(train_rows)} training / {len(held_out)} held out sentences, d_model {args.d_model}, N {args.N}, "
+          f"batch {args.batch_size}, {torch.get_num_threads()} thread(s)")
+
+    runs = [("wordlevel", None)] + [(kind, v) for kind in ("bpe", "unigram") for v in args.vocab_size]
+    print(f"{'tokenizer':<15} {'vocab src/tgt':>13} {'train s':>8} {'src len':>8} {'tgt len':>8} {'tgt p95':>8} "
+          f"{'UNK':>6} {'exact':>6} {'proj GFLOP':>10} {'sent/s':>7} {'tok/s':>7}")
+    for kind, vocab_size in runs:
+        config.update(tokenizer_type=kind, vocab_size=vocab_size)
+        start = time.perf_counter()
+        tok_src = train_tokenizer(config, train_rows, [lang_src])
+        tok_tgt = train_tokenizer(config, train_rows, [lang_tgt])
+        train_s = time.perf_counter() - start
+
+        src_len = np.array([len(e.ids) for e in tok_src.encode_batch([r["translation"][lang_src] for r in held_out])])
+        tgt_ids = [e.ids for e in tok_tgt.encode_batch(references)]
+        tgt_len = np.array([len(ids) for ids in tgt_ids])
+        unk_id, sos_id, eos_id = (tok_tgt.token_to_id(t) for t in ("[UNK]", "[SOS]", "[EOS]"))
+        unk = sum(ids.count(unk_id) for ids in tgt_ids) / max(tgt_len.sum(), 1)
+        # what translate / serve / evaluation return for a perfect prediction
+        exact = np.mean([detokenize(tok_tgt, [sos_id] + ids + [eos_id], eos_id) == ref
+                         for ids, ref in zip(tgt_ids, references)])
+        # logits of every target position + [EOS]
+        proj_gflop = 2 * args.d_model * tok_tgt.get_vocab_size() * (tgt_len.mean() + 1) / 1e9
+        sent_s, tok_s = train_throughput(args, config, tok_src, tok_tgt, train_rows)
+
+        name = kind if vocab_size is None else f"{kind}{vocab_size}"
+        print(f"{name:<15} {tok_src.get_vocab_size():>6}/{tok_tgt.get_vocab_size():<6} {train_s:>8.1f} "
+              f"{src_len.mean():>8.1f} {tgt_len.mean():>8.1f} {np.percentile(tgt_len, 95):>8.0f} {unk:>6.1%} "
+              f"{exact:>6.1%} {proj_gflop:>10.3f} {sent_s:>7.1f} {tok_s:>7.0f}")
+
+
+if __name__ == "__main__":
+    main()
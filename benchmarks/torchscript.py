@@ -0,0 +1,63 @@
+# eager Transformer vs the TorchScript export (export_torchscript.py) on CPU: output parity + greedy decoding latency
+# usage --> python -m benchmarks.torchscript [--batch_sizes 1 4 16] [--d_model 512] [--threads 1]
+import argparse
+import os
+import tempfile
+import torch
+from decoding import greedy_decode
+from export_torchscript import trace
+from scripted import ScriptedTransformer
+from benchmarks.common import SpecialTokens, random_model, random_source, timeit
+
+
+def padded_source(batch, length, vocab, pad_id):
+    # rows of different lengths --> the exported masks / cross attention see padding too
+    src, _ = random_source(batch, length, vocab)
+    lengths = torch.linspace(length // 2, length, batch).long()
+    return src.masked_fill(torch.arange(length).unsqueeze(0) >= lengths.unsqueeze(1), pad_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--N", type=int, default=6)
+    parser.add_argument("--vocab", type=int, default=8000)
+    parser.add_argument("--src_len", type=int, default=20)
+    parser.add_argument("--max_len", type=int, default=40)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    tok = SpecialTokens()
+    pad_id = tok.token_to_id("[PAD]")
+    model = random_model(args.vocab, d_model=args.d_model, N=args.N)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "model_ts.pt")
+        trace(model, path)
+        scripted = ScriptedTransformer(path)
+
+    with torch.no_grad():
+        src = padded_source(8, args.src_len, args.vocab, pad_id)
+        src_mask = model.make_src_mask(src)
+        diff = (model.encode(src, src_mask) - scripted.encode(src, src_mask)).abs().max().item()
+        eager_out = greedy_decode(model, src, src_mask, tok, tok, args.max_len, "cpu")
+        scripted_out = greedy_decode(scripted, src, src_mask, tok, tok, args.max_len, "cpu")
+    same = eager_out.shape == scripted_out.shape and torch.equal(eager_out, scripted_out)
+    print(f"parity: encoder max abs diff {diff:.2e}, greedy outputs identical: {same}")
+    assert diff < 1e-4 and same, "TorchScript export does not match the eager model"
+
+    print(f"{'batch':>6} {'eager (ms)':>11} {'scripted (ms)':>14} {'speedup':>8}")
+    for batch in args.batch_sizes:
+        src = padded_source(batch, args.src_len, args.vocab, pad_id)
+        src_mask = model.make_src_mask(src)
+        with torch.no_grad():
+            # greedy decoding of max_len tokens with the same early stopping for both
+            t_eager = timeit(lambda: greedy_decode(model, src, src_mask, tok, tok, args.max_len, "cpu")) * 1000
+            t_scripted = timeit(lambda: greedy_decode(scripted, src, src_mask, tok, tok, args.max_len, "cpu")) * 1000
+        print(f"{batch:>6} {t_eager:>11.1f} {t_scripted:>14.1f} {t_eager / t_scripted:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
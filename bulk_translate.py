@@ -0,0 +1,105 @@
+
+# bulk translation of a text / jsonl file or stdin with one model load
+# Usage:
+#   python bulk_translate.py corpus.txt -o corpus.it.txt
+#   python bulk_translate.py corpus.jsonl --field text -o out.jsonl      (adds a "translation" field to every object)
+#   cat corpus.txt | python bulk_translate.py - > out.txt
+# sentences are read in windows of --window lines, sorted by tokenized length inside the window and translated in
+# micro batches --> memory stays bounded by the window whatever the input size, output is written in input order
+import argparse
+import json
+import sys
+import time
+from itertools import islice
+
+from translate import Translator
+
+
+def read_records(stream, fmt, field):
+    # yields (record, sentence), record is what gets written back with the translation
+    for line in stream:
+        line = line.rstrip("\n")
+        if fmt == "jsonl":
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record, record[field]
+        else:
+            yield line, line
+
+
+def micro_batches(order, lengths, batch_size, max_tokens):
+    # consecutive slices of the length sorted window, capped by sentences and (optionally) tokens
+    # order is sorted by length --> the sentence being added is always the longest of its batch
+    batch = []
+    for i in order:
+        if batch and (len(batch) >= batch_size or (max_tokens and (len(batch) + 1) * lengths[i] > max_tokens)):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def translate_window(translator, sentences, batch_size, max_tokens):
+    lengths = [len(enc.ids) for enc in translator.tok_src.encode_batch(sentences)]
+    order = sorted(range(len(sentences)), key=lambda i: lengths[i])
+    results = [""] * len(sentences)
+    for batch in micro_batches(order, lengths, batch_size, max_tokens):
+        todo = [i for i in batch if sentences[i].strip()]  # empty lines stay empty
+        for i, text in zip(todo, translator.translate_batch([sentences[i] for i in todo])):
+            results[i] = text
+    return results, sum(lengths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bulk translation with micro batching")
+    parser.add_argument("input", help="text / jsonl file, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="output file, - for stdout")
+    parser.add_argument("--format", choices=["text", "jsonl"], default=None, help="default: from the file extension")
+    parser.add_argument("--field", default="text", help="jsonl field holding the source sentence")
+    parser.add_argument("--batch_size", type=int, default=32, help="max sentences per micro batch")
+    parser.add_argument("--max_tokens", type=int, default=None, help="max batch size * longest sentence per micro batch")
+    parser.add_argument("--window", type=int, default=2048, help="sentences read (and length sorted) at a time")
+    parser.add_argument("--checkpoint", default=None, help="default: latest checkpoint of the config")
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+    fmt = args.format or ("jsonl" if args.input.endswith((".jsonl", ".json")) else "text")
+
+    translator = Translator(checkpoint=args.checkpoint, device=args.device)
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+
+    start = time.perf_counter()
+    n_sentences = n_src_tokens = n_tgt_tokens = 0
+    records = read_records(src, fmt, args.field)
+    try:
+        while True:
+            window = list(islice(records, args.window))
+            if not window:
+                break
+            sentences = [sentence for _, sentence in window]
+            results, src_tokens = translate_window(translator, sentences, args.batch_size, args.max_tokens)
+            for (record, _), text in zip(window, results):
+                if fmt == "jsonl":
+                    dst.write(json.dumps({**record, "translation": text}, ensure_ascii=False) + "\n")
+                else:
+                    dst.write(text + "\n")
+            dst.flush()
+            n_sentences += len(window)
+            n_src_tokens += src_tokens
+            n_tgt_tokens += sum(len(enc.ids) for enc in translator.tok_tgt.encode_batch(results))
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"translated {n_sentences} sentences in {elapsed:.1f}s --> {n_sentences / elapsed:.2f} sentences/sec, "
+          f"{n_src_tokens / elapsed:.1f} source tokens/sec, {n_tgt_tokens / elapsed:.1f} target tokens/sec",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+
+# self contained inference bundle: weights (no optimizer state) + model hyperparameters + both tokenizers in one file
+# Usage:
+#   python bundle.py                                     (best checkpoint --> bundle_tmodel_best.pt in the model folder)
+#   python bundle.py --checkpoint some.pt --out some_bundle.pt
+# the bundle loads like any checkpoint --> Translator(checkpoint=...), inference.py / bulk_translate.py / serve.py
+# --checkpoint, without tokenizer files, dataset, token cache or the training imports
+# int8 checkpoints (quantize.py) stay int8, cold start time --> python -m benchmarks.startup
+import argparse
+import torch
+
+from config import get_config, get_weights_file_path, get_bundle_file_path
+from checkpoints import load_checkpoint
+from translate import Translator
+
+
+def model_hparams(model):
+    # build_transformer arguments of a built model (dropout left out, inference only)
+    encoder_block = model.encoder.layers[0]
+    return {
+        "src_vocab_size": model.src_embd.vocab_size,
+        "tgt_vocab_size": model.tgt_embd.vocab_size,
+        "src_seq_len": model.src_pos.seq_len,
+        "tgt_seq_len": model.tgt_pos.seq_len,
+        "d_model": model.src_embd.d_model,
+        "N": len(model.encoder.layers),
+        "h": encoder_block.self_attention_block.h,
+        "d_ff": encoder_block.feed_forward_block.linear_1.out_features,
+        "src_pad_id": model.src_pad_id,
+        "tgt_pad_id": model.tgt_pad_id,
+        # checked on the embeddings, the projection of an int8 model is a quantized copy
+        "tie_weights": model.tgt_embd.embedding.weight is model.src_embd.embedding.weight,
+    }
+
+
+def export_bundle(config, checkpoint: str, out: str):
+    translator = Translator(config, checkpoint=checkpoint, device="cpu")
+    assert isinstance(translator.model, torch.nn.Module), "TorchScript exports can't be bundled, bundle the checkpoint"
+    state = load_checkpoint(checkpoint)
+    torch.save({
+        'epoch': state.get('epoch'),
+        'global_step': state.get('global_step'),
+        'model_state_dict': translator.model.state_dict(),
+        'quantization': state.get('quantization'),
+        'hparams': model_hparams(translator.model),
+        'tokenizers': {'src': translator.tok_src.to_str(), 'tgt': translator.tok_tgt.to_str()},
+        'source_checkpoint': str(checkpoint),
+    }, out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--epoch", default="best", help="checkpoint of get_weights_file_path to bundle")
+    parser.add_argument("--checkpoint", default=None, help="explicit checkpoint path instead of --epoch")
+    parser.add_argument("--out", default=None, help="default: bundle_<model_basename><epoch>.pt next to the checkpoints")
+    args = parser.parse_args()
+
+    config = get_config()
+    checkpoint = args.checkpoint or get_weights_file_path(config, args.epoch)
+    out = args.out or get_bundle_file_path(config, args.epoch)
+    export_bundle(config, checkpoint, out)
+    print(f"Inference bundle written to {out}")
+
+
+if __name__ == "__main__":
+    main()
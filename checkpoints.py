@@ -0,0 +1,123 @@
+import json
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+import torch
+
+from config import get_weights_file_path, get_checkpoint_index_path
+
+# training checkpoints written off the training loop:
+#   save() snapshots the state to cpu (the only part the loop waits for), a background thread torch.saves it
+#   every file is written to <name>.tmp and renamed --> a crash mid write never leaves a truncated checkpoint
+#   best--> hard link of the epoch file (no second torch.save), retention keeps the last keep_last epoch files
+#   checkpoints.json (get_checkpoint_index_path) records latest / best, read by latest_weights_file_path
+
+
+def to_cpu(obj, memo=None):
+    # copy of every tensor of a (nested) state dict on the cpu, the training loop keeps updating the originals
+    # memo--> aliases (tied weights: src / tgt embedding + projection are one matrix under three keys) map to one
+    # cpu copy, torch.save then stores the shared storage once like it does for the originals
+    if memo is None:
+        memo = {}
+    if isinstance(obj, torch.Tensor):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), tuple(obj.shape), obj.stride(),
+               obj.dtype, obj.device)
+        if key not in memo:
+            memo[key] = obj.detach().to("cpu", copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: to_cpu(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v, memo) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    tmp = f"{path}.tmp"
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def atomic_link(src, dst):
+    # dst becomes the same file as src, falls back to a copy where hard links are not supported
+    tmp = f"{dst}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def load_checkpoint(path, map_location="cpu"):
+    # inference loading--> memory mapped, tensors are only read from disk when used
+    # (load_state_dict reads the weights, the Adam moments of a training checkpoint are never touched)
+    # torch < 2.1 has no mmap --> plain load of the whole file
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location=map_location)
+
+
+class CheckpointWriter:
+    def __init__(self, config, keep_last: int = 3):
+        self.config = config
+        self.keep_last = keep_last
+        self.index_path = Path(get_checkpoint_index_path(config))
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        # resumed runs continue the existing index --> its epoch files stay under the retention policy
+        self.index = json.loads(self.index_path.read_text()) if self.index_path.exists() else {}
+        self.index.setdefault("epochs", [])
+        # one pending snapshot at most --> a slow disk blocks save() instead of piling up copies of the model
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state: dict, epoch: int, val_loss: float = None, best: bool = False):
+        self._raise()
+        self.queue.put((to_cpu(state), epoch, val_loss, best))
+
+    def close(self):
+        # waits for the pending writes
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            raise RuntimeError("writing a checkpoint failed") from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, state, epoch, val_loss, best):
+        path = get_weights_file_path(self.config, f"{epoch:02d}")
+        atomic_save(state, path)
+        name = Path(path).name
+        if best:
+            best_path = get_weights_file_path(self.config, "best")
+            atomic_link(path, best_path)
+            self.index.update(best=Path(best_path).name, best_epoch=epoch, best_val_loss=val_loss)
+
+        epochs = [e for e in self.index["epochs"] if e != name] + [name]
+        if self.keep_last > 0:
+            # "best" is its own link --> removing its epoch file keeps the best weights
+            for old in epochs[:-self.keep_last]:
+                (self.index_path.parent / old).unlink(missing_ok=True)
+            epochs = epochs[-self.keep_last:]
+        self.index.update(latest=name, latest_epoch=epoch, epochs=epochs)
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+        tmp.write_text(json.dumps(self.index, indent=2))
+        os.replace(tmp, self.index_path)
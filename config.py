@@ -1,30 +1,83 @@
+import json
 from pathlib import Path
 def get_config():
     return {
         "batch_size": 16,
+        "val_batch_size": 16, # sentences greedy decoded in parallel during validation
+        "val_sample_size": 500, # validation sentences decoded for BLEU / CER / WER every epoch, None--> all (loss always uses all)
+        "dynamic_padding": True, # pad each batch to its longest sentence (length bucketed) instead of seq_len
+        "max_tokens": None, # token budget per training batch (batch size * longest sentence), None--> batch_size sentences
+        "beam_size": 1, # translate: 1--> greedy decoding, >1--> beam search with this many beams
+        "length_penalty": 0.6, # beam search length penalty alpha
         "num_epochs": 50,
         "lr": 10**-4,
         "seq_len": 350,#max len of input and output seq
         "d_model": 512, # dimensionality of model embedding
+        "attention_backend": "sdpa", # "sdpa" fused attention kernel, "math" explicit softmax (keeps attention maps)
+        "activation_checkpointing": 0, # recompute every k-th encoder/decoder block in backward (1--> all, 0--> off)
+        "world_size": 1, # data parallel training processes on this machine (gloo), python train_es_lr.py --world_size N
+        "dist_port": 29500, # rendezvous port of the training processes
+        "seed": 0, # train / val split and distributed shuffling, identical in every process
+        "log_every": 50, # training steps between TensorBoard writes (loss, non pad tokens/s, peak memory, phase times)
+        "step_timers": False, # ms per step of data / encode / decode / project / loss / backward / optimizer (syncs cuda)
+        "profile_steps": 0, # >0--> torch.profiler trace of this many steps under <tensorboard run>/profile
+        "profile_wait": 10, # steps before the profiled window
+        "precision": "fp32", # "fp32", "bf16" (autocast, cpu or cuda) or "fp16" (autocast + grad scaling, cuda only)
         "data_source": "Helsinki-NLP/opus_books",#HF datasource
         "lang_src": "en", "lang_tgt": "it", #src and tgt lang
         "model_folder": "weights", #Folder to store modek checkpoints
         "model_basename": "tmodel_", # prefix for save mmodel file
+        "keep_checkpoints": 3, # epoch checkpoints kept on disk besides the best one, 0--> keep all
         "preload" : "latest", # to reusume from latest checkpoint
         "tokenizer_file": "tokenizer_{0}.json", # to store tokenizer where {0} to be replaced by lang
+        "tokenizer_type": "wordlevel", # "wordlevel" (whole words seen twice), "bpe" or "unigram" (subwords, no [UNK] words)
+        "vocab_size": 16000, # target vocab size of the bpe / unigram tokenizers (per language, or joint with shared_vocab)
+        "shared_vocab": False, # one joint tokenizer for both languages + src embedding, tgt embedding and projection tied
+        "token_cache_folder": "token_cache", # pre tokenized, memory mapped dataset (token_cache.py)
         "experiment_name": "runs/tmodel" # to store Tensorboard logs
     }
 def get_weights_file_path(config, epoch: str):
     model_folder = f"{config['data_source']}_{config['model_folder']}"  #folder to store model weights
     model_filename = f"{config['model_basename']}{epoch}.pt"  #joining model with epoch
     return str(Path('.') / model_folder / model_filename) # returns full path of model wts
+def get_quantized_file_path(config, epoch: str):
+    # int8 export of a checkpoint, kept out of the model_basename* glob of latest_weights_file_path
+    model_folder = f"{config['data_source']}_{config['model_folder']}"
+    return str(Path('.') / model_folder / f"int8_{config['model_basename']}{epoch}.pt")
+def get_scripted_file_path(config, epoch: str):
+    # TorchScript export (export_torchscript.py), same reason for the prefix
+    model_folder = f"{config['data_source']}_{config['model_folder']}"
+    return str(Path('.') / model_folder / f"ts_{config['model_basename']}{epoch}.pt")
+def get_bundle_file_path(config, epoch: str):
+    # self contained inference bundle (bundle.py), same reason for the prefix
+    model_folder = f"{config['data_source']}_{config['model_folder']}"
+    return str(Path('.') / model_folder / f"bundle_{config['model_basename']}{epoch}.pt")
+def get_tokenizer_file_path(config, lang: str):
+    # shared_vocab--> both languages use the joint tokenizer, e.g. tokenizer_en-it.json
+    # subword tokenizers--> type and vocab size in the name too, e.g. tokenizer_en_bpe16000.json
+    if config.get('shared_vocab'):
+        lang = f"{config['lang_src']}-{config['lang_tgt']}"
+    if config.get('tokenizer_type', 'wordlevel') != 'wordlevel':
+        lang = f"{lang}_{config['tokenizer_type']}{config['vocab_size']}"
+    return config['tokenizer_file'].format(lang)
+def get_checkpoint_index_path(config):
+    # checkpoints.json--> latest / best checkpoint and the epochs kept, written by checkpoints.CheckpointWriter
+    model_folder = f"{config['data_source']}_{config['model_folder']}"
+    return str(Path('.') / model_folder / "checkpoints.json")
 #findning latest files
 def latest_weights_file_path(config):
+    index_path = Path(get_checkpoint_index_path(config))
+    if index_path.exists():
+        latest = json.loads(index_path.read_text()).get("latest")
+        if latest and (index_path.parent / latest).exists():
+            return str(index_path.parent / latest)
+    # no index (older runs)--> highest epoch number, "best" only when there is no epoch file
+    # (sorting the names as strings put tmodel_best.pt after tmodel_49.pt)
     model_folder = f"{config['data_source']}_{config['model_folder']}"
-    model_filename = f"{config['model_basename']}*"
+    model_filename = f"{config['model_basename']}*.pt"
     weights_files = list(Path(model_folder).glob(model_filename))
-    if len(weights_files) == 0:
-        return None
-    weights_files.sort()
-    return str(weights_files[-1])  # getting latest weights
-
+    epochs = [f for f in weights_files if f.stem[len(config['model_basename']):].isdigit()]
+    if epochs:
+        return str(max(epochs, key=lambda f: int(f.stem[len(config['model_basename']):])))  # getting latest weights
+    best = Path(get_weights_file_path(config, "best"))
+    return str(best) if best.exists() else None
@@ -1,11 +1,14 @@
+import random
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 class BilingualDataset(Dataset):
-    def __init__(self, ds, tokenizer_src, tokenizer_tgt,src_lang,tgt_lang, seq_len):
+    def __init__(self, ds, tokenizer_src, tokenizer_tgt,src_lang,tgt_lang, seq_len, pad: bool = True):
         super().__init__()
         self.seq_len = seq_len
+        # pad=False--> sequences are only truncated to seq_len, PadCollate pads each batch to its own longest one
+        self.pad = pad
         self.ds = ds
         self.tokenizer_src = tokenizer_src
         self.tokenizer_tgt = tokenizer_tgt
@@ -25,8 +28,13 @@ class BilingualDataset(Dataset):
         src_text = src_target_pair["translation"][self.src_lang]
         tgt_text = src_target_pair["translation"][self.tgt_lang]
         # Transform text to tokens, tokens to text  --> use .encode()
-        enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
+        # rows of a TokenCache already carry the token ids --> no tokenization per access
+        if "src_ids" in src_target_pair:
+            enc_input_tokens = src_target_pair["src_ids"]
+            dec_input_tokens = src_target_pair["tgt_ids"]
+        else:
+            enc_input_tokens = self.tokenizer_src.encode(src_text).ids
+            dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
         enc_input_tokens = enc_input_tokens[: self.seq_len - 2]  # [SOS] + tokens + [EOS]
         dec_input_tokens = dec_input_tokens[: self.seq_len - 1]  # [SOS] + tokens
         # adding sos , eos, and padding to each sentence
@@ -34,6 +42,8 @@ class BilingualDataset(Dataset):
         # we will only  add </s> to the label
         dec_num_padding_tokens = self.seq_len - len(dec_input_tokens) -1
         # ensuring that the number of padding token is not negative
+        if not self.pad:
+            enc_num_padding_tokens = dec_num_padding_tokens = 0
 
         # adding <s>, and </s> to the encoder input
         encoder_input = torch.cat(
@@ -62,16 +72,17 @@ class BilingualDataset(Dataset):
         ],
             dim=0,
         )
-        # Double check the size of the tensors to make sure they are all seq_len long
-        assert encoder_input.size(0) == self.seq_len
-        assert decoder_input.size(0) == self.seq_len
-        assert label.size(0) == self.seq_len
+        if self.pad:
+            # Double check the size of the tensors to make sure they are all seq_len long
+            assert encoder_input.size(0) == self.seq_len
+            assert decoder_input.size(0) == self.seq_len
+            assert label.size(0) == self.seq_len
 
+        # ids only --> the model builds the padding / causal masks on its own device
+        # (model.make_src_mask, model.make_tgt_mask), no (seq_len, seq_len) mask per sample
         return {
-            "encoder_input": encoder_input, # seq_len
-            "decoder_input": decoder_input, # seq_len
-            "encoder_mask": (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int() ,# (1,1,seq_len)  (batch dim, head_dim, keys dim) --> .unsqueeze(0).unsqueeze(0) to make it compatible with multiheadattention
-            "decoder_mask": (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0)) , #(1,seq_len) &(1, seq_len)-->(batch, seq_len) & (1,seq_len, seq_len) final shape--> (1,1,seq_len) & (1,seq_len,seq_len)--> (1,seq_len,seq_len)
+            "encoder_input": encoder_input, # seq_len (<= seq_len with pad=False)
+            "decoder_input": decoder_input, # seq_len (<= seq_len with pad=False)
             "label": label,
             "src_text": src_text,
             "tgt_text": tgt_text,
@@ -82,6 +93,108 @@ def causal_mask(size):
     return mask == 0
 
 
+class PadCollate:
+    # collate_fn for BilingualDataset(pad=False) --> pads every batch only to its own longest sequence
+    def __init__(self, pad_id: int):
+        self.pad_id = pad_id
+
+    def pad(self, seqs):
+        return torch.nn.utils.rnn.pad_sequence(seqs, batch_first=True, padding_value=self.pad_id)
+
+    def __call__(self, items):
+        encoder_input = self.pad([item["encoder_input"] for item in items])  # (batch, src_len)
+        decoder_input = self.pad([item["decoder_input"] for item in items])  # (batch, tgt_len)
+        label = self.pad([item["label"] for item in items])
+        return {
+            "encoder_input": encoder_input,
+            "decoder_input": decoder_input,
+            "label": label,
+            "src_text": [item["src_text"] for item in items],
+            "tgt_text": [item["tgt_text"] for item in items],
+        }
+
+
+class LengthBucketSampler(Sampler):
+    # batch_sampler that groups sentences of similar length --> little padding once PadCollate pads per batch
+    # lengths--> padded length of every sample (max of encoder / decoder input)
+    # batch_size--> fixed number of sentences per batch, or max_tokens--> batch size * longest sentence <= max_tokens
+    def __init__(self, lengths, batch_size: int = None, max_tokens: int = None, shuffle: bool = True,
+                 bucket_size: int = 100, num_replicas: int = 1, rank: int = 0, seed: int = None):
+        # no Sampler.__init__ call: it does nothing, and its data_source argument is required on torch 2.0
+        # but removed on newer versions
+        assert batch_size or max_tokens, "batch_size or max_tokens is required"
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        # sentences are sorted inside pools of bucket_size batches --> batches still vary between epochs
+        self.bucket_size = bucket_size
+        # distributed--> every rank shuffles with the same seed and keeps every num_replicas-th batch
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.rng = random.Random(seed)
+        self.batches = None
+
+    def make_batches(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            self.rng.shuffle(indices)
+        pool_size = (self.batch_size or max(1, self.max_tokens // max(self.lengths))) * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=lambda i: self.lengths[i])
+            batch, longest = [], 0
+            for i in pool:
+                if batch and self.batch_full(len(batch) + 1, max(longest, self.lengths[i])):
+                    batches.append(batch)
+                    batch, longest = [], 0
+                batch.append(i)
+                longest = max(longest, self.lengths[i])
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            self.rng.shuffle(batches)
+        if self.num_replicas > 1:
+            # same number of steps on every rank, otherwise the gradient all reduce waits forever
+            usable = len(batches) - len(batches) % self.num_replicas
+            batches = batches[self.rank:usable:self.num_replicas]
+        return batches
+
+    def batch_full(self, size, longest):
+        if self.max_tokens is not None:
+            return size * longest > self.max_tokens
+        return size > self.batch_size
+
+    def __iter__(self):
+        batches = self.batches if self.batches is not None else self.make_batches()
+        self.batches = None  # next epoch gets a new shuffle
+        return iter(batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
+
+
+def padding_report(batches, src_lengths, tgt_lengths, seq_len):
+    # share of the positions (ffn, linear in length) and of the attention scores (quadratic) that are padding
+    # for fixed seq_len padding vs the given batches
+    report = {}
+    for name, lengths in (("encoder", src_lengths), ("decoder", tgt_lengths)):
+        real = sum(lengths[i] for b in batches for i in b)
+        real_sq = sum(lengths[i] ** 2 for b in batches for i in b)
+        n = sum(len(b) for b in batches)
+        padded = sum(len(b) * max(lengths[i] for i in b) for b in batches)
+        padded_sq = sum(len(b) * max(lengths[i] for i in b) ** 2 for b in batches)
+        report[name] = {
+            "fixed_tokens": 1 - real / (n * seq_len),
+            "fixed_attention": 1 - real_sq / (n * seq_len ** 2),
+            "bucketed_tokens": 1 - real / padded,
+            "bucketed_attention": 1 - real_sq / padded_sq,
+        }
+    return report
+
+
 
 # mask1 = torch.tril(torch.ones(1, size, size), diagonal=1).int()
 # # Upper triangle (excluding diagonal)
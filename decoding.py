@@ -0,0 +1,142 @@
+import torch
+
+
+# validation code
+def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, min_len: int = 0):
+    # autoregressive inference logic for a whole batch of sources
+    # source --> (batch, seq_len), source_mask --> (batch, 1, 1, seq_len)
+    # min_len--> [EOS] blocked for the first min_len generated tokens (next best token taken instead)
+    # returns (batch, <= max_len) token ids: [SOS] + prediction (+ [EOS]), rows that finished early padded with [PAD]
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+    # encoder output->runs once to to get contextual representation of input sentence
+    encoder_output = model.encode(source, source_mask)
+    # kv cache--> every step only the newest token goes through the decoder, no causal mask needed
+    # cross attention keys/values of encoder_output are projected once here instead of every step
+    cache = model.prepare_memory(encoder_output)
+
+    output = torch.full((batch_size, max_len), pad_idx, dtype=source.dtype, device=device)
+    output[:, 0] = sos_idx  # (autoregression-->right shift operation)
+    # rows of the original batch still decoding, finished rows are dropped from every tensor below
+    active = torch.arange(batch_size, device=device)
+    last = output[:, :1]
+    length = 1
+    # loop until decoder reaches the max_len or every sentence produced [EOS]
+    while length < max_len and active.numel() > 0:
+        out = model.decode(encoder_output, source_mask, last, None, cache)
+        # next token
+        prob = model.project(out[:, -1])  # generate(last decoder ts output)->project to vocb space->prob(logits for next token pred)
+        if length - 1 < min_len:
+            prob[:, eos_idx] = float('-inf')
+        _, next_word = torch.max(prob, dim=1)  # next_word-->max_prob
+        output[active, length] = next_word
+        length += 1
+
+        running = next_word != eos_idx
+        if not running.all():
+            # per row [EOS] --> remove the finished sentences from the active batch
+            keep = running.nonzero(as_tuple=True)[0]
+            active = active[keep]
+            encoder_output = encoder_output[keep]
+            source_mask = source_mask[keep]
+            next_word = next_word[keep]
+            cache.index_select(keep)
+        last = next_word.unsqueeze(1)
+    return output[:, :length]
+
+
+def beam_search(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size: int = 4,
+                length_penalty: float = 0.6, min_len: int = 0):
+    # batched beam search --> every source keeps beam_size live hypotheses, all of them decoded in one forward pass per step
+    # source --> (batch, seq_len), source_mask --> (batch, 1, 1, seq_len)
+    # length_penalty--> alpha of the GNMT penalty ((5 + len) / 6) ** alpha finished hypotheses are ranked by, 0 = raw log prob
+    # min_len--> [EOS] blocked for the first min_len generated tokens, like greedy_decode
+    # finished hypotheses ([EOS] extensions of the live beams) leave the beam: only the best one per source is kept
+    # (length normalized), the k live beams keep expanding until none of them can beat it any more
+    # returns (batch, <= max_len) token ids of the best hypothesis, same layout as greedy_decode
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size, k = source.size(0), beam_size
+
+    def penalty(length):
+        # length--> generated tokens (including [EOS])
+        return ((5.0 + length) / 6.0) ** length_penalty if length_penalty else 1.0
+
+    # encoder runs once per source, its cross attention keys/values are expanded to the beams once here
+    encoder_output = model.encode(source, source_mask)
+    cache = model.prepare_memory(encoder_output)
+    beam_rows = torch.arange(batch_size, device=device).repeat_interleave(k)  # (batch * k,) source of every beam
+    cache.index_select(beam_rows)
+    source_mask = source_mask.index_select(0, beam_rows)
+
+    output = torch.full((batch_size, max_len), pad_idx, dtype=source.dtype, device=device)
+    output[:, 0] = sos_idx
+    active = torch.arange(batch_size, device=device)  # sources still decoding
+    tokens = torch.full((batch_size * k, 1), sos_idx, dtype=source.dtype, device=device)  # (active * k, length)
+    # only the first beam is alive at the start, otherwise the k identical beams would fill the top k
+    scores = torch.full((batch_size, k), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    # normalized score of the hypothesis written to output, per source
+    best = torch.full((batch_size,), float('-inf'), device=device)
+    # a live beam's log prob only goes down, the penalty grows at most up to max_len --> bound on what it can reach
+    max_penalty = penalty(max_len - 1)
+
+    def write(rows, norm, seq):
+        # seq (rows, length) replaces the hypothesis of the given active rows where norm beats it
+        better = norm > best[active[rows]]
+        rows, norm, seq = rows[better], norm[better], seq[better]
+        sources = active[rows]
+        best[sources] = norm
+        output[sources] = pad_idx
+        output[sources, :seq.size(1)] = seq
+
+    while tokens.size(1) < max_len and active.numel() > 0:
+        n = active.numel()
+        # cross attention uses the cached (expanded) keys/values, encoder_output itself is not read here
+        out = model.decode(encoder_output, source_mask, tokens[:, -1:], None, cache)
+        log_probs = torch.log_softmax(model.project(out[:, -1]).float(), dim=-1)  # (n * k, vocab), float32 under autocast too
+        if tokens.size(1) - 1 < min_len:
+            log_probs[:, eos_idx] = float('-inf')
+        vocab_size = log_probs.size(-1)
+
+        # [EOS] extension of every live beam --> finished hypothesis, kept if it beats the best one of its source
+        eos_scores = (scores.view(-1) + log_probs[:, eos_idx]).view(n, k) / penalty(tokens.size(1))
+        norm, beam = eos_scores.max(dim=1)
+        rows = torch.arange(n, device=device)
+        eos = torch.full((n, 1), eos_idx, dtype=tokens.dtype, device=device)
+        write(rows, norm, torch.cat([tokens.view(n, k, -1)[rows, beam], eos], dim=1))
+
+        # top k over all (beam, token) expansions of each source, [EOS] excluded --> k live beams
+        log_probs[:, eos_idx] = float('-inf')
+        candidates = (scores.view(-1, 1) + log_probs).view(n, k * vocab_size)
+        scores, top = candidates.topk(k, dim=1)
+        parent = top // vocab_size
+        next_word = top % vocab_size
+        beams = (rows * k).unsqueeze(1) + parent  # (n, k) flat index of the parent beam
+        tokens = torch.cat([tokens[beams.view(-1)], next_word.view(-1, 1)], dim=1)
+        # reorder the self attention history to follow the surviving beams (cross attention is the same for all beams)
+        cache.index_select(beams.view(-1), cross=False)
+
+        done = best[active] >= scores.max(dim=1).values / max_penalty
+        if done.any():
+            # no live beam can beat the finished hypothesis any more --> drop the source from the batch
+            keep = (~done).nonzero(as_tuple=True)[0]
+            keep_rows = ((keep * k).unsqueeze(1) + torch.arange(k, device=device)).view(-1)
+            active, scores = active[keep], scores[keep]
+            encoder_output = encoder_output[keep]
+            source_mask = source_mask[keep_rows]
+            tokens = tokens[keep_rows]
+            cache.index_select(keep_rows)
+
+    if active.numel() > 0:
+        # max_len reached--> the best live beam (no [EOS]) competes with the finished hypotheses
+        n = active.numel()
+        norm, beam = (scores / penalty(tokens.size(1) - 1)).max(dim=1)
+        rows = torch.arange(n, device=device)
+        write(rows, norm, tokens.view(n, k, -1)[rows, beam])
+    # trailing all [PAD] columns trimmed, like greedy_decode
+    used = (output != pad_idx).any(dim=0).nonzero()
+    return output[:, :int(used.max()) + 1]
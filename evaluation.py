@@ -0,0 +1,201 @@
+
+# offline evaluation of a checkpoint (or bundle / int8 / TorchScript export) on a jsonl test set
+# Usage:
+#   python evaluation.py test.jsonl                                     (latest checkpoint, report on stdout)
+#   python evaluation.py test.jsonl --checkpoint bundle.pt --workers 4 -o report.json
+# test set--> one json object per line with the source / reference under the config languages, either top level
+#   ({"en": ..., "it": ...}) or like the opus_books rows ({"translation": {"en": ..., "it": ...}})
+# loss--> teacher forced, length bucketed batches, mean over the non [PAD] target tokens (not available for TorchScript)
+# BLEU / CER / WER--> batched decoding (greedy or beam search, config["beam_size"]) of length sorted micro batches,
+#   spread over --workers processes, metric statistics accumulated batch by batch --> no texts kept around
+# train_model's per epoch validation uses the same loss / metrics on config["val_sample_size"] sentences
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import torch
+import torchmetrics
+
+from config import get_config
+from dataset import BilingualDataset, PadCollate, LengthBucketSampler
+from decoding import greedy_decode
+from precision import autocast
+from translate import Translator, detokenize
+
+
+class StreamingMetrics:
+    # CER / WER / BLEU of every update() so far, only the metric statistics are stored
+    # sync_on_compute=False--> local statistics only, torchmetrics would otherwise gather across the process group
+    # of distributed training, where validation runs on rank 0 alone
+    def __init__(self):
+        self.cer = torchmetrics.text.CharErrorRate(sync_on_compute=False)
+        self.wer = torchmetrics.text.WordErrorRate(sync_on_compute=False)
+        self.bleu = torchmetrics.text.BLEUScore(sync_on_compute=False)
+        self.sentences = 0
+
+    def update(self, predicted, expected):
+        self.cer.update(predicted, expected)
+        self.wer.update(predicted, expected)
+        self.bleu.update(predicted, [[t] for t in expected])  # nested --> one reference per sentence
+        self.sentences += len(predicted)
+
+    def compute(self):
+        if self.sentences == 0:
+            return {}
+        return {"bleu": self.bleu.compute().item(), "cer": self.cer.compute().item(), "wer": self.wer.compute().item()}
+
+
+def teacher_forced_loss(model, dataloader, pad_id: int, device, precision: str = "fp32"):
+    # mean cross entropy over all non [PAD] labels (not the mean of per batch means) --> (loss, tokens)
+    model.eval()
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=pad_id, reduction="sum")
+    total, tokens = 0.0, 0
+    with torch.no_grad(), autocast(precision, device):
+        for batch in dataloader:
+            encoder_input = batch['encoder_input'].to(device)
+            decoder_input = batch['decoder_input'].to(device)
+            label = batch['label'].to(device)
+            # only ids cross to the device, masks are built there
+            proj_output = model(encoder_input, model.make_src_mask(encoder_input), decoder_input,
+                                model.make_tgt_mask(decoder_input))
+            total += loss_fn(proj_output.float().view(-1, proj_output.shape[-1]), label.view(-1)).item()
+            tokens += int((label != pad_id).sum())
+    return total / max(tokens, 1), tokens
+
+
+def decode_batches(model, dataloader, tokenizer_src, tokenizer_tgt, max_len, device, precision: str = "fp32",
+                   max_sentences: int = None):
+    # batched greedy decode of the dataloader --> (sources, references, predictions) per batch, up to max_sentences
+    model.eval()
+    eos_id = tokenizer_tgt.token_to_id('[EOS]')
+    count = 0
+    with torch.no_grad(), autocast(precision, device):
+        for batch in dataloader:
+            encoder_input = batch["encoder_input"].to(device)
+            if max_sentences is not None:
+                encoder_input = encoder_input[:max_sentences - count]
+            out = greedy_decode(model, encoder_input, model.make_src_mask(encoder_input), tokenizer_src, tokenizer_tgt,
+                                max_len, device)
+            n = encoder_input.size(0)
+            yield (batch["src_text"][:n], batch["tgt_text"][:n],
+                   [detokenize(tokenizer_tgt, row, eos_id) for row in out.tolist()])
+            count += n
+            if max_sentences is not None and count >= max_sentences:
+                break
+
+
+def read_test_set(path, lang_src: str, lang_tgt: str):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            pair = record.get("translation", record)
+            rows.append({"translation": {lang_src: pair[lang_src], lang_tgt: pair[lang_tgt]}})
+    return rows
+
+
+# decode workers: one Translator per process, loaded once by the pool initializer
+_worker_translator = None
+
+
+def _init_worker(config, checkpoint, threads, loaded):
+    # loaded--> barrier shared with evaluate, passed once every worker has its model (or failed to load it, the
+    # pool then reports the error) --> the decode clock does not include process start up and model loading
+    global _worker_translator
+    try:
+        torch.set_num_threads(threads)
+        _worker_translator = Translator(config, checkpoint=checkpoint, device="cpu")
+    finally:
+        loaded.wait()
+
+
+def _decode_shard(indices, sentences):
+    return indices, _worker_translator.translate_batch(sentences)
+
+
+def evaluate(config, checkpoint, test_set, workers: int = 1, batch_size: int = 32, device=None):
+    lang_src, lang_tgt = config['lang_src'], config['lang_tgt']
+    translator = Translator(config, checkpoint=checkpoint, device=device)
+    rows = read_test_set(test_set, lang_src, lang_tgt)
+    sources = [r["translation"][lang_src] for r in rows]
+    references = [r["translation"][lang_tgt] for r in rows]
+    # tokenized once --> BilingualDataset takes the ids as they are, lengths for the length sorted batches
+    for row, src, tgt in zip(rows, translator.tok_src.encode_batch(sources), translator.tok_tgt.encode_batch(references)):
+        row["src_ids"], row["tgt_ids"] = src.ids, tgt.ids
+    lengths = [min(max(len(r["src_ids"]) + 2, len(r["tgt_ids"]) + 1), translator.seq_len) for r in rows]
+    report = {"checkpoint": str(checkpoint), "test_set": str(test_set), "sentences": len(rows),
+              "beam_size": config['beam_size'], "precision": translator.precision, "workers": workers}
+
+    # teacher forced loss, eager models only (the TorchScript export has no full sequence forward)
+    if isinstance(translator.model, torch.nn.Module):
+        start = time.perf_counter()
+        pad_id = translator.tok_tgt.token_to_id('[PAD]')
+        ds = BilingualDataset(rows, translator.tok_src, translator.tok_tgt, lang_src, lang_tgt, translator.seq_len,
+                              pad=False)
+        loader = torch.utils.data.DataLoader(ds, collate_fn=PadCollate(pad_id), batch_sampler=LengthBucketSampler(
+            lengths, batch_size=batch_size, shuffle=False))
+        loss, tokens = teacher_forced_loss(translator.model, loader, pad_id, translator.device, translator.precision)
+        report.update(loss=loss, perplexity=math.exp(min(loss, 50)), loss_tokens=tokens,
+                      loss_seconds=time.perf_counter() - start)
+
+    metrics = StreamingMetrics()
+    # length sorted micro batches of sentence indices --> little padding in every decode batch
+    order = sorted(range(len(rows)), key=lambda i: lengths[i])
+    shards = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    workers = min(workers, len(shards))
+    start = time.perf_counter()
+    if workers > 1:
+        # every worker loads its own copy of the model, the cores are split between them
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        ctx = multiprocessing.get_context("spawn")
+        loaded = ctx.Barrier(workers + 1)
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(config, checkpoint, threads, loaded)) as pool:
+            # the first `workers` submits start the processes, decoding begins once all of them are loaded
+            futures = [pool.submit(_decode_shard, shard, [sources[i] for i in shard]) for shard in shards]
+            loaded.wait()
+            report.update(worker_load_seconds=time.perf_counter() - start)
+            start = time.perf_counter()
+            for future in as_completed(futures):
+                indices, predicted = future.result()
+                metrics.update(predicted, [references[i] for i in indices])
+    else:
+        for shard in shards:
+            predicted = translator.translate_batch([sources[i] for i in shard])
+            metrics.update(predicted, [references[i] for i in shard])
+    elapsed = time.perf_counter() - start
+    report.update(metrics.compute())
+    report.update(decode_seconds=elapsed, sentences_per_sec=len(rows) / elapsed if elapsed else 0.0)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline evaluation of a checkpoint on a jsonl test set")
+    parser.add_argument("test_set", help="jsonl file with source / reference pairs")
+    parser.add_argument("--checkpoint", default=None, help="default: latest checkpoint of the config")
+    parser.add_argument("--workers", type=int, default=1, help="decode processes")
+    parser.add_argument("--batch_size", type=int, default=32, help="sentences per loss / decode batch")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("-o", "--output", default="-", help="json report, - for stdout")
+    args = parser.parse_args()
+
+    report = evaluate(get_config(), args.checkpoint, args.test_set, workers=args.workers, batch_size=args.batch_size,
+                      device=args.device)
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
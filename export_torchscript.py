@@ -0,0 +1,91 @@
+
+# TorchScript export of a trained checkpoint: traced encoder, cross attention memory, single decode step and projection
+# Usage:
+#   python export_torchscript.py                          (best checkpoint --> ts_tmodel_best.pt in the model folder)
+#   python export_torchscript.py --checkpoint some.pt --out some_ts.pt
+# the artifact loads like any checkpoint --> Translator(checkpoint=...), bulk_translate.py / serve.py --checkpoint
+# (float32, cpu or the device it is loaded on), parity + eager vs traced latency --> python -m benchmarks.torchscript
+import argparse
+import json
+import torch
+import torch.nn as nn
+
+from config import get_config, get_weights_file_path, get_scripted_file_path
+from translate import Translator
+
+
+class TracedMethods(nn.Module):
+    # tensor only entry points of a Transformer --> what torch.jit.trace_module records
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def encode(self, src, src_mask):
+        return self.model.encode(src, src_mask)
+
+    def memory(self, encoder_output):
+        cache = self.model.prepare_memory(encoder_output)
+        return tuple(c.key for c in cache.cross_attn), tuple(c.value for c in cache.cross_attn)
+
+    def decode_step(self, tgt, positions, src_mask, tgt_mask, cross_keys, cross_values, self_keys, self_values):
+        # tgt (batch, 1), positions (batch,), tgt_mask (batch,1,1,history + 1), caches as per layer tuples
+        cache = self.model.new_cache()
+        for c, key, value in zip(cache.cross_attn, cross_keys, cross_values):
+            c.key, c.value = key, value
+        for c, key, value in zip(cache.self_attn, self_keys, self_values):
+            c.key, c.value = key, value
+        cache.positions = positions
+        out = self.model.decode(None, src_mask, tgt, tgt_mask, cache)
+        return out, tuple(c.key for c in cache.self_attn), tuple(c.value for c in cache.self_attn)
+
+    def project(self, x):
+        return self.model.project(x)
+
+
+def trace(model, path):
+    # example inputs only fix the ranks / dtypes, batch size and lengths stay dynamic
+    model = model.eval()
+    layers = model.decoder.layers
+    attention = layers[0].self_attention_block
+    batch, src_len, history = 2, 5, 3
+    src = torch.full((batch, src_len), model.src_pad_id + 1, dtype=torch.long)
+    src_mask = model.make_src_mask(src)
+    device = next(model.parameters()).device
+    src, src_mask = src.to(device), src_mask.to(device)
+    wrapper = TracedMethods(model)
+    with torch.no_grad():
+        encoder_output = model.encode(src, src_mask)
+        cross_keys, cross_values = wrapper.memory(encoder_output)
+        past = tuple(torch.zeros(batch, attention.h, history, attention.d_k, device=device) for _ in layers)
+        step_inputs = (torch.ones(batch, 1, dtype=torch.long, device=device),
+                       torch.full((batch,), history, dtype=torch.long, device=device), src_mask,
+                       torch.ones(batch, 1, 1, history + 1, dtype=torch.bool, device=device),
+                       cross_keys, cross_values, past, past)
+        traced = torch.jit.trace_module(wrapper, {
+            "encode": (src, src_mask),
+            "memory": (encoder_output,),
+            "decode_step": step_inputs,
+            "project": (encoder_output[:, -1],),
+        }, check_trace=False)
+    meta = {"num_layers": len(layers), "h": attention.h, "d_k": attention.d_k,
+            "src_pad_id": model.src_pad_id, "tgt_pad_id": model.tgt_pad_id}
+    torch.jit.save(traced, str(path), _extra_files={"meta.json": json.dumps(meta)})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--epoch", default="best", help="checkpoint of get_weights_file_path to export")
+    parser.add_argument("--checkpoint", default=None, help="explicit checkpoint path instead of --epoch")
+    parser.add_argument("--out", default=None, help="default: ts_<model_basename><epoch>.pt next to the checkpoints")
+    args = parser.parse_args()
+
+    config = get_config()
+    checkpoint = args.checkpoint or get_weights_file_path(config, args.epoch)
+    out = args.out or get_scripted_file_path(config, args.epoch)
+    translator = Translator(config, checkpoint=checkpoint, device="cpu")
+    trace(translator.model, out)
+    print(f"TorchScript model written to {out}")
+
+
+if __name__ == "__main__":
+    main()
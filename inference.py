@@ -1,38 +1,35 @@
+import argparse
+from config import get_config
+from translate import Translator, translate
+
+# Usage:
+#   python inference.py "some sentence"                          (latest checkpoint + tokenizer files)
+#   python inference.py "some sentence" --checkpoint bundle.pt   (bundle.py export, nothing else needed)
+#   python inference.py --validate                               (+ validation examples, loads the dataset)
+# only the inference modules are imported, train_es_lr (datasets, tensorboard, torchmetrics) only for --validate
 
-from pathlib import Path
-import torch
-from config import get_config, latest_weights_file_path
-from train_es_lr import get_model, get_ds, run_validation
-from translate import translate
-import sys
 
 def main():
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using device:", device)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("text", nargs="?", default="I am not a very good student.")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint or inference bundle, default: latest checkpoint")
+    parser.add_argument("--validate", action="store_true", help="greedy decode 2 validation examples first")
+    args = parser.parse_args()
 
     config = get_config()
-    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
-    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
-
-    # Load the pretrained weights
-    model_filename = latest_weights_file_path(config)
-    state = torch.load(model_filename)
-    model.load_state_dict(state['model_state_dict'])
+    translator = Translator(config, checkpoint=args.checkpoint)
+    print("Using device:", translator.device)
 
     # Run validation
-    run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device,
-                   lambda msg: print(msg), 0, None, num_examples=2)
-
-    # Read input from sys.argv
-    if len(sys.argv) > 1:
-        input_text = sys.argv[1]
-    else:
-        input_text = "I am not a very good student."
+    if args.validate:
+        from train_es_lr import get_ds, run_validation
+        _, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+        run_validation(translator.model, val_dataloader, tokenizer_src, tokenizer_tgt, translator.seq_len,
+                       translator.device, lambda msg: print(msg), 0, None, num_examples=2, max_sentences=2)
 
     # Run translation
-    output = translate(input_text)
+    output = translate(args.text, translator)
     print(f"\nFinal Translation Output:\n{output}")
 
 if __name__ == "__main__":
     main()
-
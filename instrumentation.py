@@ -0,0 +1,172 @@
+import resource
+import time
+from contextlib import nullcontext
+
+import torch
+
+# training loop instrumentation, everything here is close to free when switched off:
+#   MetricBuffer--> scalars kept as tensors, one device sync + TensorBoard write every `every` steps (not per batch)
+#   StepTimer--> wall clock per phase of the training step (data, encode, decode, project, loss, backward, optimizer)
+#   TokenCounter--> non [PAD] target tokens / second, counted on the device without syncing
+#   profile()--> opt-in torch.profiler capture of a window of steps, TensorBoard trace
+_OFF = nullcontext()
+
+
+class MetricBuffer:
+    def __init__(self, writer, every: int = 50):
+        self.writer = writer
+        self.every = max(1, every)
+        self.pending = []  # (tag, value, step), value--> float or 0-dim tensor still on the device
+
+    def add(self, tag: str, value, step: int):
+        if self.writer is not None:
+            self.pending.append((tag, value.detach() if isinstance(value, torch.Tensor) else value, step))
+
+    def due(self, step: int):
+        return step % self.every == 0
+
+    def flush(self):
+        if not self.pending:
+            return
+        # all tensor values in one transfer instead of one .item() sync each
+        tensors = [v for _, v, _ in self.pending if isinstance(v, torch.Tensor)]
+        values = iter(torch.stack([t.float() for t in tensors]).tolist()) if tensors else iter(())
+        for tag, value, step in self.pending:
+            self.writer.add_scalar(tag, next(values) if isinstance(value, torch.Tensor) else value, step)
+        self.writer.flush()
+        self.pending = []
+
+
+class StepTimer:
+    # phase times summed over the steps since the last reset(), means() --> ms per step and phase
+    # encode / decode / project are measured by forward hooks on the model --> also through DistributedDataParallel
+    # cuda--> synchronize at every phase boundary while enabled (accurate times, slower steps)
+    def __init__(self, enabled: bool = False, device=None):
+        self.enabled = enabled
+        self.sync = enabled and torch.device(device or "cpu").type == "cuda"
+        self.totals = {}
+        self.steps = 0
+        self.mark = None
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add(self, name: str, seconds: float):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def phase(self, name: str):
+        return _Phase(self, name) if self.enabled else _OFF
+
+    def iterate(self, iterable):
+        # time spent waiting for the next batch --> "data"
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            start = self.now()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self.add("data", self.now() - start)
+            yield batch
+
+    def attach(self, model):
+        # Transformer.forward = project(decode(encode(...))) --> hook timestamps between the three parts
+        # training forwards only, validation / decoding (eval mode) is not counted
+        if not self.enabled:
+            return
+
+        def start(module, args):
+            if module.training:
+                self.mark = self.now()
+
+        def end(name):
+            def hook(module, args, output):
+                if module.training and self.mark is not None:
+                    t = self.now()
+                    self.add(name, t - self.mark)
+                    self.mark = t
+            return hook
+
+        model.register_forward_pre_hook(start)
+        model.encoder.register_forward_hook(end("encode"))
+        model.decoder.register_forward_hook(end("decode"))
+        model.projection_layer.register_forward_hook(end("project"))
+
+    def step(self):
+        self.steps += self.enabled
+        self.mark = None
+
+    def means(self):
+        return {name: total / self.steps * 1000 for name, total in self.totals.items()} if self.steps else {}
+
+    def reset(self):
+        self.totals = {}
+        self.steps = 0
+
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.timer.now()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, self.timer.now() - self.start)
+
+
+class TokenCounter:
+    # non [PAD] tokens of the labels, summed on the device --> rate() is the only sync
+    def __init__(self, pad_id: int):
+        self.pad_id = pad_id
+        self.tokens = 0
+        self.start = time.perf_counter()
+
+    def add(self, label):
+        self.tokens = self.tokens + (label != self.pad_id).sum()
+
+    def rate(self):
+        now = time.perf_counter()
+        tokens = int(self.tokens)
+        rate = tokens / max(now - self.start, 1e-9)
+        self.tokens, self.start = 0, now
+        return rate
+
+
+def peak_memory_mb(device) -> float:
+    # cuda--> peak allocated by torch, cpu--> peak resident set size of the process
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on linux
+
+
+class _NoProfiler:
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def profile(steps: int, wait: int, log_dir: str):
+    # steps > 0--> torch.profiler records `steps` training steps after `wait` (+1 warmup) steps,
+    # trace in log_dir (TensorBoard profiler plugin / chrome://tracing), start() / step() per training step / stop()
+    if steps <= 0:
+        return _NoProfiler()
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=1, active=steps, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(log_dir),
+        record_shapes=True, profile_memory=True)
@@ -1,7 +1,15 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
 
+# attention backends of MultiHeadAttentionBlock:
+#   "sdpa" --> torch's fused scaled_dot_product_attention, the attention probabilities are never materialized for python
+#   "math" --> the explicit softmax(q k^T / sqrt(d_k)) v below
+# the probabilities are only kept when asked for with AttentionCapture (attention_visual.py), the block then runs "math"
+ATTENTION_BACKENDS = ("sdpa", "math")
+
 class InputEmbeddings(nn.Module):
     def __init__(self, d_model:int, vocab_size:int):
         super().__init__()
@@ -30,8 +38,13 @@ class PositionalEncoding(nn.Module):
         # adding batch_dim
         pe = pe.unsqueeze(0)
         self.register_buffer("pe",pe)  # pe as a model state not as a trainal parameter
-    def forward(self,x):
-        x = x + (self.pe[:, :x.shape[1], :]).requires_grad_(False)
+    def forward(self, x, start=0):
+        # start--> position of the first token in x (non zero when decoding incrementally with a cache)
+        # or a (batch,) tensor of per row start positions (rows of a continuous batch joined at different steps)
+        if torch.is_tensor(start):
+            positions = start.unsqueeze(1) + torch.arange(x.shape[1], device=x.device)  # (batch, seq_len)
+            return self.dropout(x + self.pe[0, positions].requires_grad_(False))
+        x = x + (self.pe[:, start:start + x.shape[1], :]).requires_grad_(False)
         return self.dropout(x)
 
 class LayerNormalization(nn.Module):
@@ -44,9 +57,12 @@ class LayerNormalization(nn.Module):
     def forward(self,x):
             # x-->(batch,seq_len,size)
             # dim--> for broadcasting
+        # statistics in float32 even under bf16/fp16 autocast, output goes back to the input dtype
+        dtype = x.dtype
+        x = x.float()
         mean = x.mean(dim = -1, keepdim = True) #(batch,seq_len,1)  512 dims --> single dim i.e mean of all 512 in sigle dim, by keeping keep _dims==true #For each token in each sentence, you collapse the 512 values into a single mean value.
         std = x.std(dim = -1, keepdim = True)#(batch,seq_len,1)
-        return self.alpha * (x - mean) / (std + self.eps) + self.bias
+        return (self.alpha * (x - mean) / (std + self.eps) + self.bias).to(dtype)
 
 class FeedForwardBlock(nn.Module):
     def __init__(self, d_model: int, d_ff:int, dropout: float):
@@ -58,19 +74,67 @@ class FeedForwardBlock(nn.Module):
         #flow of dimension-->> (batch,seq_len,d_model)--(batch,seq_len,d_ff)--(batch,seq_len,d_model)
         return self.linear_2(self.dropout(torch.relu(self.linear_1(x))))
 
+class AttentionCache:
+    # keys/values of one attention block for the tokens already seen, split into heads --> (batch, h, seq_len, d_k)
+    def __init__(self, static: bool = False):
+        self.key = None
+        self.value = None
+        # static--> keys/values of the encoder output (cross attention), computed once and never appended to
+        self.static = static
+
+    def update(self, key, value):
+        # append the keys/values of the new tokens and return the full history
+        if self.key is not None and not self.static:
+            key = torch.cat([self.key, key], dim=2)
+            value = torch.cat([self.value, value], dim=2)
+        self.key, self.value = key, value
+        return key, value
+
+
+class DecoderCache:
+    # one AttentionCache per decoder layer, so model.decode only has to process the newest token
+    def __init__(self, num_layers: int):
+        self.self_attn = [AttentionCache() for _ in range(num_layers)]
+        self.cross_attn = [AttentionCache(static=True) for _ in range(num_layers)]
+        self.length = 0  # number of target positions already cached
+        # optional (batch,) per row positions --> rows with different history lengths (left padded, masked keys)
+        self.positions = None
+
+    def index_select(self, index: torch.Tensor, cross: bool = True):
+        # keep / reorder batch rows of every cached tensor (e.g. drop the sentences that already produced [EOS])
+        # cross=False--> only the self attention history (beams reordered within the same source sentence)
+        for c in self.self_attn + (self.cross_attn if cross else []):
+            if c.key is not None:
+                c.key = c.key.index_select(0, index)
+                c.value = c.value.index_select(0, index)
+        if self.positions is not None:
+            self.positions = self.positions.index_select(0, index)
+
+
 class MultiHeadAttentionBlock(nn.Module):
-    def __init__(self, d_model: int, h: int, dropout: float):
+    def __init__(self, d_model: int, h: int, dropout: float, backend: str = "sdpa", cross: bool = False):
         super().__init__()
         self.d_model = d_model  # Embedding vecctor sized
         self.h = h   # number of heads
         # check if d_model is divisble by h to get h number of q,k,v
         assert d_model % h == 0, "d_model is not divisible by h"
         self.d_k = d_model // h # dimension of vector seen by each head d_model splits into h heads of dim d_k  SPLIT AXROSS DIM MEANS EAAVH HEAD WILL HABE AVESS TO EAVH SEQUENVE CUT A DIFF PART OF EMCEDDING
-        self.w_q = nn.Linear(d_model, d_model, bias = False)
-        self.w_k = nn.Linear(d_model, d_model, bias = False)
-        self.w_v = nn.Linear(d_model, d_model, bias = False)
+        # fused projections --> one GEMM reads the input once
+        #   self attention (cross=False)--> w_qkv: x --> [q | k | v]
+        #   cross attention (cross=True)--> w_q on the decoder side, w_kv: encoder_output --> [k | v]
+        # checkpoints with separate w_q / w_k / w_v are converted on load (_load_from_state_dict)
+        self.cross = cross
+        if cross:
+            self.w_q = nn.Linear(d_model, d_model, bias = False)
+            self.w_kv = nn.Linear(d_model, 2 * d_model, bias = False)
+        else:
+            self.w_qkv = nn.Linear(d_model, 3 * d_model, bias = False)
         self.w_o = nn.Linear(d_model, d_model, bias = False)
         self.dropout = nn.Dropout(dropout)
+        assert backend in ATTENTION_BACKENDS, f"unknown attention backend {backend}"
+        # the fused kernel needs torch >= 2.0, older versions fall back to the explicit path
+        self.backend = backend if hasattr(F, "scaled_dot_product_attention") else "math"
+        self.capture = None  # set by AttentionCapture --> called with the (batch, h, seq_len_q, seq_len_k) probabilities
 
     #defining the Attention Block
     @staticmethod
@@ -80,28 +144,67 @@ class MultiHeadAttentionBlock(nn.Module):
         #(batch, h, seq_len, d_k)-->  (batch, h, seq_len, d_k)
         attention_scores = (query @ key.transpose(-2, -1)) / math.sqrt(d_k)
         #attention_scores.shape = (batch, heads, seq_len_q, seq_len_k)
+        # mask fill + softmax in float32 --> -1e9 does not fit fp16, bf16 softmax loses precision
+        attention_scores = attention_scores.float()
         if mask is not None:
             attention_scores.masked_fill_(mask == 0, -1e9)
             """For all positions where the mask is 0 (e.g., padding or future tokens), it sets the corresponding score to -1e9 → so softmax ≈ 0"""
         attention_scores = attention_scores.softmax(dim=-1) #(batch, h, seq_len_q, seq_Len_k)  # across seq_len_k
         if dropout is not None:
             attention_scores = dropout(attention_scores)
-        return (attention_scores @ value), attention_scores
+        return (attention_scores.to(value.dtype) @ value), attention_scores
     """(Lq, Lv/Lk) @ (Lv, d_k) → (Lq, d_k)--> final shape of (attention_scores @ value)is  output.shape = (B, h, Lq, d_k)
 """
 
 
-    def forward(self, q, k, v, mask):
-        query = self.w_q(q) #(batch_Size, seq_len, d_model)-->(batch,seq_len,d_model) each token in q is multiplied to 512x512 dim matrix
-        key = self.w_k(k)
-        value = self.w_v(v)
-
+    def split_heads(self, x):
         #(batch, seq_len, d_model) --> (batch, h, seq_len, d_k)   #molar heads
-        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+        return x.view(x.shape[0], x.shape[1], self.h, self.d_k).transpose(1, 2)
+
+    def project_kv(self, x):
+        # cross attention: head split keys/values of the encoder output --> what an AttentionCache stores
+        key, value = self.w_kv(x).chunk(2, dim=-1)
+        return self.split_heads(key), self.split_heads(value)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fused layout (separate w_q / w_k / w_v) --> concatenated into w_qkv / w_kv
+        if prefix + "w_k.weight" in state_dict:
+            w_q, w_k, w_v = (state_dict.pop(prefix + f"w_{n}.weight") for n in "qkv")
+            if self.cross:
+                state_dict[prefix + "w_q.weight"] = w_q
+                state_dict[prefix + "w_kv.weight"] = torch.cat([w_k, w_v])
+            else:
+                state_dict[prefix + "w_qkv.weight"] = torch.cat([w_q, w_k, w_v])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, q, k, v, mask, cache: AttentionCache = None):
+        # self attention is always called with q = k = v = x, cross attention with k = v = encoder_output
+        if not self.cross:
+            query, key, value = (self.split_heads(t) for t in self.w_qkv(q).chunk(3, dim=-1))  # (batch, h, seq_len, d_k) each
+            if cache is not None:
+                # incremental decoding --> k, v only hold the new tokens, attend over everything cached so far
+                key, value = cache.update(key, value)
+        else:
+            query = self.split_heads(self.w_q(q)) #(batch_Size, seq_len, d_model)-->(batch,seq_len,d_model) each token in q is multiplied to 512x512 dim matrix
+            if cache is not None and cache.static and cache.key is not None:
+                # precomputed encoder keys/values --> k, v are not projected again
+                key, value = cache.key, cache.value
+            else:
+                key, value = self.project_kv(k)
+                if cache is not None:
+                    # first step --> the static cache keeps the projected encoder keys/values
+                    key, value = cache.update(key, value)
         # calculating attention score
-        x, self.attention_score = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if self.backend == "sdpa" and self.capture is None:
+            # fused kernel --> no (batch, h, seq_len_q, seq_len_k) probability tensor kept around, masks as bool (True = attend)
+            if mask is not None and mask.dtype != torch.bool:
+                mask = mask != 0
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask,
+                                               dropout_p=self.dropout.p if self.training else 0.0)
+        else:
+            x, attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+            if self.capture is not None:
+                self.capture(attention_scores)
         x = x.transpose(1, 2).contiguous().view(x.shape[0], -1, self.h * self.d_k)
         #(batch, h, seq_len, d_k)-transpose--> (batch, seq_len,h,d_k)--> batch,seq_len,d_model
         #.contiguous --> make sure that the tensors are contigous for .view
@@ -132,16 +235,25 @@ class EncoderBlock(nn.Module):
         #--> input x form multihead --> normalized --> feedforward_applied --> dropout-applied-->x added to residual
         return x
 
+def recompute(layer, i: int, every: int, *args):
+    # activation checkpointing of every `every`-th block (i % every == 0) while training: only the block input is kept,
+    # its activations are recomputed in backward. The RNG state is restored for the recompute --> same dropout masks
+    if every and i % every == 0 and layer.training and torch.is_grad_enabled():
+        return checkpoint(layer, *args, use_reentrant=False)
+    return layer(*args)
+
+
 class Encoder(nn.Module):
     def __init__(self, features: int, layers: nn.ModuleList):
         super().__init__()
         self.layers = layers # stacks encoder blocks
         #layers--> a list of EncoderBlock instances
         self.norm = LayerNormalization(features)
+        self.checkpoint_every = 0  # set_activation_checkpointing, 0--> off
     def forward(self, x, mask):
-        for layer in self.layers:
+        for i, layer in enumerate(self.layers):
             # passing input through each encoder block sequentially
-            x = layer(x, mask)
+            x = recompute(layer, i, self.checkpoint_every, x, mask)
         return self.norm(x)  #normalize for stability
 
 
@@ -152,10 +264,12 @@ class DecoderBlock(nn.Module):
         self.self_cross_attention_block = cross_attention_block
         self.feed_forward_block = feed_forward_block
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
+    def forward(self, x, encoder_output, src_mask, tgt_mask, self_cache: AttentionCache = None, cross_cache: AttentionCache = None):
         #src_mask for input lan, tgt_mask for tarkgeted language mask
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
-        x = self.residual_connections[1](x, lambda x: self.self_cross_attention_block(x,encoder_output, encoder_output, src_mask))
+        #self_cache--> self attention keys/values of the previous target tokens (incremental decoding)
+        #cross_cache--> keys/values of encoder_output, projected once per source sentence
+        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask, self_cache))
+        x = self.residual_connections[1](x, lambda x: self.self_cross_attention_block(x,encoder_output, encoder_output, src_mask, cross_cache))
         x = self.residual_connections[2](x, self.feed_forward_block)
         return x
 
@@ -165,9 +279,17 @@ class Decoder(nn.Module):
         #layer-->encoderblock
         self.layers = layers
         self.norm = LayerNormalization(features)
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, encoder_output, src_mask, tgt_mask)
+        self.checkpoint_every = 0  # set_activation_checkpointing, 0--> off
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache: DecoderCache = None):
+        for i, layer in enumerate(self.layers):
+            if cache is not None:
+                x = layer(x, encoder_output, src_mask, tgt_mask, cache.self_attn[i], cache.cross_attn[i])
+            else:
+                x = recompute(layer, i, self.checkpoint_every, x, encoder_output, src_mask, tgt_mask)
+        if cache is not None:
+            cache.length += x.shape[1]
+            if cache.positions is not None:
+                cache.positions = cache.positions + x.shape[1]
         return self.norm(x)
 
 
@@ -183,7 +305,8 @@ class ProjectionLayer(nn.Module):
 
 
 class Transformer(nn.Module):
-    def __init__(self, encoder: Encoder, decoder: Decoder, src_embed: InputEmbeddings, tgt_embd: InputEmbeddings,src_pos = PositionalEncoding, tgt_pos = PositionalEncoding, projection_layer = ProjectionLayer):
+    def __init__(self, encoder: Encoder, decoder: Decoder, src_embed: InputEmbeddings, tgt_embd: InputEmbeddings,src_pos = PositionalEncoding, tgt_pos = PositionalEncoding, projection_layer = ProjectionLayer,
+                 src_pad_id: int = None, tgt_pad_id: int = None):
        super().__init__()
        self.encoder = encoder
        self.decoder = decoder
@@ -192,6 +315,22 @@ class Transformer(nn.Module):
        self.src_pos = src_pos
        self.tgt_pos = tgt_pos
        self.projection_layer = projection_layer
+       # masks are derived from the token ids on the model's device --> the data pipeline only moves ids
+       self.src_pad_id = src_pad_id
+       self.tgt_pad_id = tgt_pad_id
+       # lower triangle (True = may attend) built once, sliced per batch, not part of the state_dict
+       self.register_buffer("causal", torch.ones(tgt_pos.seq_len, tgt_pos.seq_len, dtype=torch.bool).tril(), persistent=False)
+
+    def make_src_mask(self, src):
+        # (batch, src_len) ids --> (batch,1,1,src_len) bool, False on [PAD]
+        assert self.src_pad_id is not None, "build the model with src_pad_id to derive masks"
+        return (src != self.src_pad_id).unsqueeze(1).unsqueeze(2)
+
+    def make_tgt_mask(self, tgt):
+        # (batch, tgt_len) ids --> (batch,1,tgt_len,tgt_len) bool, no [PAD] keys and no future positions
+        assert self.tgt_pad_id is not None, "build the model with tgt_pad_id to derive masks"
+        size = tgt.size(1)
+        return (tgt != self.tgt_pad_id).unsqueeze(1).unsqueeze(2) & self.causal[:size, :size]
 
     def encode(self, src, src_mask):
         #(batch, seq_Len, d_model)
@@ -199,20 +338,110 @@ class Transformer(nn.Module):
         src = self.src_pos(src)
         return self.encoder(src, src_mask)
 
-    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor):
+    def new_cache(self):
+        return DecoderCache(len(self.decoder.layers))
+
+    def prepare_memory(self, encoder_output: torch.Tensor):
+        # cross attention keys/values of every decoder layer computed once per source sentence
+        # --> the returned cache is passed to all the decode steps of that sentence
+        cache = self.new_cache()
+        for layer, cross in zip(self.decoder.layers, cache.cross_attn):
+            cross.key, cross.value = layer.self_cross_attention_block.project_kv(encoder_output)
+        return cache
+
+    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor, cache: DecoderCache = None):
+        # with a cache--> tgt only holds the tokens not decoded yet (usually just the newest one),
+        # tgt_mask covers (new tokens, cached + new tokens) and can be None for a single token
+        start = 0
+        if cache is not None:
+            start = cache.positions if cache.positions is not None else cache.length
         tgt = self.tgt_embd(tgt)
-        tgt = self.tgt_pos(tgt)
-        return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+        tgt = self.tgt_pos(tgt, start)
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask, cache)
 
     def project(self, x):
         return self.projection_layer(x)
 
+    def forward(self, src, src_mask, tgt, tgt_mask):
+        # full teacher forced pass --> (batch, tgt_len, vocab) logits, the entry point DistributedDataParallel wraps
+        return self.project(self.decode(self.encode(src, src_mask), src_mask, tgt, tgt_mask))
+
 #defining build_transformer funtion
 
-def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int=512, N: int = 6, h=8, dropout: float= 0.1, d_ff:int = 2048):
+class AttentionCapture:
+    # opt in recording of attention probabilities, nothing is kept (or computed explicitly) outside the with block
+    #   with AttentionCapture(model, layers=[0, 1], heads=[0], to_cpu=True) as capture:
+    #       model.encode(...)
+    #   capture.maps[("encoder", 0)] --> (batch, len(heads), seq_len_q, seq_len_k) of the last forward of that block
+    # kinds--> "encoder" (self attention), "decoder" (self attention), "encoder-decoder" (cross attention)
+    # layers / heads--> indexes to record, None = all
+    def __init__(self, model, layers=None, heads=None, kinds=("encoder", "decoder", "encoder-decoder"), to_cpu: bool = False):
+        self.heads = heads
+        self.to_cpu = to_cpu
+        self.maps = {}
+        self.blocks = {}
+        for kind in kinds:
+            stack = model.encoder.layers if kind == "encoder" else model.decoder.layers
+            for i, layer in enumerate(stack):
+                if layers is None or i in layers:
+                    block = layer.self_cross_attention_block if kind == "encoder-decoder" else layer.self_attention_block
+                    self.blocks[(kind, i)] = block
+
+    def record(self, key, attention_scores):
+        scores = attention_scores.detach()
+        if self.heads is not None:
+            scores = scores[:, self.heads]
+        self.maps[key] = scores.cpu() if self.to_cpu else scores
+
+    def __enter__(self):
+        for key, block in self.blocks.items():
+            block.capture = lambda scores, key=key: self.record(key, scores)
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks.values():
+            block.capture = None
+        return False
+
+
+def quantize_dynamic_int8(model: nn.Module):
+    # every nn.Linear (w_qkv / w_q, w_kv, w_o, ffn linear_1/linear_2, vocab projection) --> int8 weights,
+    # activations quantized on the fly per batch, cpu only. Returns a quantized copy
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def set_activation_checkpointing(model: nn.Module, every: int):
+    # recompute the activations of every `every`-th encoder / decoder block in backward instead of storing them
+    # 1--> all blocks, 2--> blocks 0, 2, 4, ..., 0--> off
+    model.encoder.checkpoint_every = every
+    model.decoder.checkpoint_every = every
+
+
+def data_parallel(model: nn.Module):
+    # DistributedDataParallel wrapper for multi process training, gradients averaged across the ranks in backward
+    # buffers (positional encodings, causal mask) are constant --> not synced, gloo can't broadcast the bool mask anyway
+    from torch.nn.parallel import DistributedDataParallel
+    return DistributedDataParallel(model, broadcast_buffers=False)
+
+
+def set_attention_backend(model: nn.Module, backend: str):
+    # switch every attention block of a built model
+    for module in model.modules():
+        if isinstance(module, MultiHeadAttentionBlock):
+            assert backend in ATTENTION_BACKENDS, f"unknown attention backend {backend}"
+            module.backend = backend if hasattr(F, "scaled_dot_product_attention") else "math"
+
+
+def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int=512, N: int = 6, h=8, dropout: float= 0.1, d_ff:int = 2048, attention_backend: str = "sdpa",
+                      src_pad_id: int = None, tgt_pad_id: int = None, tie_weights: bool = False):
+    # tie_weights--> one joint vocabulary (config shared_vocab), src embedding, tgt embedding and projection share
+    # a single (vocab, d_model) matrix --> stored, optimized and initialized once
     #embedding layer
     src_embed = InputEmbeddings(d_model, src_vocab_size)
     tgt_embed = InputEmbeddings(d_model, tgt_vocab_size)
+    if tie_weights:
+        assert src_vocab_size == tgt_vocab_size, "tied weights need one shared vocabulary"
+        tgt_embed.embedding.weight = src_embed.embedding.weight
     #positional encoding layer
     src_pos = PositionalEncoding(d_model, src_seq_len, dropout)
     tgt_pos = PositionalEncoding(d_model, tgt_seq_len, dropout)
@@ -220,7 +449,7 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     #defining the encoder block 6 in this case N=6
     encoder_blocks = []
     for _ in range(N):
-        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
         encoder_block = EncoderBlock(d_model, encoder_self_attention_block, feed_forward_block, dropout)
         encoder_blocks.append(encoder_block)
@@ -228,8 +457,8 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     # decoder blocks
     decoder_blocks = []
     for _ in range(N):
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
-        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
+        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, cross=True)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
         decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block,feed_forward_block, dropout)
         decoder_blocks.append(decoder_block)
@@ -238,9 +467,11 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     decoder = Decoder(d_model, nn.ModuleList(decoder_blocks))
     # creating projection layer
     projection_layer = ProjectionLayer(d_model, tgt_vocab_size)
+    if tie_weights:
+        projection_layer.proj.weight = tgt_embed.embedding.weight  # nn.Linear weight is (out=vocab, in=d_model) too
     # creating transformer
-    transformer = Transformer(encoder, decoder, src_embed, tgt_embed, src_pos, tgt_pos, projection_layer)
-    # parameter initialization
+    transformer = Transformer(encoder, decoder, src_embed, tgt_embed, src_pos, tgt_pos, projection_layer, src_pad_id, tgt_pad_id)
+    # parameter initialization (parameters() yields a shared weight once)
     for p in transformer.parameters():
         if p.dim() > 1:
             nn.init.xavier_uniform_(p)
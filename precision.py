@@ -0,0 +1,24 @@
+import contextlib
+import torch
+
+# config["precision"] --> dtype autocast runs the matmuls in, weights / optimizer state stay float32
+#   "fp32"--> no autocast
+#   "bf16"--> autocast on cpu and cuda, same exponent range as fp32 --> no loss scaling
+#   "fp16"--> autocast on cuda only, gradients need a GradScaler against underflow
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(precision: str, device):
+    # context for model.encode / decode / project and the loss
+    assert precision in PRECISIONS, f"unknown precision {precision}"
+    device_type = torch.device(device).type
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError("fp16 autocast needs a cuda device, use bf16 on cpu")
+    return torch.autocast(device_type=device_type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(precision: str, device):
+    # disabled for fp32 / bf16 --> scale(), step(), update() just pass through
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16" and torch.device(device).type == "cuda")
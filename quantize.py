@@ -0,0 +1,47 @@
+
+# dynamic int8 export of a trained checkpoint for cpu inference
+# Usage:
+#   python quantize.py                                   (best checkpoint --> int8_tmodel_best.pt in the model folder)
+#   python quantize.py --epoch 07
+#   python quantize.py --checkpoint some.pt --out some_int8.pt
+# the export loads like any checkpoint --> Translator(checkpoint=...), bulk_translate.py / serve.py --checkpoint
+# size / latency / BLEU report --> python -m benchmarks.quantization
+import argparse
+import torch
+
+from config import get_config, get_weights_file_path, get_quantized_file_path
+from model import quantize_dynamic_int8
+from checkpoints import load_checkpoint
+from translate import Translator
+
+
+def export_quantized(config, checkpoint: str, out: str):
+    translator = Translator(config, checkpoint=checkpoint, device="cpu")
+    state = load_checkpoint(checkpoint)
+    quantized = quantize_dynamic_int8(translator.model)
+    torch.save({
+        'epoch': state.get('epoch'),
+        'global_step': state.get('global_step'),
+        'model_state_dict': quantized.state_dict(),
+        'quantization': 'dynamic_int8',
+        'source_checkpoint': str(checkpoint),
+    }, out)
+    return quantized
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--epoch", default="best", help="checkpoint of get_weights_file_path to export")
+    parser.add_argument("--checkpoint", default=None, help="explicit checkpoint path instead of --epoch")
+    parser.add_argument("--out", default=None, help="default: int8_<model_basename><epoch>.pt next to the checkpoints")
+    args = parser.parse_args()
+
+    config = get_config()
+    checkpoint = args.checkpoint or get_weights_file_path(config, args.epoch)
+    out = args.out or get_quantized_file_path(config, args.epoch)
+    export_quantized(config, checkpoint, out)
+    print(f"int8 model written to {out}")
+
+
+if __name__ == "__main__":
+    main()
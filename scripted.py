@@ -0,0 +1,76 @@
+import json
+import zipfile
+import torch
+
+from model import DecoderCache
+
+# runtime side of export_torchscript.py --> the traced encoder / decode step behind the Transformer methods the
+# decoders use (make_src_mask, encode, prepare_memory, decode with a cache, project), no nn.Module code involved
+# greedy_decode, beam_search, Translator.stream_ids and serve.py's ContinuousBatcher run on it unchanged
+
+
+def is_torchscript(path) -> bool:
+    # torch.jit.save archives carry the generated code next to the weights, torch.save checkpoints don't
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any("/code/" in name for name in archive.namelist())
+
+
+class ScriptedTransformer:
+    def __init__(self, path, device="cpu"):
+        extra = {"meta.json": ""}
+        self.module = torch.jit.load(str(path), map_location=device, _extra_files=extra)
+        self.module.eval()
+        self.meta = json.loads(extra["meta.json"])
+        self.device = torch.device(device)
+        self.src_pad_id = self.meta["src_pad_id"]
+        self.num_layers = self.meta["num_layers"]
+
+    def eval(self):
+        return self
+
+    def make_src_mask(self, src):
+        return (src != self.src_pad_id).unsqueeze(1).unsqueeze(2)
+
+    def encode(self, src, src_mask):
+        return self.module.encode(src, src_mask)
+
+    def new_cache(self):
+        return DecoderCache(self.num_layers)
+
+    def prepare_memory(self, encoder_output):
+        cache = self.new_cache()
+        keys, values = self.module.memory(encoder_output)
+        for cross, key, value in zip(cache.cross_attn, keys, values):
+            cross.key, cross.value = key, value
+        return cache
+
+    def decode(self, encoder_output, src_mask, tgt, tgt_mask, cache: DecoderCache):
+        # only the cached (incremental) decode is exported, encoder_output is already in cache.cross_attn
+        assert cache is not None, "the scripted model only runs cached decode steps"
+        batch = tgt.size(0)
+        if cache.self_attn[0].key is None:
+            # first step --> empty (batch, h, 0, d_k) history
+            empty = torch.zeros(batch, self.meta["h"], 0, self.meta["d_k"], device=tgt.device)
+            for c in cache.self_attn:
+                c.key = c.value = empty
+        if tgt_mask is None:
+            tgt_mask = torch.ones(batch, 1, tgt.size(1), cache.self_attn[0].key.size(2) + tgt.size(1),
+                                  dtype=torch.bool, device=tgt.device)
+        positions = cache.positions
+        if positions is None:
+            positions = torch.full((batch,), cache.length, dtype=torch.long, device=tgt.device)
+        out, keys, values = self.module.decode_step(
+            tgt, positions, src_mask, tgt_mask,
+            tuple(c.key for c in cache.cross_attn), tuple(c.value for c in cache.cross_attn),
+            tuple(c.key for c in cache.self_attn), tuple(c.value for c in cache.self_attn))
+        for c, key, value in zip(cache.self_attn, keys, values):
+            c.key, c.value = key, value
+        cache.length += tgt.size(1)
+        if cache.positions is not None:
+            cache.positions = cache.positions + tgt.size(1)
+        return out
+
+    def project(self, x):
+        return self.module.project(x)
@@ -0,0 +1,326 @@
+
+# local asyncio translation server with iteration level continuous batching
+# Usage:
+#   python serve.py --port 8000 --max_batch_size 32 --max_queue_delay_ms 5
+#   curl -X POST localhost:8000/translate -d '{"text": "I am not a very good student."}'
+#   curl localhost:8000/metrics
+# every decode step runs one forward pass for all the sentences in flight: new requests join the running batch at
+# the next step, finished sentences leave it right away --> a long sentence never holds back the short ones
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from translate import Translator, detokenize
+
+
+class Request:
+    def __init__(self, text: str):
+        self.text = text
+        self.future = asyncio.get_running_loop().create_future()
+        self.arrived = time.perf_counter()
+        self.joined = None  # time the request entered the decode batch
+        self.ids = []  # generated token ids
+
+
+class ServerMetrics:
+    # latency of the last `window` requests + running counters
+    def __init__(self, window: int = 10000):
+        self.latency = deque(maxlen=window)
+        self.queue_wait = deque(maxlen=window)
+        self.started = time.perf_counter()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.tokens = 0
+        self.steps = 0
+        self.rows_stepped = 0  # sum of the batch size over all the steps
+
+    def record(self, request: Request):
+        now = time.perf_counter()
+        self.latency.append(now - request.arrived)
+        self.queue_wait.append(request.joined - request.arrived)
+        self.completed += 1
+        self.tokens += len(request.ids)
+
+    @staticmethod
+    def percentile(values, q):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def summary(self, active: int, queued: int):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "active": active,
+            "queued": queued,
+            "latency_p50_ms": self.percentile(self.latency, 0.5) * 1000,
+            "latency_p99_ms": self.percentile(self.latency, 0.99) * 1000,
+            "queue_wait_p50_ms": self.percentile(self.queue_wait, 0.5) * 1000,
+            "requests_per_sec": self.completed / elapsed,
+            "tokens_per_sec": self.tokens / elapsed,
+            "mean_batch_size": self.rows_stepped / self.steps if self.steps else 0.0,
+        }
+
+
+def pad_dim(x, length: int, dim: int):
+    # zero pad dimension dim of x (on the right) up to length
+    missing = length - x.size(dim)
+    if missing <= 0:
+        return x
+    return F.pad(x, [0, 0] * (x.dim() - dim - 1) + [0, missing])
+
+
+class ContinuousBatcher:
+    # owns the running decode batch, only touched from its single worker thread
+    #   cache.self_attn --> (rows, h, T, d_k) left padded, self_mask (rows,1,1,T) marks the real history slots
+    #   cache.cross_attn --> (rows, h, S, d_k) right padded, src_mask (rows,1,1,S)
+    #   cache.positions --> (rows,) position of the next token of every row
+    def __init__(self, translator: Translator, max_batch_size: int = 32, max_queue_delay: float = 0.005,
+                 max_queue: int = 256):
+        self.translator = translator
+        self.model = translator.model
+        self.device = translator.device
+        self.max_batch_size = max_batch_size
+        self.max_queue_delay = max_queue_delay
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.metrics = ServerMetrics()
+        self.rows = []
+        self.cache = None
+        self.src_mask = None
+        self.self_mask = None
+        self.last = None
+        self.steps = None
+
+    def submit(self, text: str):
+        # raises asyncio.QueueFull when max_queue requests are already waiting (backpressure)
+        request = Request(text)
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            raise
+        return request
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            new = []
+            if not self.rows:
+                # idle --> wait for a request, then up to max_queue_delay for others to batch with it
+                new.append(await self.queue.get())
+                deadline = loop.time() + self.max_queue_delay
+                while len(new) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        new.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            # running --> whatever is queued joins at this step, up to max_batch_size rows
+            while len(self.rows) + len(new) < self.max_batch_size and not self.queue.empty():
+                new.append(self.queue.get_nowait())
+
+            try:
+                finished = await loop.run_in_executor(self.executor, self.step, new)
+            except Exception as e:
+                # the requests of the failed step get the error, the engine keeps serving the next ones
+                # (a step that failed half way leaves the batch state unusable --> every row in flight is dropped)
+                for request in self.rows + [r for r in new if r not in self.rows]:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                        self.metrics.failed += 1
+                self.clear()
+                continue
+            for request in finished:
+                if not request.future.done():
+                    ids = [self.translator.sos_tgt] + request.ids
+                    request.future.set_result(detokenize(self.translator.tok_tgt, ids, self.translator.eos_tgt))
+                    self.metrics.record(request)
+
+    def join(self, new):
+        # encode the new sources and append their rows to the running batch
+        model = self.model
+        source, src_mask = self.translator.encode_sources([r.text for r in new])
+        cache = model.prepare_memory(model.encode(source, src_mask))
+        n = len(new)
+        cache.positions = torch.zeros(n, dtype=torch.long, device=self.device)
+        last = torch.full((n, 1), self.translator.sos_tgt, dtype=torch.long, device=self.device)
+        steps = torch.zeros(n, dtype=torch.long, device=self.device)
+        now = time.perf_counter()
+        for r in new:
+            r.joined = now
+
+        if not self.rows:
+            self.cache, self.src_mask, self.last, self.steps = cache, src_mask, last, steps
+            self.self_mask = torch.zeros(n, 1, 1, 0, dtype=torch.bool, device=self.device)
+            self.rows = list(new)
+            return
+
+        history = self.self_mask.size(-1)
+        src_len = max(self.src_mask.size(-1), src_mask.size(-1))
+        for old in self.cache.self_attn:
+            # new rows have no history yet --> all zero, masked slots (their own tokens get appended at the end)
+            empty = old.key.new_zeros(n, *old.key.shape[1:])
+            old.key = torch.cat([old.key, empty])
+            old.value = torch.cat([old.value, empty])
+        for old, c in zip(self.cache.cross_attn, cache.cross_attn):
+            old.key = torch.cat([pad_dim(old.key, src_len, 2), pad_dim(c.key, src_len, 2)])
+            old.value = torch.cat([pad_dim(old.value, src_len, 2), pad_dim(c.value, src_len, 2)])
+        self.cache.positions = torch.cat([self.cache.positions, cache.positions])
+        self.src_mask = torch.cat([pad_dim(self.src_mask, src_len, 3), pad_dim(src_mask, src_len, 3)])
+        self.self_mask = torch.cat([self.self_mask, self.self_mask.new_zeros(n, 1, 1, history)])
+        self.last = torch.cat([self.last, last])
+        self.steps = torch.cat([self.steps, steps])
+        self.rows.extend(new)
+
+    def step(self, new):
+        # one decode step for every row in flight, returns the requests that finished
+        translator = self.translator
+        with torch.no_grad(), translator.autocast():
+            if new:
+                self.join(new)
+            # the token decoded now may attend to the real history of its row + itself
+            mask = torch.cat([self.self_mask, self.self_mask.new_ones(len(self.rows), 1, 1, 1)], dim=-1)
+            # cross attention reads the cached encoder keys/values, no encoder_output needed
+            out = self.model.decode(None, self.src_mask, self.last, mask, self.cache)
+            logits = self.model.project(out[:, -1])
+            logits[self.steps < translator.min_len, translator.eos_tgt] = float('-inf')  # prevent early EOS
+            next_ids = torch.argmax(logits, dim=-1)
+            self.self_mask = mask
+            self.steps = self.steps + 1
+            self.last = next_ids.unsqueeze(1)
+            self.metrics.steps += 1
+            self.metrics.rows_stepped += len(self.rows)
+
+            done = (next_ids == translator.eos_tgt) | (self.steps + 1 >= translator.seq_len)
+            finished = []
+            for i, (request, next_id) in enumerate(zip(self.rows, next_ids.tolist())):
+                if next_id != translator.eos_tgt:
+                    request.ids.append(next_id)
+                if request.future.done():
+                    done[i] = True  # client went away (cancelled) --> stop decoding it
+                if done[i]:
+                    finished.append(request)
+            if finished:
+                self.remove(done)
+        return finished
+
+    def clear(self):
+        self.rows = []
+        self.cache = self.src_mask = self.self_mask = self.last = self.steps = None
+
+    def remove(self, done):
+        keep = (~done).nonzero(as_tuple=True)[0]
+        self.rows = [self.rows[i] for i in keep.tolist()]
+        if not self.rows:
+            self.clear()
+            return
+        self.cache.index_select(keep)
+        self.src_mask, self.self_mask = self.src_mask[keep], self.self_mask[keep]
+        self.last, self.steps = self.last[keep], self.steps[keep]
+        # history slots no remaining row uses (left padding of rows that already left) are dropped
+        first = int(self.self_mask.reshape(len(self.rows), -1).any(dim=0).int().argmax())
+        if first > 0:
+            for c in self.cache.self_attn:
+                c.key, c.value = c.key[:, :, first:], c.value[:, :, first:]
+            self.self_mask = self.self_mask[..., first:]
+
+
+class TranslationServer:
+    # minimal HTTP/1.1 on top of asyncio streams (one request per connection)
+    #   POST /translate {"text": ...} --> {"translation": ..., "latency_ms": ..., "queue_ms": ..., "tokens": ...}
+    #   GET /metrics --> ServerMetrics.summary()
+    def __init__(self, batcher: ContinuousBatcher):
+        self.batcher = batcher
+
+    async def handle(self, reader, writer):
+        status, payload = 200, {}
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode().split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "POST" and path == "/translate":
+                text = json.loads(body)["text"]
+                # checked here, a text the tokenizer rejects would only fail later on the engine thread
+                if not isinstance(text, str) or not text.strip():
+                    raise ValueError("text must be a non empty string")
+                try:
+                    request = self.batcher.submit(text)
+                    translation = await request.future
+                except asyncio.QueueFull:
+                    status, payload = 503, {"error": "server busy, retry later"}
+                except Exception:
+                    # the engine failed the step this request was decoded in
+                    status, payload = 500, {"error": "translation failed"}
+                else:
+                    payload = {
+                        "translation": translation,
+                        "latency_ms": (time.perf_counter() - request.arrived) * 1000,
+                        "queue_ms": (request.joined - request.arrived) * 1000,
+                        "tokens": len(request.ids),
+                    }
+            elif method == "GET" and path == "/metrics":
+                payload = self.batcher.metrics.summary(len(self.batcher.rows), self.batcher.queue.qsize())
+            else:
+                status, payload = 404, {"error": "not found"}
+        except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError):
+            status, payload = 400, {"error": "bad request"}
+
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+                  503: "Service Unavailable"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int, translator: Translator, max_batch_size: int, max_queue_delay: float,
+                max_queue: int):
+    batcher = ContinuousBatcher(translator, max_batch_size, max_queue_delay, max_queue)
+    server = await asyncio.start_server(TranslationServer(batcher).handle, host, port)
+    print(f"serving on http://{host}:{port} (max batch {max_batch_size}, max queue delay {max_queue_delay * 1000:.1f}ms)")
+    engine = asyncio.create_task(batcher.run())
+    async with server:
+        await asyncio.gather(server.serve_forever(), engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="continuous batching translation server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=32, help="sentences decoded together per step")
+    parser.add_argument("--max_queue_delay_ms", type=float, default=5.0,
+                        help="when idle, how long the first request waits for others to batch with")
+    parser.add_argument("--max_queue", type=int, default=256, help="waiting requests before answering 503")
+    parser.add_argument("--checkpoint", default=None, help="default: latest checkpoint of the config")
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+    translator = Translator(checkpoint=args.checkpoint, device=args.device)
+    asyncio.run(serve(args.host, args.port, translator, args.max_batch_size, args.max_queue_delay_ms / 1000,
+                      args.max_queue))
+
+
+if __name__ == "__main__":
+    main()
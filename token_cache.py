@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+
+from config import get_tokenizer_file_path
+
+# one time pre tokenized copy of the dataset:
+# <data_source>_<token_cache_folder>/<key>/
+#   {src,tgt}_ids.bin       --> int32 token ids of every sentence back to back
+#   {src,tgt}_offsets.bin   --> int64, sentence i = ids[offsets[i]:offsets[i+1]]
+#   {src,tgt}_text.bin      --> utf-8 bytes of the raw sentences (same offsets layout in *_text_offsets.bin)
+#   meta.json               --> number of rows + length statistics
+# key--> hash of both tokenizer files + the dataset part of the config, a retrained tokenizer gets a new cache
+SIDES = ("src", "tgt")
+
+
+def token_cache_key(config):
+    h = hashlib.sha256()
+    for lang in (config['lang_src'], config['lang_tgt']):
+        h.update(Path(get_tokenizer_file_path(config, lang)).read_bytes())
+    h.update(json.dumps({k: config[k] for k in ("data_source", "lang_src", "lang_tgt")}, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def token_cache_path(config):
+    # None while the tokenizers are not trained yet (nothing to hash)
+    if not all(Path(get_tokenizer_file_path(config, lang)).exists() for lang in (config['lang_src'], config['lang_tgt'])):
+        return None
+    return Path(f"{config['data_source']}_{config['token_cache_folder']}") / token_cache_key(config)
+
+
+class TokenCache:
+    # memory mapped view of a built cache, rows look like the HF dataset rows + the token ids
+    def __init__(self, path, src_lang: str, tgt_lang: str):
+        self.path = Path(path)
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+        self.meta = json.loads((self.path / "meta.json").read_text())
+        self.arrays = {}
+        for side in SIDES:
+            self.arrays[f"{side}_ids"] = np.memmap(self.path / f"{side}_ids.bin", dtype=np.int32, mode="r")
+            self.arrays[f"{side}_offsets"] = np.fromfile(self.path / f"{side}_offsets.bin", dtype=np.int64)
+            self.arrays[f"{side}_text"] = np.memmap(self.path / f"{side}_text.bin", dtype=np.uint8, mode="r")
+            self.arrays[f"{side}_text_offsets"] = np.fromfile(self.path / f"{side}_text_offsets.bin", dtype=np.int64)
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def ids(self, side: str, idx: int):
+        offsets = self.arrays[f"{side}_offsets"]
+        return self.arrays[f"{side}_ids"][offsets[idx]:offsets[idx + 1]]
+
+    def text(self, side: str, idx: int):
+        offsets = self.arrays[f"{side}_text_offsets"]
+        return self.arrays[f"{side}_text"][offsets[idx]:offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def lengths(self, side: str):
+        # number of tokens of every sentence (no [SOS]/[EOS]), without touching the ids
+        return np.diff(self.arrays[f"{side}_offsets"])
+
+    def __getitem__(self, idx):
+        return {
+            "translation": {self.src_lang: self.text("src", idx), self.tgt_lang: self.text("tgt", idx)},
+            "src_ids": self.ids("src", idx),
+            "tgt_ids": self.ids("tgt", idx),
+        }
+
+
+def _write_side(path, side, texts, tokenizer, chunk_size=1000):
+    ids, lengths = [], []
+    for start in range(0, len(texts), chunk_size):
+        for enc in tokenizer.encode_batch(texts[start:start + chunk_size]):
+            ids.append(np.asarray(enc.ids, dtype=np.int32))
+            lengths.append(len(enc.ids))
+    np.concatenate(ids or [np.zeros(0, dtype=np.int32)]).tofile(path / f"{side}_ids.bin")
+    np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64).tofile(path / f"{side}_offsets.bin")
+    encoded = [t.encode("utf-8") for t in texts]
+    np.frombuffer(b"".join(encoded), dtype=np.uint8).tofile(path / f"{side}_text.bin")
+    np.concatenate([[0], np.cumsum([len(b) for b in encoded], dtype=np.int64)]).astype(np.int64).tofile(path / f"{side}_text_offsets.bin")
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return {
+        "max_len": int(lengths.max()) if len(lengths) else 0,
+        "mean_len": float(lengths.mean()) if len(lengths) else 0.0,
+        "p99_len": int(np.percentile(lengths, 99)) if len(lengths) else 0,
+    }
+
+
+def build_token_cache(ds_raw, tokenizer_src, tokenizer_tgt, config, path):
+    # single pass over the raw dataset, written to <path>.tmp and renamed --> a crash never leaves a half built cache
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    src_texts = [item['translation'][config['lang_src']] for item in ds_raw]
+    tgt_texts = [item['translation'][config['lang_tgt']] for item in ds_raw]
+    meta = {"num_rows": len(src_texts)}
+    meta["src"] = _write_side(tmp, "src", src_texts, tokenizer_src)
+    meta["tgt"] = _write_side(tmp, "tgt", tgt_texts, tokenizer_tgt)
+    (tmp / "meta.json").write_text(json.dumps(meta, indent=2))
+    os.replace(tmp, path)
+
+
+def get_or_build_token_cache(config, tokenizer_src, tokenizer_tgt, ds_raw=None):
+    # ds_raw only needed (and loaded here when None) the first time for a given key
+    path = token_cache_path(config)
+    if path is None:
+        # the cache is keyed by the tokenizer files, e.g. a bundle checkpoint carries its tokenizers without them
+        files = [get_tokenizer_file_path(config, lang) for lang in (config['lang_src'], config['lang_tgt'])]
+        raise FileNotFoundError(f"the token cache (numeric dataset indices) needs the trained tokenizer files "
+                                f"{' / '.join(sorted(set(files)))}, run training once to build them")
+    if not (path / "meta.json").exists():
+        if ds_raw is None:
+            from datasets import load_dataset
+            ds_raw = load_dataset(f"{config['data_source']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+        print(f"Building token cache: {path}")
+        build_token_cache(ds_raw, tokenizer_src, tokenizer_tgt, config, path)
+    return TokenCache(path, config['lang_src'], config['lang_tgt'])
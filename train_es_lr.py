@@ -1,65 +1,36 @@
 import torch.cuda
 from datasets import load_dataset
 import torch.nn as nn
-from model import build_transformer
-from tokenizers import Tokenizer
-from tokenizers.models import WordLevel
-from tokenizers.trainers import WordLevelTrainer
-from tokenizers.pre_tokenizers import Whitespace
+from model import build_transformer, set_activation_checkpointing, data_parallel
+from tokenizers import Tokenizer, decoders
+from tokenizers.models import WordLevel, BPE, Unigram
+from tokenizers.trainers import WordLevelTrainer, BpeTrainer, UnigramTrainer
+from tokenizers.pre_tokenizers import Whitespace, Metaspace
 from pathlib import Path
-from dataset import BilingualDataset, causal_mask
-from torch.utils.data import Dataset, DataLoader, random_split
-from config import get_config, get_weights_file_path, latest_weights_file_path
+from dataset import BilingualDataset, PadCollate, LengthBucketSampler, padding_report
+from token_cache import token_cache_path, get_or_build_token_cache
+from torch.utils.data import Dataset, DataLoader, random_split, DistributedSampler
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from config import get_config, get_weights_file_path, latest_weights_file_path, get_tokenizer_file_path
+from checkpoints import CheckpointWriter
+from instrumentation import MetricBuffer, StepTimer, TokenCounter, peak_memory_mb, profile
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
-import torchmetrics
+from evaluation import StreamingMetrics, teacher_forced_loss, decode_batches
+from precision import autocast, grad_scaler
+import numpy as np
 import warnings
 import os
-
-
-# validation code
-def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device):
-    # autoregressive inference logic
-    # will generate a target sequence, one token at a time
-    # purpose-> generates output translation from a source sequence using Transformer model
-    # getting index of start of sent and end of sent
-    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
-    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
-    # encoder output->runs once to to get contextual representation of input sentence
-    encoder_output = model.encode(source, source_mask)
-    # adding sos token to decoder input (autoregression-->right shift operation)
-    decoder_input = torch.empty(1, 1).fill_(sos_idx).type_as(source).to(
-        device)  # tensor ready to be passed as input to the decoder
-    # loop until decoder reaches the max_len or [EOS] is encountered
-    while True:
-        if decoder_input.size(1) == max_len:
-            break
-            # mask for target
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-        # output
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
-        # next token
-        prob = model.project(
-            out[:, -1])  # generate(last decoder ts output)->project to vocb space->prob(logits for next token pred)
-        _, next_word = torch.max(prob, dim=1)  # next_word-->max_prob
-        decoder_input = torch.cat(
-            [decoder_input, torch.empty(1, 1).type_as(source).fill_(next_word.item()).to(device)], dim=1
-        )  # add this next_word to decoder output
-        if next_word == eos_idx:
-            break
-    return decoder_input.squeeze(0)
+import argparse
 
 
 # model evaluation
 
 def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer,
-                   num_examples=None):  # default: use entire validation set
-    model.eval()
-    count = 0
-    source_texts = []
-    expected = []
-    predicted = []
-
+                   num_examples: int = 2, precision: str = "fp32", max_sentences: int = None):
+    # batched greedy decode of up to max_sentences validation sentences (None--> all of them)
+    # --> CER / WER / BLEU accumulated batch by batch (evaluation.StreamingMetrics), the first num_examples printed
     try:
         with os.popen('stty size', 'r') as console:
             _, console_width = console.read().split()
@@ -67,79 +38,87 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
     except:
         console_width = 80
 
-    with torch.no_grad():
-        for batch in validation_ds:
-            count += 1
-            encoder_input = batch["encoder_input"].to(device)
-            encoder_mask = batch["encoder_mask"].to(device)
-
-            assert encoder_input.size(0) == 1  # validation batch size must be 1 for greedy decode
-            model_out = greedy_decode(
-                model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device
-            )
-
-            source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
-
-            source_texts.append(source_text)
-            expected.append(target_text)
-            predicted.append(model_out_text)
-
+    metrics = StreamingMetrics()
+    for sources, expected, predicted in decode_batches(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
+                                                       device, precision, max_sentences):
+        for i, (source_text, target_text, model_out_text) in enumerate(zip(sources, expected, predicted)):
+            if metrics.sentences + i >= num_examples:  # metrics.sentences only counts the previous batches
+                break
             print_msg('-' * console_width)
             print_msg(f"{f'source: ':>12}{source_text}")
             print_msg(f"{f'target: ':>12}{target_text}")
             print_msg(f"{f'predicted: ':>12}{model_out_text}")
-
-            # Only stop early if a cap was explicitly provided
-            if num_examples is not None and count >= num_examples:
-                print_msg('-' * console_width)
-                break
-
-
+        metrics.update(predicted, expected)
+    print_msg('-' * console_width)
+
+    scores = metrics.compute()
+    # char error rate (character level mistakes), word error rate (word level mistakes),
+    # bleu (n-gram overlap of predicted and reference sentence)
+    print_msg(" ".join(f"{name.upper()} {value:.4f}" for name, value in scores.items()) +
+              f" ({metrics.sentences} sentences)")
     if writer:
-        # evaluate char error rate
-        # for character level mistakes
-        cer_metric = torchmetrics.CharErrorRate()
-        cer = cer_metric(predicted, expected)
-        writer.add_scalar('validation/CER', cer, global_step)
+        for name, value in scores.items():
+            writer.add_scalar(f'validation/{name.upper()}', value, global_step)
         writer.flush()
+    return scores
 
-    # word error rate
-    # for word level mistakes
 
-    wer_metric = torchmetrics.WordErrorRate()
 
-    wer = wer_metric(predicted, expected)
-    writer.add_scalar('validation/WER', wer, global_step)
-    writer.flush()
 
-    # bleu score
-    # comparison of n-gram between predicted and reference sent
-    bleu_metric = torchmetrics.BLEUScore()
-    expected_bleu = [[t] for t in expected]  # nested
-    bleu = bleu_metric(predicted, expected_bleu)
-    writer.add_scalar('validation/BLEU', bleu, global_step)
-    writer.flush()
+def get_all_sentences(ds, lang):
+    for item in ds:
+        yield item['translation'][lang]  # hf ds --> dict , get a specific sent in specific lang
 
 
+def get_sentence_batches(ds, langs, batch_size: int = 1000):
+    # lists of sentences for train_from_iterator --> streamed from the dataset, never all in memory at once
+    batch = []
+    for lang in langs:
+        for sentence in get_all_sentences(ds, lang):
+            batch.append(sentence)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def new_tokenizer(config):
+    # untrained tokenizer + trainer of config["tokenizer_type"]
+    # special tokens first in every trainer --> [UNK]=0 [PAD]=1 [SOS]=2 [EOS]=3 whatever the type
+    special_tokens = ["[UNK]", "[PAD]", "[SOS]", "[EOS]"]
+    kind = config['tokenizer_type']
+    if kind == "wordlevel":
+        tokenizer = Tokenizer(WordLevel(unk_token="[UNK]"))  # New wordlevel tokenizer with ["UNK"]
+        tokenizer.pre_tokenizer = Whitespace()  # splitting criteria
+        return tokenizer, WordLevelTrainer(special_tokens=special_tokens, min_frequency=2)
+    if kind == "bpe":
+        tokenizer = Tokenizer(BPE(unk_token="[UNK]"))
+        trainer = BpeTrainer(vocab_size=config['vocab_size'], special_tokens=special_tokens, min_frequency=2)
+    elif kind == "unigram":
+        tokenizer = Tokenizer(Unigram())
+        trainer = UnigramTrainer(vocab_size=config['vocab_size'], special_tokens=special_tokens, unk_token="[UNK]")
+    else:
+        raise ValueError(f"unknown tokenizer_type {kind!r}, expected wordlevel, bpe or unigram")
+    # subwords--> spaces kept as the ▁ word start marker, the Metaspace decoder puts them back on decode()
+    tokenizer.pre_tokenizer = Metaspace()
+    tokenizer.decoder = decoders.Metaspace()
+    return tokenizer, trainer
 
 
-def get_all_sentences(ds, lang):
-    for item in ds:
-        yield item['translation'][lang]  # hf ds --> dict , get a specific sent in specific lang
+def train_tokenizer(config, ds, langs):
+    tokenizer, trainer = new_tokenizer(config)
+    # proceses each sent->split it into tokens-> counts word / subword freq->Builds vocab-> TRAINS TOKENIZER
+    tokenizer.train_from_iterator(get_sentence_batches(ds, langs), trainer=trainer, length=len(ds) * len(langs))
+    return tokenizer
 
 
 def get_or_build_tokenizer(config, ds, lang):
-    tokenizer_path = Path(config['tokenizer_file'].format(lang))  # path to tokenizer
+    tokenizer_path = Path(get_tokenizer_file_path(config, lang))  # path to tokenizer
     if not Path.exists(tokenizer_path):
-        tokenizer = Tokenizer(WordLevel(unk_token="[UNK]"))  # New wordlevel tokenizer with ["UNK"]
-        tokenizer.pre_tokenizer = Whitespace()  # splitting criteria
-        trainer = WordLevelTrainer(special_tokens=["[UNK]", "[PAD]", "[SOS]", "[EOS]"],
-                                   min_frequency=2)  # setting up the trainer
-        tokenizer.train_from_iterator(get_all_sentences(ds, lang),
-                                      trainer=trainer)  # training a tokenizer from an iterable source of data
-        # proceses each sent->split it into tokens-> counts word freq->Builds vocab-> TRAINS TOKENIZER
+        # shared_vocab--> one joint tokenizer trained on the sentences of both languages
+        langs = (config['lang_src'], config['lang_tgt']) if config['shared_vocab'] else (lang,)
+        tokenizer = train_tokenizer(config, ds, langs)
         tokenizer.save(str(tokenizer_path))
     else:
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
@@ -150,85 +129,147 @@ def get_or_build_tokenizer(config, ds, lang):
 # tokenizer--> an instance or object
 
 # config--> {datasource, lang_src, lang_tgt, tokenizer_file}
-def get_ds(config):
-    ds_raw = load_dataset(f"{config['data_source']}", f"{config['lang_src']}-{config['lang_tgt']}",
-                          split='train')  # loading ds from hf (only train data -> further spit to train and val)
+def get_ds(config, rank: int = 0, world_size: int = 1):
+    # rank / world_size--> distributed training, every rank gets its own share of the training batches
+    # the raw dataset is only loaded when the tokenizers or the token cache still have to be built
+    ds_raw = None
+    cache_path = token_cache_path(config)
+    if cache_path is None or not (cache_path / "meta.json").exists():
+        ds_raw = load_dataset(f"{config['data_source']}", f"{config['lang_src']}-{config['lang_tgt']}",
+                              split='train')  # loading ds from hf (only train data -> further spit to train and val)
 
     # building tokeinzer # ds-> raw_ds
     tokenizer_src = get_or_build_tokenizer(config, ds_raw, config["lang_src"])
-    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config["lang_tgt"])
+    tokenizer_tgt = tokenizer_src if config['shared_vocab'] else get_or_build_tokenizer(config, ds_raw, config["lang_tgt"])
+    # token ids of every sentence, tokenized once and memory mapped from disk
+    cache = get_or_build_token_cache(config, tokenizer_src, tokenizer_tgt, ds_raw)
     # train test split
-    train_ds_size = int(0.9 * len(ds_raw))
-    val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
+    train_ds_size = int(0.9 * len(cache))
+    val_ds_size = len(cache) - train_ds_size
+    # seeded --> the same split in every process (and every run)
+    train_ds_raw, val_ds_raw = random_split(cache, [train_ds_size, val_ds_size],
+                                            generator=torch.Generator().manual_seed(config['seed']))
 
     # getting the dataset
+    # dynamic_padding--> sequences padded per batch (PadCollate) instead of always to seq_len
+    dynamic = config['dynamic_padding']
     train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'],
-                                config['seq_len'])
+                                config['seq_len'], pad=not dynamic)
     val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'],
-                              config['seq_len'])
-    # max length of each sent in the source and target sentence
-
-    max_len_src = 0
-    max_len_tgt = 0
-    # iterate through the orignal dataset to compute maximun tokenized len
-
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
-    print(f'Max length of source sentence: {max_len_src}')  # largest seq in src
-    print(f'Max length of target sentence: {max_len_tgt}')  # largest in tgt
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+                              config['seq_len'], pad=not dynamic)
+    # max length of each sent in the source and target sentence --> stored in the cache, no pass over the dataset
+    if rank == 0:
+        print(f"Max length of source sentence: {cache.meta['src']['max_len']}")  # largest seq in src
+        print(f"Max length of target sentence: {cache.meta['tgt']['max_len']}")  # largest in tgt
+    # model input lengths ([SOS]/[EOS] included, truncated to seq_len) --> used for length bucketing
+    src_lengths = (np.minimum(cache.lengths("src"), config['seq_len'] - 2) + 2).tolist()
+    tgt_lengths = (np.minimum(cache.lengths("tgt"), config['seq_len'] - 1) + 1).tolist()
+
+    if not dynamic:
+        if world_size > 1:
+            train_sampler = DistributedSampler(train_ds, num_replicas=world_size, rank=rank, seed=config['seed'])
+            train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], sampler=train_sampler)
+        else:
+            train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
+        # not shuffled--> run_validation scores the same val_sample_size sentences every epoch (random_split
+        # already shuffled them once)
+        val_dataloader = DataLoader(val_ds, batch_size=config['val_batch_size'], shuffle=False)
+        return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
+
+    collate = PadCollate(tokenizer_tgt.token_to_id('[PAD]'))
+    lengths = [max(s, t) for s, t in zip(src_lengths, tgt_lengths)]
+    # max_tokens set--> token budget batches, batch_size ignored
+    train_sampler = LengthBucketSampler([lengths[i] for i in train_ds_raw.indices], batch_size=config['batch_size'],
+                                        max_tokens=config['max_tokens'], num_replicas=world_size, rank=rank,
+                                        seed=config['seed'] if world_size > 1 else None)
+    # validation batches made once (seeded) and reused--> run_validation scores the same val_sample_size sentences
+    # every epoch, comparable BLEU / CER / WER curves (a fresh shuffle each epoch would sample a different subset)
+    val_sampler = LengthBucketSampler([lengths[i] for i in val_ds_raw.indices], batch_size=config['val_batch_size'],
+                                      seed=config['seed']).make_batches()
+
+    report = padding_report(train_sampler.make_batches(), [src_lengths[i] for i in train_ds_raw.indices],
+                            [tgt_lengths[i] for i in train_ds_raw.indices], config['seq_len'])
+    for name, r in report.items() if rank == 0 else []:
+        print(f"Padding share ({name}): tokens {r['fixed_tokens']:.1%} -> {r['bucketed_tokens']:.1%}, "
+              f"attention {r['fixed_attention']:.1%} -> {r['bucketed_attention']:.1%}")
+
+    train_dataloader = DataLoader(train_ds, batch_sampler=train_sampler, collate_fn=collate)
+    val_dataloader = DataLoader(val_ds, batch_sampler=val_sampler, collate_fn=collate)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
 
-def get_model(config, vocab_src_len, vocab_tgt_len):
+def get_model(config, vocab_src_len, vocab_tgt_len, src_pad_id=None, tgt_pad_id=None):
+    # pad ids--> the model derives its attention masks from the token ids (make_src_mask / make_tgt_mask)
     model = build_transformer(vocab_src_len, vocab_tgt_len, config["seq_len"], config["seq_len"],
-                              d_model=config['d_model'])
+                              d_model=config['d_model'], attention_backend=config['attention_backend'],
+                              src_pad_id=src_pad_id, tgt_pad_id=tgt_pad_id, tie_weights=config['shared_vocab'])
+    # trades compute for memory while training, no effect in eval / no_grad (validation, decoding)
+    set_activation_checkpointing(model, config['activation_checkpointing'])
     return model
 
 
-def compute_val_loss(model, val_dataloader, tokenizer_tgt, device):
-    model.eval()
-    total_loss = 0.0
-    count = 0
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_tgt.token_to_id('[PAD]'))
+def compute_val_loss(model, val_dataloader, tokenizer_tgt, device, precision: str = "fp32"):
+    # mean over the non [PAD] target tokens of the whole validation set
+    return teacher_forced_loss(model, val_dataloader, tokenizer_tgt.token_to_id('[PAD]'), device, precision)[0]
+
 
-    with torch.no_grad():
-        for batch in val_dataloader:
-            encoder_input = batch['encoder_input'].to(device)
-            decoder_input = batch['decoder_input'].to(device)
-            encoder_mask = batch['encoder_mask'].to(device)
-            decoder_mask = batch['decoder_mask'].to(device)
-            label = batch['label'].to(device)
+def train_model(config):
+    # world_size > 1--> one process per rank on this machine (gloo, cpu), gradients all reduced by DDP
+    world_size = config['world_size']
+    if world_size > 1:
+        # tokenizers + token cache built once here, the ranks only read them
+        get_ds(config)
+        mp.spawn(train_worker, args=(world_size, config), nprocs=world_size, join=True)
+    else:
+        train_worker(0, 1, config)
 
-            encoder_output = model.encode(encoder_input, encoder_mask)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask)
-            proj_output = model.project(decoder_output)
 
-            loss = loss_fn(proj_output.view(-1, proj_output.shape[-1]), label.view(-1))
-            total_loss += loss.item()
-            count += 1
-    return total_loss / count
+def log_training(metrics, timer, tokens, device, global_step):
+    # periodic training scalars: buffered losses, throughput, peak memory, ms per step of every timed phase
+    metrics.add('train/tokens_per_sec', tokens.rate(), global_step)
+    metrics.add('train/peak_memory_mb', peak_memory_mb(device), global_step)
+    for name, ms in timer.means().items():
+        metrics.add(f'train/time_ms/{name}', ms, global_step)
+    timer.reset()
+    metrics.flush()
 
 
-def train_model(config):
+def broadcast_value(value: float, distributed: bool):
+    # rank 0 evaluates, every rank gets the result --> same LR schedule / early stopping decisions everywhere
+    if not distributed:
+        return value
+    t = torch.tensor([value], dtype=torch.float64)
+    dist.broadcast(t, src=0)
+    return t.item()
+
+
+def train_worker(rank, world_size, config):
     import time
     start_time = time.time()
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using device:", device)
+    distributed = world_size > 1
+    is_main = rank == 0
+    # only rank 0 prints, logs to TensorBoard and writes checkpoints
+    log = print if is_main else (lambda *args, **kwargs: None)
+    if distributed:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", str(config['dist_port']))
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+        # cores split between the ranks instead of every rank using all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    log("Using device:", device, f"({world_size} processes)" if distributed else "")
 
     Path(f"{config['data_source']}_{config['model_folder']}").mkdir(parents=True, exist_ok=True)
 
-    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
-    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config, rank, world_size)
+    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size(),
+                      tokenizer_src.token_to_id('[PAD]'), tokenizer_tgt.token_to_id('[PAD]')).to(device)
 
-    writer = SummaryWriter()
+    writer = SummaryWriter() if is_main else None
     optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"], eps=1e-9)
 
     # LR scheduler
@@ -237,6 +278,8 @@ def train_model(config):
     )
 
     loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_tgt.token_to_id('[PAD]'), label_smoothing=0.1).to(device)
+    precision = config['precision']
+    scaler = grad_scaler(precision, device)
 
     initial_epoch = 0
     global_step = 0
@@ -244,89 +287,140 @@ def train_model(config):
     model_filename = latest_weights_file_path(config) if preload == "latest" else get_weights_file_path(config,
                                                                                                         preload) if preload else None
 
-    if os.path.exists(model_filename):
-        print(f'Resuming from best model: {model_filename}')
-        state = torch.load(model_filename)
+    if model_filename and os.path.exists(model_filename):
+        log(f'Resuming from best model: {model_filename}')
+        state = torch.load(model_filename, map_location=device)
         model.load_state_dict(state['model_state_dict'])
-        optimizer.load_state_dict(state['optimizer_state_dict'])
+        try:
+            optimizer.load_state_dict(state['optimizer_state_dict'])
+        except ValueError:
+            # checkpoint from before the fused qkv layout --> weights are converted, Adam moments can't be
+            log("Optimizer state does not match the model parameters, starting with a fresh optimizer")
+        if state.get('precision', 'fp32') != precision:
+            log(f"Checkpoint was trained with {state.get('precision', 'fp32')}, continuing with {precision}")
+        if scaler.is_enabled() and 'scaler_state_dict' in state:
+            scaler.load_state_dict(state['scaler_state_dict'])
         initial_epoch = state['epoch'] + 1
         if initial_epoch >= config['num_epochs']:
             config['num_epochs'] = initial_epoch + 3
         global_step = state['global_step']
-        best_val_loss = compute_val_loss(model, val_dataloader, tokenizer_tgt, device)
-        print(f"Resumed with best validation loss: {best_val_loss:.4f}")
+        best_val_loss = compute_val_loss(model, val_dataloader, tokenizer_tgt, device, precision) if is_main else 0.0
+        best_val_loss = broadcast_value(best_val_loss, distributed)
+        log(f"Resumed with best validation loss: {best_val_loss:.4f}")
     else:
-        print("Training from scratch")
+        log("Training from scratch")
         best_val_loss = float('inf')
 
+    # torch.save on a background thread, the loop only waits for the cpu snapshot
+    checkpoint_writer = CheckpointWriter(config, keep_last=config['keep_checkpoints']) if is_main else None
+
+    # DDP--> parameters broadcast from rank 0 here, gradients averaged across the ranks in backward
+    ddp_model = data_parallel(model) if distributed else model
+
+    # buffered TensorBoard scalars (one sync + write every log_every steps), opt-in phase timers / profiler window
+    metrics = MetricBuffer(writer, config['log_every'])
+    timer = StepTimer(config['step_timers'], device)
+    timer.attach(model)
+    tokens = TokenCounter(tokenizer_tgt.token_to_id('[PAD]'))
+    profiler = profile(config['profile_steps'] if is_main else 0, config['profile_wait'],
+                       str(Path(writer.log_dir if writer else ".") / "profile"))
+    profiler.start()
+
     no_improve_count = 0
     patience = 10
 
     for epoch in range(initial_epoch, config['num_epochs']):
         torch.cuda.empty_cache()
         model.train()
-        batch_iterator = tqdm(train_dataloader, desc=f"Epoch {epoch:02d}")
-
-        for batch in batch_iterator:
-            encoder_input = batch['encoder_input'].to(device)
-            decoder_input = batch['decoder_input'].to(device)
-            encoder_mask = batch['encoder_mask'].to(device)
-            decoder_mask = batch['decoder_mask'].to(device)
-            label = batch['label'].to(device)
-
-            encoder_output = model.encode(encoder_input, encoder_mask)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask)
-            proj_output = model.project(decoder_output)
-
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
-            writer.add_scalar('train loss', loss.item(), global_step)
-            writer.flush()
-
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad(set_to_none=True)
+        if isinstance(train_dataloader.sampler, DistributedSampler):
+            train_dataloader.sampler.set_epoch(epoch)  # new shuffle every epoch, same on every rank
+        batch_iterator = tqdm(train_dataloader, desc=f"Epoch {epoch:02d}", disable=not is_main)
+
+        for batch in timer.iterate(batch_iterator):
+            with timer.phase("data"):
+                encoder_input = batch['encoder_input'].to(device)
+                decoder_input = batch['decoder_input'].to(device)
+                label = batch['label'].to(device)
+                # only ids cross to the device, masks are built there
+                encoder_mask = model.make_src_mask(encoder_input)
+                decoder_mask = model.make_tgt_mask(decoder_input)
+
+            # forward + loss under autocast (no-op for fp32), logits go into the loss as float32
+            # model(...) = encode + decode + project, called through the DDP wrapper when distributed
+            with autocast(precision, device):
+                proj_output = ddp_model(encoder_input, encoder_mask, decoder_input, decoder_mask)
+
+                with timer.phase("loss"):
+                    loss = loss_fn(proj_output.float().view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
+            # no loss.item() here --> the loss stays on the device until the next flush
+            metrics.add('train loss', loss, global_step)
+            tokens.add(label)
+
+            # fp16--> scaled loss, step skipped when the gradients overflowed
+            with timer.phase("backward"):
+                scaler.scale(loss).backward()
+            with timer.phase("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
             global_step += 1
+            timer.step()
+            profiler.step()
 
-        run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device,
-                       lambda msg: batch_iterator.write(msg), global_step, writer)
+            if is_main and metrics.due(global_step):
+                log_training(metrics, timer, tokens, device, global_step)
+                batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
 
-        val_loss = compute_val_loss(model, val_dataloader, tokenizer_tgt, device)
-        writer.add_scalar("val loss", val_loss, global_step)
-        writer.flush()
-        print(f"Validation loss at epoch {epoch:02d}: {val_loss:.4f}")
+        if is_main:
+            log_training(metrics, timer, tokens, device, global_step)
+
+        # validation on rank 0 with the plain model (no DDP sync), the other ranks wait in the broadcast
+        val_loss = 0.0
+        if is_main:
+            run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device,
+                           lambda msg: batch_iterator.write(msg), global_step, writer, precision=precision,
+                           max_sentences=config['val_sample_size'])
+
+            val_loss = compute_val_loss(model, val_dataloader, tokenizer_tgt, device, precision)
+            writer.add_scalar("val loss", val_loss, global_step)
+            writer.flush()
+        val_loss = broadcast_value(val_loss, distributed)
+        log(f"Validation loss at epoch {epoch:02d}: {val_loss:.4f}")
 
         #Update LR scheduler
         scheduler.step(val_loss)
 
-        if val_loss < best_val_loss:
+        is_best = val_loss < best_val_loss
+        if is_best:
             best_val_loss = val_loss
             no_improve_count = 0
-            print(f"New best model at epoch {epoch:02d}, saving as best...")
-            torch.save({
+            log(f"New best model at epoch {epoch:02d}, saving as best...")
+        else:
+            no_improve_count += 1
+            log(f"No improvement ({no_improve_count}/{patience})")
+
+        # one write per epoch, "best" is linked to it
+        if is_main:
+            checkpoint_writer.save({
                 'epoch': epoch,
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
+                'scaler_state_dict': scaler.state_dict(),
+                'precision': precision,
                 'global_step': global_step
-            }, get_weights_file_path(config, "best"))
-        else:
-            no_improve_count += 1
-            print(f"No improvement ({no_improve_count}/{patience})")
-
-        model_filename = get_weights_file_path(config, f"{epoch:02d}")
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': global_step
-        }, model_filename)
+            }, epoch, val_loss=val_loss, best=is_best)
 
         if no_improve_count >= patience:
-            print(f" Early stopping triggered at epoch {epoch:02d}. Best val loss: {best_val_loss:.4f}")
+            log(f" Early stopping triggered at epoch {epoch:02d}. Best val loss: {best_val_loss:.4f}")
             break
 
+    if is_main:
+        checkpoint_writer.close()
+        profiler.stop()
     total_time = (time.time() - start_time) / 60
-    print(f"Training complete in {total_time:.2f} minutes. Best val loss: {best_val_loss:.4f}")
+    log(f"Training complete in {total_time:.2f} minutes. Best val loss: {best_val_loss:.4f}")
+    if distributed:
+        dist.destroy_process_group()
 
 
 
@@ -338,6 +432,10 @@ if __name__ == '__main__':
     config = get_config()
     ####
     config['preload'] = "best"
+    # python train_es_lr.py --world_size 4 --> 4 data parallel processes on this machine
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=config['world_size'])
+    config['world_size'] = parser.parse_args().world_size
     train_model(config)
     end_time = time.time()
     print(f" Total Training Time: {(end_time - start_time) / 60:.2f} minutes")
@@ -1,126 +1,201 @@
 
+from functools import lru_cache
 from pathlib import Path
 import sys
 import torch
 from tokenizers import Tokenizer
-from datasets import load_dataset
 
-from config import get_config, latest_weights_file_path
-from model import build_transformer
-from dataset import BilingualDataset, causal_mask  # uses (1,1,L,L) causal mask
+from config import get_config, latest_weights_file_path, get_tokenizer_file_path
+from model import build_transformer, quantize_dynamic_int8
+from scripted import ScriptedTransformer, is_torchscript
+from checkpoints import load_checkpoint
+from decoding import greedy_decode, beam_search
+from token_cache import get_or_build_token_cache
+from precision import autocast
+
+
+def detokenize(tokenizer, ids, eos_id):
+    # Trim [SOS]/[EOS] -->detokenize nicely
+    try:
+        stop = ids.index(eos_id)
+    except ValueError:
+        stop = len(ids)
+    text = tokenizer.decode(ids[1:stop])  # drop SOS and everything after EOS
+    # bpe / unigram--> the Metaspace decoder restores the original spacing exactly
+    # word level tokenizers have no decoder (decode() joins the words with spaces) --> cleanup of spaces before punctuation
+    if tokenizer.decoder is None:
+        for bad, good in [(" ,", ","), (" .", "."), (" !", "!"), (" ?", "?"), (" ;", ";"), (" :", ":")]:
+            text = text.replace(bad, good)
+    return text
+
+
+class Translator:
+    # loads the tokenizers, the model and its weights once --> translate as many sentences as needed
+    def __init__(self, config=None, checkpoint=None, device=None):
+        self.config = config or get_config()
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        config = self.config
+
+        ckpt_path = checkpoint or latest_weights_file_path(config)
+        self.dataset = None  # token cache, only opened for numeric (dataset index) inputs
+        scripted = is_torchscript(ckpt_path)
+        state = None if scripted else load_checkpoint(ckpt_path)  # memory mapped (torch >= 2.1), the optimizer state is not read
+        # bundle (bundle.py)--> tokenizers + model hyperparameters stored with the weights, no files / config needed
+        hparams = state.get("hparams") if state is not None else None
+
+        # Load--> wordlevel tokenizer both src and tgt
+        if hparams:
+            self.tok_src = Tokenizer.from_str(state["tokenizers"]["src"])
+            self.tok_tgt = Tokenizer.from_str(state["tokenizers"]["tgt"])
+        else:
+            self.tok_src = Tokenizer.from_file(str(Path(get_tokenizer_file_path(config, config["lang_src"]))))
+            self.tok_tgt = Tokenizer.from_file(str(Path(get_tokenizer_file_path(config, config["lang_tgt"]))))
+        self.sos_src = self.tok_src.token_to_id("[SOS]")
+        self.eos_src = self.tok_src.token_to_id("[EOS]")
+        self.pad_src = self.tok_src.token_to_id("[PAD]")
+        self.sos_tgt = self.tok_tgt.token_to_id("[SOS]")
+        self.eos_tgt = self.tok_tgt.token_to_id("[EOS]")
+        self.seq_len = hparams["tgt_seq_len"] if hparams else config["seq_len"]
+        self.min_len = 2  # block EOS for first couple tokens
+        self.precision = config["precision"]  # autocast dtype of every decode, weights stay float32
+
+        if scripted:
+            # export of export_torchscript.py --> traced encoder / decode step, no eager model built, float32
+            self.model = ScriptedTransformer(ckpt_path, self.device)
+            self.precision = "fp32"
+            return
+
+        # model building
+        if hparams:
+            self.model = build_transformer(**hparams, attention_backend=config["attention_backend"]).to(self.device)
+        else:
+            self.model = build_transformer(
+                self.tok_src.get_vocab_size(),
+                self.tok_tgt.get_vocab_size(),
+                config["seq_len"],
+                config["seq_len"],
+                d_model=config["d_model"],
+                attention_backend=config["attention_backend"],
+                src_pad_id=self.pad_src,
+                tgt_pad_id=self.tok_tgt.token_to_id("[PAD]"),
+                tie_weights=config["shared_vocab"],
+            ).to(self.device)
+
+        # loading the wts
+        if state.get("quantization") == "dynamic_int8":
+            # export of quantize.py --> same int8 module structure before loading, runs on cpu in float32
+            self.device = torch.device("cpu")
+            self.model = quantize_dynamic_int8(self.model.cpu())
+            self.precision = "fp32"
+        self.model.load_state_dict(state["model_state_dict"])
+        self.model.eval()
+
+    def source_pair(self, idx: int):
+        # (source, target) sentence at index idx of the train split
+        if self.dataset is None:
+            self.dataset = get_or_build_token_cache(self.config, self.tok_src, self.tok_tgt)
+        return self.dataset.text("src", idx), self.dataset.text("tgt", idx)
+
+    def encode_sources(self, sentences):
+        # [SOS] + ids + [EOS], padded to the longest sentence of the batch --> (B, L) ids and (B,1,1,L) src mask
+        rows = [[self.sos_src] + enc.ids[: self.seq_len - 2] + [self.eos_src]  # reserve [SOS],[EOS]
+                for enc in self.tok_src.encode_batch(list(sentences))]
+        width = max(len(r) for r in rows)
+        source = torch.tensor([r + [self.pad_src] * (width - len(r)) for r in rows], dtype=torch.long,
+                              device=self.device)
+        src_mask = self.model.make_src_mask(source)  # (B,1,1,L) bool
+        return source, src_mask
+
+    def translate_batch(self, sentences):
+        # all sentences decoded together, greedy or beam search depending on config["beam_size"]
+        if len(sentences) == 0:
+            return []
+        with torch.no_grad(), self.autocast():
+            source, src_mask = self.encode_sources(sentences)
+            if self.config["beam_size"] > 1:
+                out = beam_search(self.model, source, src_mask, self.tok_tgt, self.seq_len, self.device,
+                                  beam_size=self.config["beam_size"], length_penalty=self.config["length_penalty"],
+                                  min_len=self.min_len)
+            else:
+                out = greedy_decode(self.model, source, src_mask, self.tok_src, self.tok_tgt, self.seq_len,
+                                    self.device, min_len=self.min_len)
+        return [detokenize(self.tok_tgt, row, self.eos_tgt) for row in out.tolist()]
+
+    def autocast(self):
+        return autocast(self.precision, self.device)
+
+    def translate(self, sentence: str):
+        return self.translate_batch([sentence])[0]
+
+    def stream_ids(self, sentence: str):
+        # greedy decoding of a single sentence, yields every predicted token id (without [EOS]) as soon as it is decoded
+        with torch.no_grad():
+            source, src_mask = self.encode_sources([sentence])
+            # autocast per step, not around the yield --> the caller's code never runs inside it
+            with self.autocast():
+                # Run encoder
+                enc_out = self.model.encode(source, src_mask)
+                # per layer keys/values of the tokens decoded so far + the encoder output projected once for cross attention
+                cache = self.model.prepare_memory(enc_out)
+            next_id = self.sos_tgt
+            steps = 0
+            while steps + 1 < self.seq_len:
+                # only the newest token goes through the decoder, it may attend to all cached ones --> no causal mask
+                last = torch.tensor([[next_id]], device=self.device)
+                with self.autocast():
+                    out = self.model.decode(enc_out, src_mask, last, None, cache)  # (1,1,d_model)
+                    logits = self.model.project(out[:, -1])  # (1, vocab)
+                # prevent early EOS
+                if steps < self.min_len:
+                    logits[:, self.eos_tgt] = float('-inf')
+                next_id = torch.argmax(logits, dim=-1).item()
+                steps += 1
+                if next_id == self.eos_tgt:
+                    break
+                yield next_id
+
+    def translate_stream(self, sentence: str):
+        # streaming variant of translate --> the text each new token adds
+        # the ids so far are decoded together and only the new suffix yielded: subword pieces decoded one by one
+        # lose their word boundaries (Metaspace), the joined stream is the detokenize result of the whole output
+        ids = [self.sos_tgt]
+        text = ""
+        for next_id in self.stream_ids(sentence):
+            ids.append(next_id)
+            new_text = detokenize(self.tok_tgt, ids, self.eos_tgt)
+            yield new_text[len(text):]
+            text = new_text
+
+
+@lru_cache(maxsize=1)
+def default_translator():
+    # shared instance --> tokenizers / model / weights loaded on the first call only
+    return Translator()
+
 
 # defining entry point that would either translate a raw string or int index
-def translate(sentence: str):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("using device:", device)
-    config = get_config()
-
-    # Load--> wordlevel tokenizer both src and tgt
-    tok_src = Tokenizer.from_file(str(Path(config["tokenizer_file"].format(config["lang_src"]))))
-    tok_tgt = Tokenizer.from_file(str(Path(config["tokenizer_file"].format(config["lang_tgt"]))))
-
-    # model building
-    model = build_transformer(
-        tok_src.get_vocab_size(),
-        tok_tgt.get_vocab_size(),
-        config["seq_len"],
-        config["seq_len"],
-        d_model=config["d_model"],
-    ).to(device)
-
-    # loading the wts
-    ckpt_path = latest_weights_file_path(config)
-    state = torch.load(ckpt_path, map_location=device)
-    model.load_state_dict(state["model_state_dict"])
-    model.eval()
+def translate(sentence: str, translator: Translator = None):
+    translator = translator or default_translator()
+    print("using device:", translator.device)
 
     # numeric input to index ( from the (train) set)
     label = ""
     if isinstance(sentence, int) or (isinstance(sentence, str) and sentence.isdigit()):
         idx = int(sentence)
-        ds_raw = load_dataset(
-            config["data_source"], f"{config['lang_src']}-{config['lang_tgt']}", split="train"
-        )
-        ds = BilingualDataset(
-            ds_raw, tok_src, tok_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"]
-        )
-        sentence = ds[idx]["src_text"]
-        label = ds[idx]["tgt_text"]
-
-    seq_len = config["seq_len"]
-
-    # Encode source
-    with torch.no_grad():
-        src_ids = tok_src.encode(sentence).ids[: seq_len - 2]  # reserve [SOS],[EOS]
-        pad_src = seq_len - len(src_ids) - 2
-        if pad_src < 0:
-            pad_src = 0
-
-        sos_src = tok_src.token_to_id("[SOS]")
-        eos_src = tok_src.token_to_id("[EOS]")
-        pad_src_id = tok_src.token_to_id("[PAD]")
-
-        source = torch.tensor(
-            [sos_src] + src_ids + [eos_src] + [pad_src_id] * pad_src, dtype=torch.long, device=device
-        )  # (L,)
-        source = source.unsqueeze(0)  # (B=1, L)
-
-        # src mask -> (B,1,1,L)
-        src_mask = (source != pad_src_id).unsqueeze(1).unsqueeze(2).int()  # (1,1,1,L)
-
-        # Run encoder
-        enc_out = model.encode(source, src_mask)
-
-        # Greedy decode (with tiny min-length )
-        sos_tgt = tok_tgt.token_to_id("[SOS]")
-        eos_tgt = tok_tgt.token_to_id("[EOS]")
-
-        dec = torch.tensor([[sos_tgt]], dtype=torch.long, device=device)  # (1,1)
-        min_len = 2  # block EOS for first couple tokens
-        steps = 0
-
-        if label != "":
-            print(f"{'ID:':>12} {idx}")
-        print(f"{'SOURCE:':>12} {sentence}")
-        if label != "":
-            print(f"{'TARGET:':>12} {label}")
-        print(f"{'PREDICTED:':>12}", end=" ")
-
-        while dec.size(1) < seq_len:
-            L = dec.size(1)
-            tgt_mask = causal_mask(L).to(device)  # (1,1,L,L), keep=1 mask
-
-            out = model.decode(enc_out, src_mask, dec, tgt_mask)  # (1,L,d_model)
-            logits = model.project(out[:, -1])  # (1, vocab)
-            next_id = torch.argmax(logits, dim=-1).item()
-
-            # prevent early EOS
-            if steps < min_len and next_id == eos_tgt:
-                # pick 2nd best
-                top2 = torch.topk(torch.log_softmax(logits, dim=-1), 2, dim=-1).indices[0]
-                next_id = top2[1].item()
-
-            dec = torch.cat([dec, torch.tensor([[next_id]], device=device)], dim=1)
-            print(tok_tgt.decode([next_id]), end=" ")
-
-            steps += 1
-            if next_id == eos_tgt and steps >= min_len:
-                break
-
-        # Trim [SOS]/[EOS] -->detokenize nicely
-        out_ids = dec[0].tolist()
-        try:
-            stop = out_ids.index(eos_tgt)
-        except ValueError:
-            stop = len(out_ids)
-        trimmed = out_ids[1:stop]  # drop SOS and everything after EOS
-
-        text = tok_tgt.decode(trimmed)
-        # simple cleanup of spaces before punctuation
-        for bad, good in [(" ,", ","), (" .", "."), (" !", "!"), (" ?", "?"), (" ;", ";"), (" :", ":")]:
-            text = text.replace(bad, good)
-
-        return text
+        sentence, label = translator.source_pair(idx)
+
+    if label != "":
+        print(f"{'ID:':>12} {idx}")
+    print(f"{'SOURCE:':>12} {sentence}")
+    if label != "":
+        print(f"{'TARGET:':>12} {label}")
+    print(f"{'PREDICTED:':>12}", end=" ")
+
+    text = ""
+    for piece in translator.translate_stream(sentence):
+        print(piece, end="", flush=True)
+        text += piece
+    return text
 
 if __name__ == "__main__":
     # Usage: